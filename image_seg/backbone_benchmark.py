@@ -0,0 +1,99 @@
+"""
+backbone_benchmark.py
+
+Throughput/latency of the backbones of model.BACKBONES on the CPU, at several image sizes: for each, the number of
+parameters and the latency of the backbone alone (C2 to C5) and of MaskRCNN.detect() on one image (random weights,
+with every detection kept so that the heads always do the same work).
+
+Run from the root directory of the project:
+    python -m image_seg.backbone_benchmark
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import time
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+import keras.layers as KL
+import keras.models as KM
+
+from image_seg import model as modellib
+from image_seg.config import Config
+
+# Hide GPUs, so that everything runs on the CPU
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+backbones = ["resnet101", "resnet50", "mobilenet"]
+image_dims = [512, 1024]
+warmup_runs, timed_runs = 2, 10
+model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+
+
+class BenchmarkConfig(Config):
+    NAME = "backbone_benchmark"
+    NUM_CLASSES = 1 + 34
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    DETECTION_MIN_CONFIDENCE = 0
+    GRAPH_ANCHORS = True
+
+    def __init__(self, backbone, image_dim):
+        self.BACKBONE = backbone
+        self.IMAGE_MIN_DIM = self.IMAGE_MAX_DIM = image_dim
+        super(BenchmarkConfig, self).__init__()
+
+
+def time_runs(run):
+    """Average time (s) of run() after a few warm-up runs"""
+    for _ in range(warmup_runs):
+        run()
+
+    start = time.perf_counter()
+    for _ in range(timed_runs):
+        run()
+    return (time.perf_counter() - start) / timed_runs
+
+
+def benchmark_backbone(backbone, image_dim):
+    """Latency of the backbone alone
+    Returns:
+        number of parameters and average latency (s)
+    """
+    K.clear_session()
+    input_image = KL.Input(shape=[None, None, 3])
+    _, C2, C3, C4, C5 = modellib.BACKBONES[backbone](input_image, stage5=True, train_bn=False)
+    model = KM.Model(input_image, [C2, C3, C4, C5])
+
+    image = np.random.rand(1, image_dim, image_dim, 3).astype(np.float32)
+    return model.count_params(), time_runs(lambda: model.predict(image))
+
+
+def benchmark_detect(backbone, image_dim):
+    """Latency of MaskRCNN.detect() on an image of image_dim x image_dim
+    Returns:
+        number of parameters and average latency (s)
+    """
+    K.clear_session()
+    model = modellib.MaskRCNN(mode="inference", config=BenchmarkConfig(backbone, image_dim), model_dir=model_dir)
+
+    image = np.random.randint(0, 256, (image_dim, image_dim, 3), dtype=np.uint8)
+    return model.keras_model.count_params(), time_runs(lambda: model.detect([image]))
+
+
+def main():
+    print(f"CPU, {tf.__version__}, {timed_runs} runs per setting")
+    print(f"{'backbone':>10} {'size':>5} {'backbone params':>16} {'backbone (ms)':>14} {'model params':>13} "
+          f"{'detect (ms)':>12} {'images/s':>9}")
+
+    for image_dim in image_dims:
+        for backbone in backbones:
+            backbone_params, backbone_time = benchmark_backbone(backbone, image_dim)
+            model_params, detect_time = benchmark_detect(backbone, image_dim)
+            print(f"{backbone:>10} {image_dim:>5} {backbone_params / 1e6:>15.1f}M {backbone_time * 1000:>14.1f} "
+                  f"{model_params / 1e6:>12.1f}M {detect_time * 1000:>12.1f} {1 / detect_time:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
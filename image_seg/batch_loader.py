@@ -0,0 +1,250 @@
+"""
+Mask R-CNN
+Shared-memory batch loading for training.
+
+With use_multiprocessing, Keras runs a copy of data_generator() in every
+worker process: each one computes the anchor pyramid again, and every batch
+(images, gt_masks padded to MAX_GT_INSTANCES and RPN targets) is pickled
+back to the training process. SharedBatchLoader instead preallocates a few
+batch slots in shared memory. Worker processes write samples straight into
+the slots and only pass slot numbers through queues. The anchors are computed
+once and shared read-only.
+
+Batches have a fixed shape, so images must all be resized to
+config.IMAGE_SHAPE ("square" or "crop" IMAGE_RESIZE_MODE).
+"""
+
+import logging
+import multiprocessing
+import numpy as np
+import traceback
+
+from image_seg import utils
+from image_seg import model as modellib
+
+
+############################################################
+#  Shared Arrays
+############################################################
+
+_CTYPES = {np.dtype(np.float64): 'd', np.dtype(np.float32): 'f', np.dtype(np.int32): 'i',
+           np.dtype(np.bool_): 'b', np.dtype(np.uint8): 'B'}
+
+
+def shared_array(context, shape, dtype):
+    """Allocates a zero-filled array in shared memory, inherited by processes
+    forked afterwards (without copying).
+    """
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buffer = context.RawArray(_CTYPES[dtype], max(count, 1))
+    return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+
+def generate_training_anchors(config):
+    """Anchor pyramid [anchor_count, (y1, x1, y2, x2)] in pixel coordinates
+    of config.IMAGE_SHAPE, as used to build RPN targets.
+    """
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    return utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                          config.RPN_ANCHOR_RATIOS,
+                                          backbone_shapes,
+                                          config.BACKBONE_STRIDES,
+                                          config.RPN_ANCHOR_STRIDE)
+
+
+############################################################
+#  Loader
+############################################################
+
+class SharedBatchLoader(object):
+    """Generator of Mask R-CNN training batches, in the same format as
+    data_generator() (without random ROIs or detection targets).
+
+    The arrays of a batch are views into a shared slot, valid until the
+    next batch is taken: consume each batch before asking for the next one
+    (as fit_generator() does with workers=0).
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augment=False, augmentation=None,
+                 batch_size=1, workers=None, slots=None, anchors=None):
+        """
+        dataset: The Dataset object to pick training images from.
+        config: The model config object.
+        shuffle: If True, each worker shuffles the images before every epoch.
+        augment, augmentation: See data_generator().
+        batch_size: How many images to return in each batch.
+        workers: Number of worker processes. Defaults to the CPU count.
+        slots: Number of batches in shared memory (in progress or ready).
+            Defaults to the number of workers plus two: one batch being
+            filled per worker, one being consumed and one ready.
+        anchors: Optional. [anchor_count, (y1, x1, y2, x2)] anchors in pixel
+            coordinates (see generate_training_anchors()).
+        """
+        assert config.IMAGE_RESIZE_MODE in ["square", "crop"], \
+            "Shared batches need images of a fixed size"
+
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.augment = augment
+        self.augmentation = augmentation
+        self.batch_size = batch_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self.num_slots = slots or self.workers + 2
+
+        # Workers are forked so that they inherit the shared memory (and the
+        # dataset) without pickling
+        self._context = multiprocessing.get_context("fork")
+
+        if anchors is None:
+            anchors = generate_training_anchors(config)
+        self.anchors = shared_array(self._context, anchors.shape, anchors.dtype)
+        self.anchors[:] = anchors
+        self.anchors.flags.writeable = False
+        self.anchor_grid = utils.AnchorGrid(self.anchors)
+
+        mask_shape = config.MINI_MASK_SHAPE if config.USE_MINI_MASK else tuple(config.IMAGE_SHAPE[:2])
+        shapes = [
+            ("images", tuple(config.IMAGE_SHAPE), np.float32),
+            ("image_meta", (config.IMAGE_META_SIZE,), np.float64),
+            ("rpn_match", (anchors.shape[0], 1), np.int32),
+            ("rpn_bbox", (config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4), np.float64),
+            ("gt_class_ids", (config.MAX_GT_INSTANCES,), np.int32),
+            ("gt_boxes", (config.MAX_GT_INSTANCES, 4), np.int32),
+            ("gt_masks", tuple(mask_shape) + (config.MAX_GT_INSTANCES,), np.bool_),
+        ]
+        self.names = [name for name, _, _ in shapes]
+        self.slots = [{name: shared_array(self._context, (batch_size,) + shape, dtype)
+                       for name, shape, dtype in shapes}
+                      for _ in range(self.num_slots)]
+
+        self._free = None
+        self._ready = None
+        self._processes = []
+        self._current = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._processes:
+            self.start()
+
+        # The previous batch has been consumed, so its slot can be refilled
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+
+        slot, error = self._ready.get()
+        if error is not None:
+            self.close()
+            raise RuntimeError("Error in batch loader worker:\n" + error)
+
+        self._current = slot
+        batch = self.slots[slot]
+        return [batch[name] for name in self.names], []
+
+    def start(self):
+        """Forks the worker processes and hands them all the slots."""
+        self._free = self._context.Queue()
+        self._ready = self._context.Queue()
+        for slot in range(self.num_slots):
+            self._free.put(slot)
+
+        seed = np.random.randint(2 ** 31)
+        for i in range(self.workers):
+            process = self._context.Process(target=self._work, args=((seed + i) % 2 ** 31,), daemon=True)
+            process.start()
+            self._processes.append(process)
+
+    def close(self):
+        """Stops the worker processes."""
+        for process in self._processes:
+            process.terminate()
+        self._processes = []
+        self._current = None
+
+    def _samples(self, rng):
+        """Yields the samples of the images of the dataset (in a worker),
+        skipping images without instances.
+        """
+        image_ids = np.copy(self.dataset.image_ids)
+        error_count = 0
+        while True:
+            if self.shuffle:
+                rng.shuffle(image_ids)
+            for image_id in image_ids:
+                try:
+                    sample = self._load_sample(image_id, rng)
+                except Exception:
+                    # Log it and skip the image
+                    logging.exception("Error processing image {}".format(
+                        self.dataset.image_info[image_id]))
+                    error_count += 1
+                    if error_count > 5:
+                        raise
+                    continue
+                if sample is not None:
+                    yield sample
+
+    def _load_sample(self, image_id, rng):
+        config = self.config
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            modellib.load_image_gt(self.dataset, config, image_id, augment=self.augment,
+                                   augmentation=self.augmentation,
+                                   use_mini_mask=config.USE_MINI_MASK)
+
+        # Skip images that have no instances
+        if not np.any(gt_class_ids > 0):
+            return None
+
+        assert image.shape == tuple(config.IMAGE_SHAPE), \
+            "Image {} has shape {}, expected {}".format(image_id, image.shape, config.IMAGE_SHAPE)
+
+        rpn_match, rpn_bbox = modellib.build_rpn_targets(image.shape, self.anchors,
+                                                         gt_class_ids, gt_boxes, config,
+                                                         anchor_grid=self.anchor_grid)
+
+        # If more instances than fits in the array, sub-sample from them.
+        if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+            ids = rng.choice(np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+            gt_class_ids = gt_class_ids[ids]
+            gt_boxes = gt_boxes[ids]
+            gt_masks = gt_masks[:, :, ids]
+
+        return image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks
+
+    def _write(self, batch, b, sample):
+        """Writes a sample into item b of a batch slot, in place."""
+        image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks = sample
+        n = gt_class_ids.shape[0]
+
+        batch["images"][b] = modellib.mold_image(image.astype(np.float32), self.config)
+        batch["image_meta"][b] = image_meta
+        batch["rpn_match"][b, :, 0] = rpn_match
+        batch["rpn_bbox"][b] = rpn_bbox
+        batch["gt_class_ids"][b, :n] = gt_class_ids
+        batch["gt_class_ids"][b, n:] = 0
+        batch["gt_boxes"][b, :n] = gt_boxes
+        batch["gt_boxes"][b, n:] = 0
+        batch["gt_masks"][b, :, :, :n] = gt_masks
+        batch["gt_masks"][b, :, :, n:] = False
+
+    def _work(self, seed):
+        """Worker process: fills free slots with batches of samples."""
+        # Forked workers would otherwise all draw the same random numbers
+        np.random.seed(seed)
+        rng = np.random.RandomState(seed)
+        if self.augmentation is not None:
+            self.augmentation.reseed(seed)
+        samples = self._samples(rng)
+        try:
+            while True:
+                slot = self._free.get()
+                batch = self.slots[slot]
+                for b in range(self.batch_size):
+                    self._write(batch, b, next(samples))
+                self._ready.put((slot, None))
+        except Exception:
+            self._ready.put((-1, traceback.format_exc()))
@@ -49,7 +49,9 @@ class Config(object):
     VALIDATION_STEPS = 50
 
     # Backbone network architecture
-    # Supported values are: resnet50, resnet101.
+    # Supported values are the names in model.BACKBONES: resnet50, resnet101
+    # and mobilenet (much lighter, e.g. for inference on CPUs). Other
+    # backbones can be added with model.register_backbone().
     # You can also provide a callable that should have the signature
     # of model.resnet_graph. If you do so, you need to supply a callable
     # to COMPUTE_BACKBONE_SHAPE as well
@@ -168,6 +170,16 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Suppress overlapping detections of all classes with a single NMS
+    # (boxes are offset by their class ID) instead of one NMS per class.
+    # Same detections, faster with many classes.
+    DETECTION_BATCHED_NMS = False
+
+    # Generate anchors inside the inference graph (see model.AnchorsLayer)
+    # instead of feeding them with every batch. The inference model then
+    # takes only the images and the image metas as inputs.
+    GRAPH_ANCHORS = False
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer
@@ -0,0 +1,108 @@
+"""
+detection_nms_benchmark.py
+
+Micro-benchmark of the NMS of refine_detections_graph() on the CPU: one NMS per class (the default) against a single
+NMS over class-offset boxes (Config.DETECTION_BATCHED_NMS), for increasing numbers of classes. Checks that both
+return the same detections.
+
+Run from the root directory of the project:
+    python -m image_seg.detection_nms_benchmark
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import numpy as np
+import tensorflow as tf
+
+from image_seg import model as modellib
+from image_seg.config import Config
+
+
+class BenchmarkConfig(Config):
+    NAME = "detection_nms_benchmark"
+    DETECTION_MIN_CONFIDENCE = 0.5
+
+
+# Numbers of classes (including background; the WAD dataset has 1 + 34), proposals per image and runs per setting
+class_counts = [2, 9, 35, 81]
+num_rois = BenchmarkConfig.POST_NMS_ROIS_INFERENCE
+test_images = 20
+warmup_runs = 3
+
+
+def random_inputs(num_classes, rng):
+    """Proposals clustered around a few objects, with peaked class probabilities (so that many pass
+    DETECTION_MIN_CONFIDENCE and overlap each other)
+    Returns:
+        rois [N, 4], probs [N, num_classes], deltas [N, num_classes, 4] and window [4]
+    """
+    centers = rng.uniform(0.1, 0.9, size=(30, 2))
+    sizes = rng.uniform(0.05, 0.3, size=(30, 2))
+    objects = rng.randint(0, len(centers), num_rois)
+    center = centers[objects] + rng.normal(0, 0.02, size=(num_rois, 2))
+    size = sizes[objects] * rng.uniform(0.8, 1.2, size=(num_rois, 2))
+    rois = np.clip(np.concatenate([center - size / 2, center + size / 2], axis=1), 0, 1)
+
+    logits = rng.normal(0, 1, size=(num_rois, num_classes))
+    logits[np.arange(num_rois), rng.randint(0, num_classes, num_rois)] += rng.uniform(0, 6, num_rois)
+    probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    deltas = rng.normal(0, 0.5, size=(num_rois, num_classes, 4))
+    window = np.array([0., 0., 1., 1.])
+    return rois.astype(np.float32), probs.astype(np.float32), deltas.astype(np.float32), window.astype(np.float32)
+
+
+def benchmark(num_classes, batched, inputs):
+    """Builds refine_detections_graph() in a fresh graph and runs it on each input
+    Returns:
+        number of ops, average latency (s) and the detections
+    """
+    config = BenchmarkConfig()
+    config.NUM_CLASSES = num_classes
+    config.DETECTION_BATCHED_NMS = batched
+
+    graph = tf.Graph()
+    with graph.as_default(), tf.device('/device:CPU:0'):
+        rois_tnsr = tf.placeholder(tf.float32, [num_rois, 4], 'rois')
+        probs_tnsr = tf.placeholder(tf.float32, [num_rois, num_classes], 'probs')
+        deltas_tnsr = tf.placeholder(tf.float32, [num_rois, num_classes, 4], 'deltas')
+        window_tnsr = tf.placeholder(tf.float32, [4], 'window')
+        detections_tnsr = modellib.refine_detections_graph(rois_tnsr, probs_tnsr, deltas_tnsr, window_tnsr,
+                                                           config)
+        num_ops = len(graph.get_operations())
+
+    with tf.Session(graph=graph) as sess:
+        def run(rois, probs, deltas, window):
+            return sess.run(detections_tnsr, feed_dict={rois_tnsr: rois, probs_tnsr: probs,
+                                                        deltas_tnsr: deltas, window_tnsr: window})
+
+        for _ in range(warmup_runs):
+            run(*inputs[0])
+
+        start = time.perf_counter()
+        detections = [run(*x) for x in inputs]
+        latency = (time.perf_counter() - start) / len(inputs)
+
+    return num_ops, latency, detections
+
+
+def main():
+    print(f"{num_rois} proposals per image, {test_images} images per setting (CPU)")
+    print(f"{'classes':>7} {'detections':>10} {'per class (ms)':>15} {'batched (ms)':>13} {'speedup':>8} "
+          f"{'ops':>11} {'identical':>10}")
+
+    rng = np.random.RandomState(0)
+    for num_classes in class_counts:
+        inputs = [random_inputs(num_classes, rng) for _ in range(test_images)]
+
+        per_class_ops, per_class_time, per_class_detections = benchmark(num_classes, False, inputs)
+        batched_ops, batched_time, batched_detections = benchmark(num_classes, True, inputs)
+
+        identical = all(np.array_equal(a, b) for a, b in zip(per_class_detections, batched_detections))
+        count = np.mean([np.count_nonzero(d[:, 4]) for d in per_class_detections])
+        print(f"{num_classes:>7} {count:>10.1f} {per_class_time * 1000:>15.2f} {batched_time * 1000:>13.2f} "
+              f"{per_class_time / batched_time:>7.1f}x {per_class_ops:>5}/{batched_ops:<5} {str(identical):>10}")
+
+
+if __name__ == '__main__':
+    main()
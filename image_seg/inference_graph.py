@@ -0,0 +1,317 @@
+"""
+Mask R-CNN
+Frozen inference graphs.
+
+At inference, a batch normalization layer is a fixed per-channel affine
+transform, applied in a memory pass of its own. fold_batch_norms() rebuilds
+a Keras model with every batch normalization that follows a convolution
+folded into the weights of that convolution. export_inference_graph() folds
+a model, keeps only the outputs that are needed, and writes the graph with
+its weights as constants to a single file. FrozenModel loads that file back,
+which is much faster than building the Keras model and loading its weights.
+"""
+
+import json
+import numpy as np
+import tensorflow as tf
+import keras
+import keras.backend as K
+import keras.layers as KL
+import keras.models as KM
+
+# Depthwise convolutions are a layer of Keras 2.1.5 and later
+try:
+    DepthwiseConv2D = KL.DepthwiseConv2D
+except AttributeError:
+    from keras.applications.mobilenet import DepthwiseConv2D
+
+
+# Name of the constant node that describes the inputs and outputs of a
+# frozen graph (as JSON)
+GRAPH_INFO_NODE = "inference_graph_info"
+
+
+############################################################
+#  Keras Graph Traversal
+############################################################
+
+def _to_list(x):
+    return x if isinstance(x, list) else [x]
+
+
+def _node_key(tensor):
+    """Identifies the Keras node (layer call) that produced a tensor."""
+    layer, node_index, _ = tensor._keras_history
+    return id(layer), node_index
+
+
+def _node_arguments(layer, node_index):
+    """Keyword arguments the layer was called with at the given node."""
+    nodes = getattr(layer, "_inbound_nodes", None)
+    if nodes is None:
+        # Before Keras 2.1.3
+        nodes = layer.inbound_nodes
+    return dict(nodes[node_index].arguments or {})
+
+
+def _walk(outputs):
+    """Lists the nodes the outputs depend on, every node after its inputs.
+
+    Returns: [(layer, node_index)]
+    """
+    order = []
+    visited = set()
+    stack = [(tensor._keras_history[:2], False) for tensor in reversed(outputs)]
+    while stack:
+        (layer, node_index), inputs_done = stack.pop()
+        if inputs_done:
+            order.append((layer, node_index))
+            continue
+        if (id(layer), node_index) in visited:
+            continue
+        visited.add((id(layer), node_index))
+        stack.append(((layer, node_index), True))
+        if not isinstance(layer, KL.InputLayer):
+            for tensor in reversed(_to_list(layer.get_input_at(node_index))):
+                stack.append((tensor._keras_history[:2], False))
+    return order
+
+
+############################################################
+#  Batch Normalization Folding
+############################################################
+
+def _unwrap(layer):
+    return layer.layer if isinstance(layer, KL.TimeDistributed) else layer
+
+
+def _batch_norm_affine(bn):
+    """Returns the (scale, offset) [channels] that an inference mode batch
+    normalization layer applies to its input.
+    """
+    mean, variance = K.batch_get_value([bn.moving_mean, bn.moving_variance])
+    gamma = K.get_value(bn.gamma) if bn.scale else 1.
+    beta = K.get_value(bn.beta) if bn.center else 0.
+    scale = gamma / np.sqrt(variance + bn.epsilon)
+    return scale, beta - mean * scale
+
+
+def _foldable(conv_layer, bn_layer, scale):
+    """Whether a batch normalization can be folded into the convolution
+    before it. A ReLU between them can only be folded if it commutes with
+    the scale (all positive).
+    """
+    conv, bn = _unwrap(conv_layer), _unwrap(bn_layer)
+    if not isinstance(bn, KL.BatchNormalization) or \
+            isinstance(conv_layer, KL.TimeDistributed) != isinstance(bn_layer, KL.TimeDistributed):
+        return False
+    if not isinstance(conv, (KL.Conv2D, DepthwiseConv2D)) or conv.data_format != "channels_last":
+        return False
+    ndim = bn.input_spec.ndim
+    if list(np.ravel(bn.axis) % ndim) != [ndim - 1]:
+        return False
+    if conv.activation is keras.activations.relu:
+        return bool(np.all(scale > 0))
+    return conv.activation is keras.activations.linear
+
+
+def _fold(conv_layer, bn_layer, inputs):
+    """Calls a copy of the convolution with the batch normalization folded
+    into its kernel and bias.
+
+    Returns: the output tensor
+    """
+    conv = _unwrap(conv_layer)
+    scale, offset = _batch_norm_affine(_unwrap(bn_layer))
+
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else 0.
+    if isinstance(conv, DepthwiseConv2D):
+        # [height, width, in_channels, depth_multiplier]
+        kernel = kernel * scale.reshape(kernel.shape[2:])
+    elif isinstance(conv, KL.Conv2DTranspose):
+        # [height, width, out_channels, in_channels]
+        kernel = kernel * scale[:, np.newaxis]
+    else:
+        kernel = kernel * scale
+
+    config = conv.get_config()
+    config.update(use_bias=True, activation="linear")
+    folded = conv.__class__.from_config(config)
+    if isinstance(conv_layer, KL.TimeDistributed):
+        x = KL.TimeDistributed(folded, name=conv_layer.name)(inputs)
+    else:
+        x = folded(inputs)
+    folded.set_weights([kernel, bias * scale + offset])
+
+    if conv.activation is keras.activations.relu:
+        # relu(z) * scale + offset = max(z * scale + offset, offset) when scale > 0
+        x = KL.Lambda(lambda t: K.maximum(t, offset.astype(np.float32)), name=bn_layer.name)(x)
+    return x
+
+
+def fold_batch_norms(model, outputs=None):
+    """Rebuilds a Keras model for inference, with the batch normalization
+    layers that directly follow a convolution (2D, transposed or depthwise,
+    possibly in TimeDistributed wrappers) folded into it. The other layers
+    are reused, and the remaining batch normalization layers are called in
+    inference mode.
+
+    model: A Keras model. Nested models are reused as they are.
+    outputs: Optional. The output tensors of the model to keep (defaults to
+        all of them). Layers that they do not depend on are dropped.
+
+    Returns: A Keras model with the same inputs.
+    """
+    outputs = model.outputs if outputs is None else outputs
+    nodes = _walk(outputs)
+
+    # How many times each node output is used. Convolutions whose output is
+    # also used elsewhere are not folded.
+    consumers = {}
+    for tensor in outputs:
+        consumers[_node_key(tensor)] = consumers.get(_node_key(tensor), 0) + 1
+    for layer, node_index in nodes:
+        if not isinstance(layer, KL.InputLayer):
+            for tensor in _to_list(layer.get_input_at(node_index)):
+                consumers[_node_key(tensor)] = consumers.get(_node_key(tensor), 0) + 1
+
+    # Pair batch normalization nodes with the convolution nodes they fold into
+    folds = {}
+    for layer, node_index in nodes:
+        inputs = layer.get_input_at(node_index)
+        if not isinstance(_unwrap(layer), KL.BatchNormalization) or isinstance(inputs, list):
+            continue
+        conv_layer = inputs._keras_history[0]
+        if consumers[_node_key(inputs)] == 1 and \
+                _foldable(conv_layer, layer, _batch_norm_affine(_unwrap(layer))[0]):
+            folds[_node_key(inputs)] = layer
+            folds[(id(layer), node_index)] = None
+
+    # Call the layers again, in order, on the rebuilt tensors
+    rebuilt = {}
+    for layer, node_index in nodes:
+        key = (id(layer), node_index)
+        if isinstance(layer, KL.InputLayer):
+            rebuilt[key] = _to_list(layer.get_output_at(node_index))
+            continue
+
+        inputs = layer.get_input_at(node_index)
+        new_inputs = [rebuilt[_node_key(t)][t._keras_history[2]] for t in _to_list(inputs)]
+        new_inputs = new_inputs if isinstance(inputs, list) else new_inputs[0]
+
+        if key in folds and folds[key] is None:
+            # Folded into the convolution before it
+            rebuilt[key] = rebuilt[_node_key(inputs)]
+        elif key in folds:
+            rebuilt[key] = [_fold(layer, folds[key], new_inputs)]
+        else:
+            arguments = _node_arguments(layer, node_index)
+            if isinstance(_unwrap(layer), KL.BatchNormalization):
+                arguments["training"] = False
+            rebuilt[key] = _to_list(layer(new_inputs, **arguments))
+
+    new_outputs = [rebuilt[_node_key(t)][t._keras_history[2]] for t in outputs]
+    return KM.Model(model.inputs, new_outputs, name=model.name)
+
+
+############################################################
+#  Frozen Graphs
+############################################################
+
+def export_inference_graph(model, path, keep_outputs=None, fold=True):
+    """Writes a frozen inference graph of a Keras model: a GraphDef with
+    the weights as constants, and only the ops the kept outputs need.
+
+    model: A Keras model, in the Keras session.
+    path: The file to write.
+    keep_outputs: Optional. List of bools, one per output of the model,
+        of the outputs to keep. Defaults to all of them.
+    fold: Whether to fold batch normalization layers into the convolutions
+        (see fold_batch_norms()).
+    """
+    keep_outputs = keep_outputs or [True] * len(model.outputs)
+    assert len(keep_outputs) == len(model.outputs)
+    outputs = [t for t, keep in zip(model.outputs, keep_outputs) if keep]
+    if fold:
+        outputs = fold_batch_norms(model, outputs).outputs
+
+    session = K.get_session()
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), [t.op.name for t in outputs])
+
+    # Keras only feeds the learning phase if some layer depends on it
+    learning_phase = K.learning_phase()
+    node_names = set(node.name for node in graph_def.node)
+    if not isinstance(learning_phase, tf.Tensor) or learning_phase.op.name not in node_names:
+        learning_phase = None
+
+    output_names = iter(t.name for t in outputs)
+    info = {
+        "inputs": [t.name for t in model.inputs],
+        "outputs": [next(output_names) if keep else None for keep in keep_outputs],
+        "output_names": list(model.output_names),
+        "learning_phase": learning_phase.name if learning_phase is not None else None,
+    }
+    info_node = graph_def.node.add()
+    info_node.name = GRAPH_INFO_NODE
+    info_node.op = "Const"
+    info_node.attr["dtype"].type = tf.string.as_datatype_enum
+    info_node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(json.dumps(info)))
+
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+
+class FrozenModel(object):
+    """A frozen inference graph written by export_inference_graph(), in a
+    graph and session of its own. Its predict() works like the one of the
+    Keras model, except that outputs that were not kept are None.
+    """
+
+    def __init__(self, path, session_config=None):
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+        info = json.loads(self.session.run(GRAPH_INFO_NODE + ":0").decode())
+        self.output_names = info["output_names"]
+        self.inputs = [self.graph.get_tensor_by_name(name) for name in info["inputs"]]
+        self.outputs = [self.graph.get_tensor_by_name(name) if name else None
+                        for name in info["outputs"]]
+        self.learning_phase = self.graph.get_tensor_by_name(info["learning_phase"]) \
+            if info["learning_phase"] else None
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """Runs the graph on a list of input arrays (or a single array), in
+        batches of batch_size (defaults to all at once).
+
+        Returns: The output array, or the list of output arrays (None for
+        the outputs that were not kept).
+        """
+        x = list(x) if isinstance(x, (list, tuple)) else [x]
+        assert len(x) == len(self.inputs), \
+            "Expected {} inputs, got {}".format(len(self.inputs), len(x))
+        count = len(x[0])
+        batch_size = batch_size or count
+        fetches = [t for t in self.outputs if t is not None]
+
+        batches = []
+        for start in range(0, count, batch_size):
+            feed_dict = {t: a[start:start + batch_size] for t, a in zip(self.inputs, x)}
+            if self.learning_phase is not None:
+                feed_dict[self.learning_phase] = False
+            batches.append(self.session.run(fetches, feed_dict=feed_dict))
+
+        results = iter([np.concatenate(arrays) for arrays in zip(*batches)])
+        outputs = [next(results) if t is not None else None for t in self.outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def close(self):
+        self.session.close()
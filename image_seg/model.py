@@ -12,6 +12,7 @@ import datetime
 import re
 import math
 import logging
+import functools
 from collections import OrderedDict
 import multiprocessing
 import numpy as np
@@ -24,6 +25,7 @@ import keras.engine as KE
 import keras.models as KM
 
 from image_seg import utils
+from image_seg import inference_graph
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -76,8 +78,8 @@ def compute_backbone_shapes(config, image_shape):
     if callable(config.BACKBONE):
         return config.COMPUTE_BACKBONE_SHAPE(image_shape)
 
-    # Currently supports ResNet only
-    assert config.BACKBONE in ["resnet50", "resnet101"]
+    # Registered backbones have the sizes of ResNet
+    assert config.BACKBONE in BACKBONES, "Unknown backbone {}".format(config.BACKBONE)
     return np.array(
         [[int(math.ceil(image_shape[0] / stride)),
             int(math.ceil(image_shape[1] / stride))]
@@ -205,31 +207,216 @@ def resnet_graph(input_image, architecture, stage5=False, train_bn=True):
     return [C1, C2, C3, C4, C5]
 
 
+############################################################
+#  MobileNet Graph
+############################################################
+
+# Depthwise convolutions are a layer of Keras 2.1.5 and later
+try:
+    DepthwiseConv2D = KL.DepthwiseConv2D
+except AttributeError:
+    from keras.applications.mobilenet import DepthwiseConv2D
+
+
+def relu6(x):
+    return K.relu(x, max_value=6)
+
+
+def depthwise_separable_block(input_tensor, filters, stage, block, strides=(1, 1),
+                              train_bn=True):
+    """A 3x3 depthwise convolution followed by a 1x1 pointwise convolution,
+    each with batch normalization and ReLU6 (as in MobileNet).
+    # Arguments
+        input_tensor: input tensor
+        filters: integer, the nb_filters of the pointwise conv layer
+        stage: integer, current stage label, used for generating layer names
+        block: 'a','b'..., current block label, used for generating layer names
+        strides: strides of the depthwise conv layer
+        train_bn: Boolean. Train or freeze Batch Norm layres
+    """
+    name_base = 'mobile' + str(stage) + block
+
+    x = DepthwiseConv2D((3, 3), strides=strides, padding='same', use_bias=False,
+                        name=name_base + '_dw')(input_tensor)
+    x = BatchNorm(name=name_base + '_dw_bn')(x, training=train_bn)
+    x = KL.Activation(relu6)(x)
+
+    x = KL.Conv2D(filters, (1, 1), use_bias=False, name=name_base + '_pw')(x)
+    x = BatchNorm(name=name_base + '_pw_bn')(x, training=train_bn)
+    x = KL.Activation(relu6, name=name_base + '_out')(x)
+    return x
+
+
+def mobilenet_graph(input_image, stage5=False, train_bn=True, alpha=1.0):
+    """Build a MobileNet (v1) graph, with the stages of resnet_graph(): C2 to
+    C5 have strides of 4, 8, 16 and 32. With "same" padding, stage outputs
+    are ceil(image size / stride), as compute_backbone_shapes() expects.
+        stage5: Boolean. If False, stage5 of the network is not created
+        train_bn: Boolean. Train or freeze Batch Norm layres
+        alpha: Width multiplier of the number of filters of every layer
+    """
+    def filters(n):
+        return int(n * alpha)
+
+    # Stage 1
+    x = KL.Conv2D(filters(32), (3, 3), strides=(2, 2), padding='same', use_bias=False,
+                  name='mobile1_conv')(input_image)
+    x = BatchNorm(name='mobile1_bn')(x, training=train_bn)
+    x = KL.Activation(relu6)(x)
+    C1 = x = depthwise_separable_block(x, filters(64), stage=1, block='a', train_bn=train_bn)
+    # Stage 2
+    x = depthwise_separable_block(x, filters(128), stage=2, block='a', strides=(2, 2), train_bn=train_bn)
+    C2 = x = depthwise_separable_block(x, filters(128), stage=2, block='b', train_bn=train_bn)
+    # Stage 3
+    x = depthwise_separable_block(x, filters(256), stage=3, block='a', strides=(2, 2), train_bn=train_bn)
+    C3 = x = depthwise_separable_block(x, filters(256), stage=3, block='b', train_bn=train_bn)
+    # Stage 4
+    x = depthwise_separable_block(x, filters(512), stage=4, block='a', strides=(2, 2), train_bn=train_bn)
+    for i in range(5):
+        x = depthwise_separable_block(x, filters(512), stage=4, block=chr(98 + i), train_bn=train_bn)
+    C4 = x
+    # Stage 5
+    if stage5:
+        x = depthwise_separable_block(x, filters(1024), stage=5, block='a', strides=(2, 2), train_bn=train_bn)
+        C5 = x = depthwise_separable_block(x, filters(1024), stage=5, block='b', train_bn=train_bn)
+    else:
+        C5 = None
+    return [C1, C2, C3, C4, C5]
+
+
+############################################################
+#  Backbone Registry
+############################################################
+
+# Backbones that can be selected by name with Config.BACKBONE. Each builds
+# the graph of its stages from the input image:
+#     graph_fn(input_image, stage5=False, train_bn=True) -> [C1, C2, C3, C4, C5]
+# and its stage outputs must have the sizes of compute_backbone_shapes().
+BACKBONES = {
+    "resnet50": functools.partial(resnet_graph, architecture="resnet50"),
+    "resnet101": functools.partial(resnet_graph, architecture="resnet101"),
+    "mobilenet": mobilenet_graph,
+}
+
+
+def register_backbone(name, graph_fn):
+    """Makes a backbone available as Config.BACKBONE = name.
+
+    graph_fn: function building the backbone, with the signature described
+        above BACKBONES. For example, a thinner MobileNet:
+        register_backbone("mobilenet_050", functools.partial(mobilenet_graph, alpha=0.5))
+    """
+    BACKBONES[name] = graph_fn
+
+
+############################################################
+#  Anchors Layer
+############################################################
+
+def generate_pyramid_anchors_graph(config, image_shape):
+    """Graph version of utils.generate_pyramid_anchors() followed by
+    utils.norm_boxes(), for a backbone whose feature maps have a size of
+    ceil(image size / stride) (see compute_backbone_shapes()).
+
+    image_shape: [(height, width)] int tensor of the image size in pixels
+
+    Returns:
+        [anchor_count, (y1, x1, y2, x2)] anchors in normalized coordinates,
+        in the same order (and with the same values) as get_anchors().
+    """
+    image_shape = tf.cast(image_shape, tf.int64)
+    anchors = []
+    for scale, stride in zip(config.RPN_ANCHOR_SCALES, config.BACKBONE_STRIDES):
+        # Anchor sizes don't depend on the image: [anchors_per_location, 4]
+        # offsets from the anchor centers, computed as utils.generate_anchors() does
+        scales, ratios = np.meshgrid(np.array(scale), np.array(config.RPN_ANCHOR_RATIOS))
+        heights = scales.flatten() / np.sqrt(ratios.flatten())
+        widths = scales.flatten() * np.sqrt(ratios.flatten())
+        sizes = np.stack([heights, widths], axis=1)
+        offsets = tf.constant(np.concatenate([-0.5 * sizes, 0.5 * sizes], axis=1), dtype=tf.float64)
+
+        # Anchor centers, one per cell of the (strided) feature map
+        feature_shape = (image_shape + stride - 1) // stride
+        shifts_y = tf.cast(tf.range(0, feature_shape[0], config.RPN_ANCHOR_STRIDE) * stride, tf.float64)
+        shifts_x = tf.cast(tf.range(0, feature_shape[1], config.RPN_ANCHOR_STRIDE) * stride, tf.float64)
+        shifts_x, shifts_y = tf.meshgrid(shifts_x, shifts_y)
+        centers = tf.stack([tf.reshape(shifts_y, [-1]), tf.reshape(shifts_x, [-1])], axis=1)
+        centers = tf.tile(centers, [1, 2])
+
+        # [cells, anchors_per_location, 4] -> [cells * anchors_per_location, 4]
+        anchors.append(tf.reshape(tf.expand_dims(centers, 1) + tf.expand_dims(offsets, 0), [-1, 4]))
+    anchors = tf.concat(anchors, axis=0)
+
+    # Normalize coordinates (in float64, as utils.norm_boxes() does)
+    h, w = tf.split(tf.cast(image_shape, tf.float64), 2)
+    scale = tf.concat([h, w, h, w], axis=-1) - 1.
+    shift = tf.constant([0., 0., 1., 1.], dtype=tf.float64)
+    return tf.cast((anchors - shift) / scale, tf.float32)
+
+
+class AnchorsLayer(KE.Layer):
+    """Provides the anchors of the input images inside the graph, so that
+    they don't need to be fed with every batch.
+
+    Anchors are generated from the shape of the images (see
+    generate_pyramid_anchors_graph()). Custom backbones (a callable
+    config.BACKBONE) have their own feature map sizes, so they get constant
+    anchors for config.IMAGE_SHAPE instead, and images must have that shape.
+
+    Inputs:
+        input_image: [batch, height, width, channels]
+
+    Returns:
+        Anchors in normalized coordinates [batch, anchors, (y1, x1, y2, x2)]
+    """
+
+    def __init__(self, config=None, anchors=None, **kwargs):
+        """
+        config: The model config object.
+        anchors: [anchor_count, (y1, x1, y2, x2)] constant anchors in
+            normalized coordinates. If None, they're generated in the graph.
+        """
+        super(AnchorsLayer, self).__init__(**kwargs)
+        self.config = config
+        self.anchors = anchors
+
+    def call(self, inputs):
+        if self.anchors is None:
+            anchors = generate_pyramid_anchors_graph(self.config, tf.shape(inputs)[1:3])
+        else:
+            anchors = tf.constant(self.anchors, dtype=tf.float32)
+        # Same anchors for every image of the batch
+        return tf.tile(tf.expand_dims(anchors, 0), [tf.shape(inputs)[0], 1, 1])
+
+    def compute_output_shape(self, input_shape):
+        return (None, None, 4)
+
+
 ############################################################
 #  Proposal Layer
 ############################################################
 
 def apply_box_deltas_graph(boxes, deltas):
     """Applies the given deltas to the given boxes.
-    boxes: [N, (y1, x1, y2, x2)] boxes to update
-    deltas: [N, (dy, dx, log(dh), log(dw))] refinements to apply
+    boxes: [..., N, (y1, x1, y2, x2)] boxes to update
+    deltas: [..., N, (dy, dx, log(dh), log(dw))] refinements to apply
     """
     # Convert to y, x, h, w
-    height = boxes[:, 2] - boxes[:, 0]
-    width = boxes[:, 3] - boxes[:, 1]
-    center_y = boxes[:, 0] + 0.5 * height
-    center_x = boxes[:, 1] + 0.5 * width
+    height = boxes[..., 2] - boxes[..., 0]
+    width = boxes[..., 3] - boxes[..., 1]
+    center_y = boxes[..., 0] + 0.5 * height
+    center_x = boxes[..., 1] + 0.5 * width
     # Apply deltas
-    center_y += deltas[:, 0] * height
-    center_x += deltas[:, 1] * width
-    height *= tf.exp(deltas[:, 2])
-    width *= tf.exp(deltas[:, 3])
+    center_y += deltas[..., 0] * height
+    center_x += deltas[..., 1] * width
+    height *= tf.exp(deltas[..., 2])
+    width *= tf.exp(deltas[..., 3])
     # Convert back to y1, x1, y2, x2
     y1 = center_y - 0.5 * height
     x1 = center_x - 0.5 * width
     y2 = y1 + height
     x2 = x1 + width
-    result = tf.stack([y1, x1, y2, x2], axis=1, name="apply_box_deltas_out")
+    result = tf.stack([y1, x1, y2, x2], axis=-1, name="apply_box_deltas_out")
     return result
 
 
@@ -283,38 +470,30 @@ class ProposalLayer(KE.Layer):
 
         # Improve performance by trimming to top anchors by score
         # and doing the rest on the smaller subset.
+        # The whole batch is processed at once (the graph doesn't grow with
+        # IMAGES_PER_GPU)
         pre_nms_limit = tf.minimum(6000, tf.shape(anchors)[1])
         ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
                          name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
+        scores = batch_gather_graph(scores, ix)
+        deltas = batch_gather_graph(deltas, ix)
+        pre_nms_anchors = batch_gather_graph(anchors, ix, name="pre_nms_anchors")
 
         # Apply deltas to anchors to get refined anchors.
         # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([pre_nms_anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
+        boxes = apply_box_deltas_graph(pre_nms_anchors, deltas)
 
         # Clip to image boundaries. Since we're in normalized coordinates,
         # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
-        window = np.array([0, 0, 1, 1], dtype=np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        boxes = tf.clip_by_value(boxes, 0., 1., name="refined_anchors_clipped")
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
         # for small objects, so we're skipping it.
 
-        # Non-max suppression
-        def nms(boxes, scores):
+        # Non-max suppression, padded to proposal_count for each image
+        def nms(inputs):
+            boxes, scores = inputs
             indices = tf.image.non_max_suppression(
                 boxes, scores, self.proposal_count,
                 self.nms_threshold, name="rpn_non_max_suppression")
@@ -322,9 +501,9 @@ class ProposalLayer(KE.Layer):
             # Pad if needed
             padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
             proposals = tf.pad(proposals, [(0, padding), (0, 0)])
+            proposals.set_shape([self.proposal_count, 4])
             return proposals
-        proposals = utils.batch_slice([boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+        proposals = tf.map_fn(nms, [boxes, scores], dtype=tf.float32)
         return proposals
 
     def compute_output_shape(self, input_shape):
@@ -340,6 +519,71 @@ def log2_graph(x):
     return tf.log(x) / tf.log(2.0)
 
 
+def roi_level_graph(boxes, image_meta):
+    """Assigns each ROI to a level of the feature pyramid based on its area.
+
+    boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized coordinates
+    image_meta: [batch, (meta train)] Image details. See compose_image_meta()
+
+    Returns [batch, num_boxes] int32 levels, from 2 (P2) to 5 (P5).
+    """
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=2)
+    h = y2 - y1
+    w = x2 - x1
+    # Use shape of first image. Images in a batch must have the same size.
+    image_shape = parse_image_meta_graph(image_meta)['image_shape'][0]
+    # Equation 1 in the Feature Pyramid Networks paper. Account for
+    # the fact that our coordinates are normalized here.
+    # e.g. a 224x224 ROI (in pixels) maps to P4
+    image_area = tf.cast(image_shape[0] * image_shape[1], tf.float32)
+    roi_level = log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
+    roi_level = tf.minimum(5, tf.maximum(
+        2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
+    return tf.squeeze(roi_level, 2)
+
+
+def roi_level_order_graph(roi_level):
+    """Groups the ROIs of a batch by pyramid level.
+
+    roi_level: [batch, num_boxes] levels (see roi_level_graph())
+
+    Returns:
+        level_order: [batch * num_boxes] int32 indices of the (flattened)
+            ROIs, those of P2 first, then P3, P4 and P5
+        level_counts: [4] int32 number of ROIs of each level
+    """
+    roi_level = tf.reshape(roi_level, [-1])
+    level_order = []
+    level_counts = []
+    for level in range(2, 6):
+        ix = tf.where(tf.equal(roi_level, level))[:, 0]
+        level_order.append(ix)
+        level_counts.append(tf.shape(ix)[0])
+    return tf.cast(tf.concat(level_order, axis=0), tf.int32), tf.stack(level_counts)
+
+
+class PyramidROILevels(KE.Layer):
+    """Assigns ROIs to levels of the feature pyramid. PyramidROIAlign layers
+    that pool the same ROIs (e.g. the classifier and mask heads in training)
+    can share the assignment instead of each computing it.
+
+    Inputs:
+    - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized coordinates
+    - image_meta: [batch, (meta train)] Image details. See compose_image_meta()
+
+    Output: level_order and level_counts (see roi_level_order_graph())
+    """
+
+    def call(self, inputs):
+        return list(roi_level_order_graph(roi_level_graph(inputs[0], inputs[1])))
+
+    def compute_output_shape(self, input_shape):
+        return [(None,), (4,)]
+
+    def compute_mask(self, inputs, mask=None):
+        return [None, None]
+
+
 class PyramidROIAlign(KE.Layer):
     """Implements ROI Pooling on multiple levels of the feature pyramid.
 
@@ -351,8 +595,11 @@ class PyramidROIAlign(KE.Layer):
              coordinates. Possibly padded with zeros if not enough
              boxes to fill the array.
     - image_meta: [batch, (meta train)] Image details. See compose_image_meta()
-    - Feature maps: List of feature maps from different levels of the pyramid.
-                    Each is [batch, height, width, channels]
+    - Feature maps: List of feature maps from different levels of the pyramid,
+                    [P2, P3, P4, P5]. Each is [batch, height, width, channels]
+    - Optional. level_order, level_counts: The assignment of the boxes to
+                pyramid levels, output by a PyramidROILevels layer. Computed
+                by this layer if not given.
 
     Output:
     Pooled regions in the shape: [batch, num_boxes, height, width, channels].
@@ -374,35 +621,23 @@ class PyramidROIAlign(KE.Layer):
 
         # Feature Maps. List of feature maps from different level of the
         # feature pyramid. Each is [batch, height, width, channels]
-        feature_maps = inputs[2:]
+        feature_maps = inputs[2:6]
 
         # Assign each ROI to a level in the pyramid based on the ROI area.
-        y1, x1, y2, x2 = tf.split(boxes, 4, axis=2)
-        h = y2 - y1
-        w = x2 - x1
-        # Use shape of first image. Images in a batch must have the same size.
-        image_shape = parse_image_meta_graph(image_meta)['image_shape'][0]
-        # Equation 1 in the Feature Pyramid Networks paper. Account for
-        # the fact that our coordinates are normalized here.
-        # e.g. a 224x224 ROI (in pixels) maps to P4
-        image_area = tf.cast(image_shape[0] * image_shape[1], tf.float32)
-        roi_level = log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
-        roi_level = tf.minimum(5, tf.maximum(
-            2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
-        roi_level = tf.squeeze(roi_level, 2)
+        if len(inputs) > 6:
+            level_order, level_counts = inputs[6:8]
+        else:
+            level_order, level_counts = roi_level_order_graph(roi_level_graph(boxes, image_meta))
 
         # Loop through levels and apply ROI pooling to each. P2 to P5.
+        num_boxes = tf.shape(boxes)[1]
+        flat_boxes = tf.reshape(boxes, [-1, 4])
         pooled = []
-        box_to_level = []
-        for i, level in enumerate(range(2, 6)):
-            ix = tf.where(tf.equal(roi_level, level))
-            level_boxes = tf.gather_nd(boxes, ix)
+        for i, ix in enumerate(tf.split(level_order, level_counts, num=4)):
+            level_boxes = tf.gather(flat_boxes, ix)
 
             # Box indicies for crop_and_resize.
-            box_indices = tf.cast(ix[:, 0], tf.int32)
-
-            # Keep track of which box is mapped to which level
-            box_to_level.append(ix)
+            box_indices = ix // num_boxes
 
             # Stop gradient propogation to ROI proposals
             level_boxes = tf.stop_gradient(level_boxes)
@@ -424,24 +659,13 @@ class PyramidROIAlign(KE.Layer):
         # Pack pooled features into one tensor
         pooled = tf.concat(pooled, axis=0)
 
-        # Pack box_to_level mapping into one array and add another
-        # column representing the order of pooled boxes
-        box_to_level = tf.concat(box_to_level, axis=0)
-        box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
-        box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
-                                 axis=1)
-
-        # Rearrange pooled features to match the order of the original boxes
-        # Sort box_to_level by batch then box index
-        # TF doesn't have a way to sort by two columns, so merge them and sort.
-        sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
-        ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
-            box_to_level)[0]).indices[::-1]
-        ix = tf.gather(box_to_level[:, 2], ix)
-        pooled = tf.gather(pooled, ix)
+        # Rearrange pooled features to match the order of the original boxes.
+        # Every box has exactly one level, so level_order is a permutation.
+        pooled = tf.gather(pooled, tf.invert_permutation(level_order))
 
         # Re-add the batch dimension
-        pooled = tf.expand_dims(pooled, 0)
+        shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
+        pooled = tf.reshape(pooled, shape)
         return pooled
 
     def compute_output_shape(self, input_shape):
@@ -454,18 +678,18 @@ class PyramidROIAlign(KE.Layer):
 
 def overlaps_graph(boxes1, boxes2):
     """Computes IoU overlaps between two sets of boxes.
-    boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    boxes1: [..., N, (y1, x1, y2, x2)].
+    boxes2: [..., M, (y1, x1, y2, x2)], with the same leading dimensions.
+
+    Returns [..., N, M] overlaps.
     """
-    # 1. Tile boxes2 and repeate boxes1. This allows us to compare
+    # 1. Broadcast boxes1 against boxes2. This allows us to compare
     # every boxes1 against every boxes2 without loops.
-    # TF doesn't have an equivalent to np.repeate() so simulate it
-    # using tf.tile() and tf.reshape.
-    b1 = tf.reshape(tf.tile(tf.expand_dims(boxes1, 1),
-                            [1, 1, tf.shape(boxes2)[0]]), [-1, 4])
-    b2 = tf.tile(boxes2, [tf.shape(boxes1)[0], 1])
+    b1 = tf.expand_dims(boxes1, -2)
+    b2 = tf.expand_dims(boxes2, -3)
     # 2. Compute intersections
-    b1_y1, b1_x1, b1_y2, b1_x2 = tf.split(b1, 4, axis=1)
-    b2_y1, b2_x1, b2_y2, b2_x2 = tf.split(b2, 4, axis=1)
+    b1_y1, b1_x1, b1_y2, b1_x2 = b1[..., 0], b1[..., 1], b1[..., 2], b1[..., 3]
+    b2_y1, b2_x1, b2_y2, b2_x2 = b2[..., 0], b2[..., 1], b2[..., 2], b2[..., 3]
     y1 = tf.maximum(b1_y1, b2_y1)
     x1 = tf.maximum(b1_x1, b2_x1)
     y2 = tf.minimum(b1_y2, b2_y2)
@@ -475,110 +699,154 @@ def overlaps_graph(boxes1, boxes2):
     b1_area = (b1_y2 - b1_y1) * (b1_x2 - b1_x1)
     b2_area = (b2_y2 - b2_y1) * (b2_x2 - b2_x1)
     union = b1_area + b2_area - intersection
-    # 4. Compute IoU and reshape to [boxes1, boxes2]
-    iou = intersection / union
-    overlaps = tf.reshape(iou, [tf.shape(boxes1)[0], tf.shape(boxes2)[0]])
-    return overlaps
+    # 4. Compute IoU [..., boxes1, boxes2]
+    return intersection / union
+
+
+def random_subset_graph(candidates, count):
+    """Picks random candidates in each row of a batch.
+
+    candidates: [batch, N] boolean
+    count: maximum number of candidates to pick in each row
+
+    Returns:
+        indices: [batch, min(count, N)] int32 indices of the picked
+            candidates first (in random order), then of other items
+        counts: [batch] number of picked candidates in each row
+    """
+    keys = tf.where(candidates, tf.random_uniform(tf.shape(candidates)),
+                    -tf.ones(tf.shape(candidates)))
+    count = tf.minimum(count, tf.shape(candidates)[1])
+    indices = tf.nn.top_k(keys, count, sorted=True).indices
+    counts = tf.minimum(tf.reduce_sum(tf.cast(candidates, tf.int32), axis=1), count)
+    return indices, counts
 
 
 def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config):
-    """Generates detection targets for one image. Subsamples proposals and
-    generates target class IDs, bounding box deltas, and masks for each.
+    """Generates detection targets for a batch of images. Subsamples
+    proposals and generates target class IDs, bounding box deltas, and masks
+    for each.
+
+    Images are processed together: zero padding is masked out instead of
+    removed, so the graph doesn't depend on the batch size.
 
     Inputs:
-    proposals: [N, (y1, x1, y2, x2)] in normalized coordinates. Might
+    proposals: [batch, N, (y1, x1, y2, x2)] in normalized coordinates. Might
                be zero padded if there are not enough proposals.
-    gt_class_ids: [MAX_GT_INSTANCES] int class IDs
-    gt_boxes: [MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized coordinates.
-    gt_masks: [height, width, MAX_GT_INSTANCES] of boolean type.
+    gt_class_ids: [batch, MAX_GT_INSTANCES] int class IDs
+    gt_boxes: [batch, MAX_GT_INSTANCES, (y1, x1, y2, x2)] in normalized
+              coordinates.
+    gt_masks: [batch, height, width, MAX_GT_INSTANCES] of boolean type.
 
     Returns: Target ROIs and corresponding class IDs, bounding box shifts,
     and masks.
-    rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized coordinates
-    class_ids: [TRAIN_ROIS_PER_IMAGE]. Integer class IDs. Zero padded.
-    deltas: [TRAIN_ROIS_PER_IMAGE, NUM_CLASSES, (dy, dx, log(dh), log(dw))]
+    rois: [batch, TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)] in normalized
+          coordinates
+    class_ids: [batch, TRAIN_ROIS_PER_IMAGE]. Integer class IDs. Zero padded.
+    deltas: [batch, TRAIN_ROIS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
             Class-specific bbox refinements.
-    masks: [TRAIN_ROIS_PER_IMAGE, height, width). Masks cropped to bbox
-           boundaries and resized to neural network output size.
+    masks: [batch, TRAIN_ROIS_PER_IMAGE, height, width). Masks cropped to
+           bbox boundaries and resized to neural network output size.
 
     Note: Returned arrays might be zero padded if not enough target ROIs.
     """
     # Assertions
     asserts = [
-        tf.Assert(tf.greater(tf.shape(proposals)[0], 0), [proposals],
+        tf.Assert(tf.greater(tf.shape(proposals)[1], 0), [proposals],
                   name="roi_assertion"),
     ]
     with tf.control_dependencies(asserts):
         proposals = tf.identity(proposals)
 
-    # Remove zero padding
-    proposals, _ = trim_zeros_graph(proposals, name="trim_proposals")
-    gt_boxes, non_zeros = trim_zeros_graph(gt_boxes, name="trim_gt_boxes")
-    gt_class_ids = tf.boolean_mask(gt_class_ids, non_zeros,
-                                   name="trim_gt_class_ids")
-    gt_masks = tf.gather(gt_masks, tf.where(non_zeros)[:, 0], axis=2,
-                         name="trim_gt_masks")
+    batch_size = tf.shape(proposals)[0]
+    num_proposals = tf.shape(proposals)[1]
+    num_gt = tf.shape(gt_boxes)[1]
+    roi_count = config.TRAIN_ROIS_PER_IMAGE
+
+    # Zero padding
+    valid_proposals = tf.reduce_any(tf.not_equal(proposals, 0), axis=2)
+    valid_gt = tf.reduce_any(tf.not_equal(gt_boxes, 0), axis=2)
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
-    crowd_ix = tf.where(gt_class_ids < 0)[:, 0]
-    non_crowd_ix = tf.where(gt_class_ids > 0)[:, 0]
-    crowd_boxes = tf.gather(gt_boxes, crowd_ix)
-    crowd_masks = tf.gather(gt_masks, crowd_ix, axis=2)
-    gt_class_ids = tf.gather(gt_class_ids, non_crowd_ix)
-    gt_boxes = tf.gather(gt_boxes, non_crowd_ix)
-    gt_masks = tf.gather(gt_masks, non_crowd_ix, axis=2)
-
-    # Compute overlaps matrix [proposals, gt_boxes]
+    crowd_bool = tf.logical_and(valid_gt, gt_class_ids < 0)
+    non_crowd_bool = tf.logical_and(valid_gt, gt_class_ids > 0)
+
+    # Compute overlaps matrix [batch, proposals, gt_boxes]
     overlaps = overlaps_graph(proposals, gt_boxes)
 
-    # Compute overlaps with crowd boxes [anchors, crowds]
-    crowd_overlaps = overlaps_graph(proposals, crowd_boxes)
-    crowd_iou_max = tf.reduce_max(crowd_overlaps, axis=1)
+    def for_proposals(gt_bool):
+        return tf.tile(tf.expand_dims(gt_bool, 1), [1, num_proposals, 1])
+
+    # Overlaps with crowd boxes (0 for other boxes)
+    crowd_overlaps = tf.where(for_proposals(crowd_bool), overlaps, tf.zeros_like(overlaps))
+    crowd_iou_max = tf.reduce_max(crowd_overlaps, axis=2)
     no_crowd_bool = (crowd_iou_max < 0.001)
+    # Overlaps with GT boxes (-1 for crowds and padding)
+    overlaps = tf.where(for_proposals(non_crowd_bool), overlaps, -tf.ones_like(overlaps))
 
     # Determine postive and negative ROIs
-    roi_iou_max = tf.reduce_max(overlaps, axis=1)
+    roi_iou_max = tf.reduce_max(overlaps, axis=2)
     # 1. Positive ROIs are those with >= 0.5 IoU with a GT box
-    positive_roi_bool = (roi_iou_max >= 0.5)
-    positive_indices = tf.where(positive_roi_bool)[:, 0]
+    positive_roi_bool = tf.logical_and(valid_proposals, roi_iou_max >= 0.5)
     # 2. Negative ROIs are those with < 0.5 with every GT box. Skip crowds.
-    negative_indices = tf.where(tf.logical_and(roi_iou_max < 0.5, no_crowd_bool))[:, 0]
+    negative_roi_bool = tf.logical_and(valid_proposals,
+                                       tf.logical_and(roi_iou_max < 0.5, no_crowd_bool))
 
     # Subsample ROIs. Aim for 33% positive
     # Positive ROIs
     positive_count = int(config.TRAIN_ROIS_PER_IMAGE *
                          config.ROI_POSITIVE_RATIO)
-    positive_indices = tf.random_shuffle(positive_indices)[:positive_count]
-    positive_count = tf.shape(positive_indices)[0]
+    positive_indices, positive_counts = random_subset_graph(positive_roi_bool, positive_count)
     # Negative ROIs. Add enough to maintain positive:negative ratio.
     r = 1.0 / config.ROI_POSITIVE_RATIO
-    negative_count = tf.cast(r * tf.cast(positive_count, tf.float32), tf.int32) - positive_count
-    negative_indices = tf.random_shuffle(negative_indices)[:negative_count]
-    # Gather selected ROIs
-    positive_rois = tf.gather(proposals, positive_indices)
-    negative_rois = tf.gather(proposals, negative_indices)
-
-    # Assign positive ROIs to GT boxes.
-    positive_overlaps = tf.gather(overlaps, positive_indices)
-    roi_gt_box_assignment = tf.cond(
-        tf.greater(tf.shape(positive_overlaps)[1], 0),
-        true_fn = lambda: tf.argmax(positive_overlaps, axis=1),
-        false_fn = lambda: tf.cast(tf.constant([]),tf.int64)
-    )
-    roi_gt_boxes = tf.gather(gt_boxes, roi_gt_box_assignment)
-    roi_gt_class_ids = tf.gather(gt_class_ids, roi_gt_box_assignment)
-
-    # Compute bbox refinement for positive ROIs
-    deltas = utils.box_refinement_graph(positive_rois, roi_gt_boxes)
+    negative_counts = tf.cast(r * tf.cast(positive_counts, tf.float32), tf.int32) - positive_counts
+    negative_indices, negative_available = random_subset_graph(negative_roi_bool, roi_count)
+    negative_counts = tf.minimum(negative_counts, negative_available)
+
+    # Rows of the targets: positive ROIs, then negative ROIs, then padding
+    rows = tf.expand_dims(tf.range(roi_count), 0)
+    positive_rows = rows < tf.expand_dims(positive_counts, 1)
+    valid_rows = rows < tf.expand_dims(positive_counts + negative_counts, 1)
+    positive_slots = tf.tile(tf.minimum(rows, tf.shape(positive_indices)[1] - 1), [batch_size, 1])
+    negative_slots = tf.clip_by_value(rows - tf.expand_dims(positive_counts, 1),
+                                      0, tf.shape(negative_indices)[1] - 1)
+    roi_indices = tf.where(positive_rows,
+                           batch_gather_graph(positive_indices, positive_slots),
+                           batch_gather_graph(negative_indices, negative_slots))
+    rois = batch_gather_graph(proposals, roi_indices) * tf.to_float(tf.expand_dims(valid_rows, 2))
+
+    # Assign ROIs to GT boxes (only positive ROIs keep them).
+    roi_gt_box_assignment = tf.argmax(batch_gather_graph(overlaps, roi_indices), axis=2,
+                                      output_type=tf.int32)
+    roi_gt_boxes = batch_gather_graph(gt_boxes, roi_gt_box_assignment)
+    roi_gt_class_ids = tf.where(positive_rows,
+                                batch_gather_graph(gt_class_ids, roi_gt_box_assignment),
+                                tf.zeros_like(roi_gt_box_assignment, dtype=gt_class_ids.dtype))
+
+    # Compute bbox refinement for positive ROIs. Other rows get a unit box
+    # instead of their ROI and GT box (zero padding would give inf/NaN deltas
+    # and, through tf.where, NaN gradients into the proposals).
+    positive_flat = tf.reshape(positive_rows, [-1])
+    unit_boxes = tf.zeros([batch_size * roi_count, 4]) + tf.constant([0., 0., 1., 1.])
+    safe_rois = tf.where(positive_flat, tf.reshape(rois, [-1, 4]), unit_boxes)
+    safe_gt_boxes = tf.where(positive_flat, tf.reshape(tf.to_float(roi_gt_boxes), [-1, 4]), unit_boxes)
+    deltas = utils.box_refinement_graph(safe_rois, safe_gt_boxes)
     deltas /= config.BBOX_STD_DEV
+    deltas = tf.where(positive_flat, deltas, tf.zeros_like(deltas))
+    deltas = tf.reshape(deltas, [batch_size, roi_count, 4])
 
     # Assign positive ROIs to GT masks
-    # Permute masks to [N, height, width, 1]
-    transposed_masks = tf.expand_dims(tf.transpose(gt_masks, [2, 0, 1]), -1)
-    # Pick the right mask for each ROI
-    roi_masks = tf.gather(transposed_masks, roi_gt_box_assignment)
+    # Flatten the batch: [batch * MAX_GT_INSTANCES, height, width, 1]
+    mask_shape = tf.shape(gt_masks)[1:3]
+    transposed_masks = tf.reshape(tf.transpose(gt_masks, [0, 3, 1, 2]),
+                                  tf.concat([[-1], mask_shape, [1]], axis=0))
+    # Positive rows of the flattened targets and their masks
+    positive_ix = tf.where(positive_flat)[:, 0]
+    mask_ids = tf.expand_dims(tf.range(batch_size), 1) * num_gt + roi_gt_box_assignment
+    roi_masks = tf.gather(transposed_masks, tf.gather(tf.reshape(mask_ids, [-1]), positive_ix))
+    positive_rois = tf.gather(tf.reshape(rois, [-1, 4]), positive_ix)
 
     # Compute mask targets
     boxes = positive_rois
@@ -586,7 +854,8 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
         # Transform ROI corrdinates from normalized image space
         # to normalized mini-mask space.
         y1, x1, y2, x2 = tf.split(positive_rois, 4, axis=1)
-        gt_y1, gt_x1, gt_y2, gt_x2 = tf.split(roi_gt_boxes, 4, axis=1)
+        gt_y1, gt_x1, gt_y2, gt_x2 = tf.split(
+            tf.gather(tf.reshape(roi_gt_boxes, [-1, 4]), positive_ix), 4, axis=1)
         gt_h = gt_y2 - gt_y1
         gt_w = gt_x2 - gt_x1
         y1 = (y1 - gt_y1) / gt_h
@@ -605,16 +874,10 @@ def detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks, config)
     # binary cross entropy loss.
     masks = tf.round(masks)
 
-    # Append negative ROIs and pad bbox deltas and masks that
-    # are not used for negative ROIs with zeros.
-    rois = tf.concat([positive_rois, negative_rois], axis=0)
-    N = tf.shape(negative_rois)[0]
-    P = tf.maximum(config.TRAIN_ROIS_PER_IMAGE - tf.shape(rois)[0], 0)
-    rois = tf.pad(rois, [(0, P), (0, 0)])
-    roi_gt_boxes = tf.pad(roi_gt_boxes, [(0, N + P), (0, 0)])
-    roi_gt_class_ids = tf.pad(roi_gt_class_ids, [(0, N + P)])
-    deltas = tf.pad(deltas, [(0, N + P), (0, 0)])
-    masks = tf.pad(masks, [[0, N + P], (0, 0), (0, 0)])
+    # Masks of other rows are zeros
+    masks = tf.scatter_nd(tf.expand_dims(positive_ix, 1), masks,
+                          tf.cast(tf.stack([batch_size * roi_count] + list(config.MASK_SHAPE)), tf.int64))
+    masks = tf.reshape(masks, [batch_size, roi_count] + list(config.MASK_SHAPE))
 
     return rois, roi_gt_class_ids, deltas, masks
 
@@ -656,15 +919,11 @@ class DetectionTargetLayer(KE.Layer):
         gt_boxes = inputs[2]
         gt_masks = inputs[3]
 
-        # Slice the batch and run a graph for each slice
         # TODO: Rename target_bbox to target_deltas for clarity
         names = ["rois", "target_class_ids", "target_bbox", "target_mask"]
-        outputs = utils.batch_slice(
-            [proposals, gt_class_ids, gt_boxes, gt_masks],
-            lambda w, x, y, z: detection_targets_graph(
-                w, x, y, z, self.config),
-            self.config.IMAGES_PER_GPU, names=names)
-        return outputs
+        outputs = detection_targets_graph(proposals, gt_class_ids, gt_boxes, gt_masks,
+                                          self.config)
+        return [tf.identity(o, name=n) for o, n in zip(outputs, names)]
 
     def compute_output_shape(self, input_shape):
         return [
@@ -714,6 +973,36 @@ def refine_detections_graph(rois, probs, deltas, window, config):
 
     # TODO: Filter out boxes with zero area
 
+    if config.DETECTION_BATCHED_NMS:
+        keep = class_offset_nms_graph(refined_rois, class_ids, class_scores, config)
+    else:
+        keep = per_class_nms_graph(refined_rois, class_ids, class_scores, config)
+
+    # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
+    # Coordinates are normalized.
+    detections = tf.concat([
+        tf.gather(refined_rois, keep),
+        tf.to_float(tf.gather(class_ids, keep))[..., tf.newaxis],
+        tf.gather(class_scores, keep)[..., tf.newaxis]
+        ], axis=1)
+
+    # Pad with zeros if detections < DETECTION_MAX_INSTANCES
+    gap = config.DETECTION_MAX_INSTANCES - tf.shape(detections)[0]
+    detections = tf.pad(detections, [(0, gap), (0, 0)], "CONSTANT")
+    return detections
+
+
+def per_class_nms_graph(refined_rois, class_ids, class_scores, config):
+    """Filters detections with one NMS per class (in sequence).
+
+    Inputs:
+        refined_rois: [N, (y1, x1, y2, x2)] in normalized coordinates
+        class_ids: [N] int class IDs
+        class_scores: [N] float scores of the class IDs
+
+    Returns [num_detections] int64 indices of the kept detections, sorted by
+    decreasing score. At most DETECTION_MAX_INSTANCES.
+    """
     # Filter out background boxes
     keep = tf.where(class_ids > 0)[:, 0]
     # Filter out low confidence boxes
@@ -765,20 +1054,41 @@ def refine_detections_graph(rois, probs, deltas, window, config):
     class_scores_keep = tf.gather(class_scores, keep)
     num_keep = tf.minimum(tf.shape(class_scores_keep)[0], roi_count)
     top_ids = tf.nn.top_k(class_scores_keep, k=num_keep, sorted=True)[1]
-    keep = tf.gather(keep, top_ids)
+    return tf.gather(keep, top_ids)
 
-    # Arrange output as [N, (y1, x1, y2, x2, class_id, score)]
-    # Coordinates are normalized.
-    detections = tf.concat([
-        tf.gather(refined_rois, keep),
-        tf.to_float(tf.gather(class_ids, keep))[..., tf.newaxis],
-        tf.gather(class_scores, keep)[..., tf.newaxis]
-        ], axis=1)
 
-    # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-    gap = config.DETECTION_MAX_INSTANCES - tf.shape(detections)[0]
-    detections = tf.pad(detections, [(0, gap), (0, 0)], "CONSTANT")
-    return detections
+def class_offset_nms_graph(refined_rois, class_ids, class_scores, config):
+    """Filters detections with a single NMS over all classes. Boxes of
+    each class are shifted by their class ID, so that boxes of different
+    classes never overlap. Same results as per_class_nms_graph(): NMS keeps
+    boxes by decreasing score, and a box can only suppress boxes of its
+    own class.
+
+    Inputs:
+        refined_rois: [N, (y1, x1, y2, x2)] in normalized coordinates,
+            clipped to the image window
+        class_ids: [N] int class IDs
+        class_scores: [N] float scores of the class IDs
+
+    Returns [num_detections] int64 indices of the kept detections, sorted by
+    decreasing score. At most DETECTION_MAX_INSTANCES.
+    """
+    # Filter out background and low confidence boxes
+    keep = class_ids > 0
+    if config.DETECTION_MIN_CONFIDENCE:
+        keep = tf.logical_and(keep, class_scores >= config.DETECTION_MIN_CONFIDENCE)
+    keep = tf.where(keep)[:, 0]
+
+    # Normalized boxes fit in [0, 1], so an offset of 1 per class separates them
+    pre_nms_class_ids = tf.gather(class_ids, keep)
+    offsets = tf.to_float(tf.expand_dims(pre_nms_class_ids, 1))
+    # NMS returns the kept boxes by decreasing score
+    nms_keep = tf.image.non_max_suppression(
+        tf.gather(refined_rois, keep) + offsets,
+        tf.gather(class_scores, keep),
+        max_output_size=config.DETECTION_MAX_INSTANCES,
+        iou_threshold=config.DETECTION_NMS_THRESHOLD)
+    return tf.gather(keep, nms_keep)
 
 
 class DetectionLayer(KE.Layer):
@@ -901,7 +1211,7 @@ def build_rpn_model(anchor_stride, anchors_per_location, depth):
 
 def fpn_classifier_graph(rois, feature_maps, image_meta,
                          pool_size, num_classes, train_bn=True,
-                         fc_layers_size=1024):
+                         fc_layers_size=1024, roi_levels=None):
     """Builds the computation graph of the feature pyramid network classifier
     and regressor heads.
 
@@ -914,6 +1224,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layres
     fc_layers_size: Size of the 2 FC layers
+    roi_levels: Optional. Outputs of a PyramidROILevels layer for rois.
 
     Returns:
         logits: [N, NUM_CLASSES] classifier logits (before softmax)
@@ -924,7 +1235,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     # ROI Pooling
     # Shape: [batch, num_boxes, pool_height, pool_width, channels]
     x = PyramidROIAlign([pool_size, pool_size],
-                        name="roi_align_classifier")([rois, image_meta] + feature_maps)
+                        name="roi_align_classifier")([rois, image_meta] + feature_maps + (roi_levels or []))
     # Two 1024 FC layers (implemented with Conv2D for consistency)
     x = KL.TimeDistributed(KL.Conv2D(fc_layers_size, (pool_size, pool_size), padding="valid"),
                            name="mrcnn_class_conv1")(x)
@@ -956,7 +1267,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
 
 
 def build_fpn_mask_graph(rois, feature_maps, image_meta,
-                         pool_size, num_classes, train_bn=True):
+                         pool_size, num_classes, train_bn=True, roi_levels=None):
     """Builds the computation graph of the mask head of Feature Pyramid Network.
 
     rois: [batch, num_rois, (y1, x1, y2, x2)] Proposal boxes in normalized
@@ -967,6 +1278,7 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     pool_size: The width of the square feature map generated from ROI Pooling.
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layres
+    roi_levels: Optional. Outputs of a PyramidROILevels layer for rois.
 
     Returns: Masks [batch, roi_count, height, width, num_classes]
              ROI features [batch, boxes, pool_height, pool_width, channels]
@@ -974,7 +1286,7 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     # ROI Pooling
     # Shape: [batch, boxes, pool_height, pool_width, channels]
     y = PyramidROIAlign([pool_size, pool_size],
-                        name="roi_align_mask")([rois, image_meta] + feature_maps)
+                        name="roi_align_mask")([rois, image_meta] + feature_maps + (roi_levels or []))
 
     # Conv layers
     x = KL.TimeDistributed(KL.Conv2D(256, (3, 3), padding="same"),
@@ -1212,19 +1524,39 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     bbox: [instance_count, (y1, x1, y2, x2)]
     mask: [height, width, instance_count]. The height and width are those
         of the image unless use_mini_mask is True, in which case they are
-        defined in MINI_MASK_SHAPE.
+        defined in MINI_MASK_SHAPE. If the dataset returns utils.SparseMasks
+        (or dataset.label_maps is set) and use_mini_mask is False, this is
+        utils.SparseMasks.
     """
-    # Load image and mask
+    # Load image and mask. With label maps, the instances stay in a single
+    # [height, width] plane until their boxes are known.
     image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
-    original_shape = image.shape
+    if dataset.label_maps:
+        mask, class_ids = dataset.load_label_map(image_id)
+        bbox = dataset.load_bboxes(image_id)
+    else:
+        mask, class_ids = dataset.load_mask(image_id)
+        bbox = None
+    # Images that are stored pre-resized (see train.packed_dataset) record the
+    # shape of their source image and the scale they were resized by
+    info = dataset.image_info[image_id]
+    original_shape = info.get("original_shape", image.shape)
+    original_scale = info.get("resize_scale", 1)
     image, window, scale, padding, crop = utils.resize_image(
         image,
         min_dim=config.IMAGE_MIN_DIM,
         min_scale=config.IMAGE_MIN_SCALE,
         max_dim=config.IMAGE_MAX_DIM,
         mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+    if dataset.label_maps:
+        mask = utils.resize_label_map(mask, scale, padding, crop)
+        # Stored boxes only survive padding. Otherwise, they're recomputed.
+        if bbox is not None and scale == 1 and crop is None and not augment and not augmentation:
+            bbox = bbox + np.array([padding[0][0], padding[1][0]] * 2)
+        else:
+            bbox = None
+    else:
+        mask = utils.resize_mask(mask, scale, padding, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
@@ -1232,7 +1564,7 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         logging.warning("'augment' is depricated. Use 'augmentation' instead.")
         if random.randint(0, 1):
             image = np.fliplr(image)
-            mask = np.fliplr(mask)
+            mask = mask.fliplr() if isinstance(mask, utils.SparseMasks) else np.fliplr(mask)
 
     # Augmentation
     # This requires the imgaug lib (https://github.com/aleju/imgaug)
@@ -1250,6 +1582,11 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
             """Determines which augmenters to apply to masks."""
             return augmenter.__class__.__name__ in MASK_AUGMENTERS
 
+        # imgaug needs dense masks
+        sparse = isinstance(mask, utils.SparseMasks)
+        if sparse:
+            mask = mask.to_dense()
+
         # Store shapes before augmentation to compare
         image_shape = image.shape
         mask_shape = mask.shape
@@ -1258,25 +1595,51 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         det = augmentation.to_deterministic()
         image = det.augment_image(image)
 
-        # Change mask to np.uint8 because imgaug doesn't support np.bool
-        mask = det.augment_image(mask.astype(np.uint8),
-                                 hooks=imgaug.HooksImages(activator=hook))
+        if dataset.label_maps:
+            # The uint16 label map goes through the same mask augmenters, but
+            # with nearest neighbor interpolation so that labels don't blend
+            nearest = det.deepcopy()
+            for augmenter in [nearest] + nearest.get_all_children(flat=True):
+                if hasattr(augmenter, "order"):
+                    augmenter.order = imgaug.parameters.Deterministic(0)
+            mask = nearest.augment_image(mask, hooks=imgaug.HooksImages(activator=hook))
+        else:
+            # Change mask to np.uint8 because imgaug doesn't support np.bool
+            mask = det.augment_image(mask.astype(np.uint8),
+                                     hooks=imgaug.HooksImages(activator=hook))
 
         # Verify that shapes didn't change
         assert image.shape == image_shape, "Augmentation shouldn't change image size"
         assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
-        # Change mask back to bool
-        mask = mask.astype(np.bool)
+        if not dataset.label_maps:
+            # Change mask back to bool
+            mask = mask.astype(np.bool)
+        if sparse:
+            mask = utils.SparseMasks.from_dense(mask)
+
+    if dataset.label_maps:
+        # Per-instance masks, only derived inside the box of each instance
+        if bbox is not None:
+            mask = utils.label_map_masks(mask, bbox)
+        else:
+            _, mask = utils.extract_label_map_masks(mask, len(class_ids))
 
     # Note that some boxes might be all zeros if the corresponding mask got cropped out.
     # and here is to filter them out
-    _idx = np.sum(mask, axis=(0, 1)) > 0
+    if isinstance(mask, utils.SparseMasks):
+        _idx = mask.areas() > 0
+    else:
+        _idx = np.sum(mask, axis=(0, 1)) > 0
     mask = mask[:, :, _idx]
     class_ids = class_ids[_idx]
     # Bounding boxes. Note that some boxes might be all zeros
     # if the corresponding mask got cropped out.
     # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+    if bbox is not None:
+        # The stored boxes are tight, as if extracted from the masks
+        bbox = mask.boxes
+    else:
+        bbox = utils.extract_bboxes(mask)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1291,7 +1654,7 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
     # Image meta train
     image_meta = compose_image_meta(image_id, original_shape, image.shape,
-                                    window, scale, active_class_ids)
+                                    window, original_scale * scale, active_class_ids)
 
     return image, image_meta, class_ids, bbox, mask
 
@@ -1453,13 +1816,69 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def _match_sparse_overlaps(sparse_overlaps, num_anchors, num_gt_boxes):
+    """Same as np.argmax()/np.max() along both axes of the overlaps matrix,
+    from its non-zero entries (see utils.AnchorGrid.overlaps()), as far as
+    build_rpn_targets() uses them: ties go to the lowest index, and rows or
+    columns without overlaps to index 0. anchor_iou_max is only exact where
+    it is >= 0.3 (elsewhere, it is lower than 0.3), and anchor_iou_argmax
+    where it is >= 0.3 or for the best anchor of a GT box.
+
+    Returns: anchor_iou_argmax, anchor_iou_max, gt_iou_argmax
+    """
+    anchor_ids, gt_ids, iou = sparse_overlaps
+    anchor_iou_argmax = np.zeros([num_anchors], dtype=np.int64)
+    anchor_iou_max = np.zeros([num_anchors])
+    gt_iou_argmax = np.zeros([num_gt_boxes], dtype=np.int64)
+    if not len(iou):
+        return anchor_iou_argmax, anchor_iou_max, gt_iou_argmax
+
+    def best_of_each(keys, others, values):
+        # For each key: max value, and the lowest other index with that value
+        if not len(keys):
+            return keys, others, values
+        order = np.lexsort((others, -values, keys))
+        first = order[np.r_[True, keys[order][1:] != keys[order][:-1]]]
+        return keys[first], others[first], values[first]
+
+    # Best anchor of each GT box. A (fast, stable) sort on the small GT
+    # indices groups the pairs by GT box, then segment reductions find the
+    # max IoU and the lowest anchor index reaching it.
+    order = np.argsort(gt_ids.astype(np.int16 if num_gt_boxes < 2 ** 15 else np.int64), kind="stable")
+    sorted_gt_ids, sorted_iou, sorted_anchor_ids = gt_ids[order], iou[order], anchor_ids[order]
+    starts = np.where(np.r_[True, sorted_gt_ids[1:] != sorted_gt_ids[:-1]])[0]
+    lengths = np.diff(np.r_[starts, len(order)])
+    gt_iou_max = np.maximum.reduceat(sorted_iou, starts)
+    is_max = sorted_iou == np.repeat(gt_iou_max, lengths)
+    gt_iou_argmax[sorted_gt_ids[starts]] = np.minimum.reduceat(
+        np.where(is_max, sorted_anchor_ids, num_anchors), starts)
+
+    # Best GT box of each anchor, from the few pairs that can make an anchor
+    # positive or neutral
+    strong = iou >= 0.3
+    ids, best_gt, best_iou = best_of_each(anchor_ids[strong], gt_ids[strong], iou[strong])
+    anchor_iou_argmax[ids] = best_gt
+    anchor_iou_max[ids] = best_iou
+
+    # Anchors matched to a GT box regardless of IoU need their exact argmax too
+    weak = gt_iou_argmax[anchor_iou_max[gt_iou_argmax] < 0.3]
+    if len(weak):
+        in_weak = np.isin(anchor_ids, weak)
+        ids, best_gt, _ = best_of_each(anchor_ids[in_weak], gt_ids[in_weak], iou[in_weak])
+        anchor_iou_argmax[ids] = best_gt
+
+    return anchor_iou_argmax, anchor_iou_max, gt_iou_argmax
+
+
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config, anchor_grid=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_grid: Optional. utils.AnchorGrid of the anchors. If given, only
+        the IoUs of anchors near each GT box are computed (same results).
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
@@ -1481,16 +1900,29 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
         crowd_boxes = gt_boxes[crowd_ix]
         gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
-        no_crowd_bool = (crowd_iou_max < 0.001)
+        if anchor_grid is not None:
+            crowd_anchor_ids, _, crowd_iou = anchor_grid.overlaps(crowd_boxes)
+            no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+            no_crowd_bool[crowd_anchor_ids[crowd_iou >= 0.001]] = False
+        else:
+            # Compute overlaps with crowd boxes [anchors, crowds]
+            crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+            crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+            no_crowd_bool = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    # Best GT box of each anchor and best anchor of each GT box
+    if anchor_grid is not None:
+        anchor_iou_argmax, anchor_iou_max, gt_iou_argmax = \
+            _match_sparse_overlaps(anchor_grid.overlaps(gt_boxes), anchors.shape[0], gt_boxes.shape[0])
+    else:
+        # Compute overlaps [num_anchors, num_gt_boxes]
+        overlaps = utils.compute_overlaps(anchors, gt_boxes)
+        anchor_iou_argmax = np.argmax(overlaps, axis=1)
+        anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+        gt_iou_argmax = np.argmax(overlaps, axis=0)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1502,12 +1934,9 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
@@ -1532,34 +1961,31 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     # For positive anchors, compute shift and scale needed to transform them
     # to match the corresponding GT boxes.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    # Closest gt box (it might have IoU < 0.7)
+    gt = gt_boxes[anchor_iou_argmax[ids]]
+    a = anchors[ids]
+
+    # Convert coordinates to center plus width/height.
+    # GT Box
+    gt_h = gt[:, 2] - gt[:, 0]
+    gt_w = gt[:, 3] - gt[:, 1]
+    gt_center_y = gt[:, 0] + 0.5 * gt_h
+    gt_center_x = gt[:, 1] + 0.5 * gt_w
+    # Anchor
+    a_h = a[:, 2] - a[:, 0]
+    a_w = a[:, 3] - a[:, 1]
+    a_center_y = a[:, 0] + 0.5 * a_h
+    a_center_x = a[:, 1] + 0.5 * a_w
+
+    # Compute the bbox refinement that the RPN should predict.
+    rpn_bbox[:len(ids)] = np.stack([
+        (gt_center_y - a_center_y) / a_h,
+        (gt_center_x - a_center_x) / a_w,
+        np.log(gt_h / a_h),
+        np.log(gt_w / a_w),
+    ], axis=1)
+    # Normalize
+    rpn_bbox[:len(ids)] /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
@@ -1639,7 +2065,7 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
 
 
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
-                   random_rois=0, batch_size=1, detection_targets=False):
+                   random_rois=0, batch_size=1, detection_targets=False, anchors=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1658,6 +2084,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     detection_targets: If True, generate detection targets (class IDs, bbox
         deltas, and masks). Typically for debugging or visualizations because
         in trainig detection targets are generated by DetectionTargetLayer.
+    anchors: Optional. [anchor_count, (y1, x1, y2, x2)] anchors in pixel
+        coordinates of config.IMAGE_SHAPE, to avoid computing them again.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The containtes
@@ -1684,12 +2112,14 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
-    backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    if anchors is None:
+        backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
+        anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                 config.RPN_ANCHOR_RATIOS,
+                                                 backbone_shapes,
+                                                 config.BACKBONE_STRIDES,
+                                                 config.RPN_ANCHOR_STRIDE)
+    anchor_grid = utils.AnchorGrid(anchors)
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -1714,7 +2144,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
             # RPN Targets
             rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
+                                                    gt_class_ids, gt_boxes, config,
+                                                    anchor_grid=anchor_grid)
 
             # Mask R-CNN Targets
             if random_rois:
@@ -1821,18 +2252,28 @@ class MaskRCNN:
     The actual Keras model is in the keras_model property.
     """
 
-    def __init__(self, mode, config, model_dir):
+    # Number of image shapes whose anchors are kept by get_anchors()
+    ANCHOR_CACHE_SIZE = 16
+
+    def __init__(self, mode, config, model_dir, inference_graph_path=None):
         """
         mode: Either "training" or "inference"
         config: A Sub-class of the Config class
         model_dir: Directory to save training logs and trained weights
+        inference_graph_path: Optional. A frozen inference graph written by
+            export_inference_graph() (with the same config) to load instead
+            of building the Keras model. Inference mode only.
         """
         assert mode in ['training', 'inference']
         self.mode = mode
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
-        self.keras_model = self.build(mode=mode, config=config)
+        if inference_graph_path:
+            assert mode == "inference", "Inference graphs need inference mode."
+            self.keras_model = inference_graph.FrozenModel(inference_graph_path)
+        else:
+            self.keras_model = self.build(mode=mode, config=config)
 
     def build(self, mode, config):
         """Build Mask R-CNN architecture.
@@ -1883,7 +2324,7 @@ class MaskRCNN:
                 input_gt_masks = KL.Input(
                     shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
-        elif mode == "inference":
+        elif mode == "inference" and not config.GRAPH_ANCHORS:
             # Anchors in normalized coordinates
             input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
 
@@ -1895,8 +2336,8 @@ class MaskRCNN:
             _, C2, C3, C4, C5 = config.BACKBONE(input_image, stage5=True,
                                                 train_bn=config.TRAIN_BN)
         else:
-            _, C2, C3, C4, C5 = resnet_graph(input_image, config.BACKBONE,
-                                             stage5=True, train_bn=config.TRAIN_BN)
+            _, C2, C3, C4, C5 = BACKBONES[config.BACKBONE](input_image, stage5=True,
+                                                           train_bn=config.TRAIN_BN)
         # Top-down Layers
         # TODO: add assert to verify feature map sizes match what's in config
         P5 = KL.Conv2D(config.TOP_DOWN_PYRAMID_SIZE, (1, 1), name='fpn_c5p5')(C5)
@@ -1930,6 +2371,9 @@ class MaskRCNN:
             anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
             # A hack to get around Keras's bad support for constants
             anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
+        elif config.GRAPH_ANCHORS:
+            constant_anchors = self.get_anchors(config.IMAGE_SHAPE) if callable(config.BACKBONE) else None
+            anchors = AnchorsLayer(config=config, anchors=constant_anchors, name="anchors")(input_image)
         else:
             anchors = input_anchors
 
@@ -1987,19 +2431,24 @@ class MaskRCNN:
                 DetectionTargetLayer(config, name="proposal_targets")([
                     target_rois, input_gt_class_ids, gt_boxes, input_gt_masks])
 
+            # Both heads pool the same ROIs, so they share their pyramid levels
+            roi_levels = PyramidROILevels(name="roi_levels")([rois, input_image_meta])
+
             # Network Heads
             # TODO: verify that this handles zero padded ROIs
             mrcnn_class_logits, mrcnn_class, mrcnn_bbox =\
                 fpn_classifier_graph(rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     roi_levels=roi_levels)
 
             mrcnn_mask, roi_features = build_fpn_mask_graph(rois, mrcnn_feature_maps,
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              roi_levels=roi_levels)
 
             # TODO: clean up (use tf.identify if necessary)
             output_rois = KL.Lambda(lambda x: x * 1, name="output_rois")(rois)
@@ -2050,7 +2499,10 @@ class MaskRCNN:
                                               train_bn=config.TRAIN_BN)
 
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            inputs = [input_image, input_image_meta]
+            if not config.GRAPH_ANCHORS:
+                inputs.append(input_anchors)
+            model = KM.Model(inputs,
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, roi_features, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
@@ -2129,6 +2581,26 @@ class MaskRCNN:
         # Update the log directory
         self.set_log_dir(filepath)
 
+    def export_inference_graph(self, path, roi_features=False):
+        """Writes a frozen inference graph of the model, to load with the
+        inference_graph_path argument of the constructor. Batch
+        normalization layers are folded into the convolutions before them,
+        and only the outputs that detect() uses are kept (detections and
+        mrcnn_mask, plus roi_features if requested). The others are None in
+        the outputs of the frozen model.
+
+        The graph is tied to the config it was built with (e.g. BATCH_SIZE).
+        Unless GRAPH_ANCHORS is set, the anchors are still an input.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        keras_model = self.keras_model
+        assert isinstance(keras_model, KM.Model), "The model is already frozen."
+
+        # Outputs: [detections, mrcnn_class, mrcnn_bbox, mrcnn_mask,
+        #          roi_features, rpn_rois, rpn_class, rpn_bbox]
+        keep_outputs = [True, False, False, True, roi_features, False, False, False]
+        inference_graph.export_inference_graph(keras_model, path, keep_outputs=keep_outputs)
+
     def get_imagenet_weights(self):
         """Downloads ImageNet trained weights from Keras.
         Returns path to weights file.
@@ -2297,6 +2769,10 @@ class MaskRCNN:
                     imgaug.augmenters.Fliplr(0.5),
                     imgaug.augmenters.GaussianBlur(sigma=(0.0, 5.0))
                 ])
+        use_multiprocessing: Load batches in worker processes. With fixed
+            size images ("square" or "crop" IMAGE_RESIZE_MODE), workers write
+            batches into shared memory (see batch_loader.SharedBatchLoader);
+            otherwise Keras runs a data_generator() in each worker.
         """
         assert self.mode == "training", "Create model in training mode."
 
@@ -2304,22 +2780,47 @@ class MaskRCNN:
         layer_regex = {
             # all layers but the backbone
             "heads": r"(image_seg\_.*)|(rpn\_.*)|(fpn\_.*)",
-            # From a specific Resnet stage and up
-            "3+": r"(res3.*)|(bn3.*)|(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(image_seg\_.*)|(rpn\_.*)|(fpn\_.*)",
-            "4+": r"(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(image_seg\_.*)|(rpn\_.*)|(fpn\_.*)",
-            "5+": r"(res5.*)|(bn5.*)|(image_seg\_.*)|(rpn\_.*)|(fpn\_.*)",
+            # From a specific Resnet (or MobileNet) stage and up
+            "3+": r"(res3.*)|(bn3.*)|(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(mobile[345].*)|(image_seg\_.*)|(rpn\_.*)|(fpn\_.*)",
+            "4+": r"(res4.*)|(bn4.*)|(res5.*)|(bn5.*)|(mobile[45].*)|(image_seg\_.*)|(rpn\_.*)|(fpn\_.*)",
+            "5+": r"(res5.*)|(bn5.*)|(mobile5.*)|(image_seg\_.*)|(rpn\_.*)|(fpn\_.*)",
             # All layers
             "all": ".*",
         }
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        else:
+            workers = multiprocessing.cpu_count()
+
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        from image_seg import batch_loader
+        anchors = batch_loader.generate_training_anchors(self.config)
+        shared_batches = use_multiprocessing and workers > 0 and \
+            self.config.IMAGE_RESIZE_MODE in ["square", "crop"]
+        if shared_batches:
+            train_generator = batch_loader.SharedBatchLoader(
+                train_dataset, self.config, shuffle=True, augmentation=augmentation,
+                batch_size=self.config.BATCH_SIZE, workers=workers, anchors=anchors)
+            val_generator = batch_loader.SharedBatchLoader(
+                val_dataset, self.config, shuffle=True, batch_size=self.config.BATCH_SIZE,
+                workers=max(1, workers // 4), anchors=anchors)
+            # The loaders have their own workers, and their batches must be
+            # consumed before the next one is taken
+            workers, use_multiprocessing = 0, False
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             anchors=anchors)
+            val_generator = data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE,
+                                           anchors=anchors)
 
         # Callbacks (mod: extend with extra callbacks)
         callbacks = [
@@ -2335,26 +2836,24 @@ class MaskRCNN:
         self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
-
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=use_multiprocessing
-        )
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=100,
+                workers=workers,
+                use_multiprocessing=use_multiprocessing
+            )
+        finally:
+            # Stop the loader workers, even if training failed
+            if shared_batches:
+                train_generator.close()
+                val_generator.close()
         self.epoch = max(self.epoch, epochs)
 
     def mold_inputs(self, images):
@@ -2397,7 +2896,7 @@ class MaskRCNN:
         return molded_images, image_metas, windows
 
     def unmold_detections(self, detections, mrcnn_mask, roi_features, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, box_local=False):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
@@ -2408,12 +2907,17 @@ class MaskRCNN:
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        box_local: If True, masks are returned cropped to their boxes (lists of
+                [y2 - y1, x2 - x1] arrays) instead of pasted into the full image.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks"""
+        masks: [height, width, num_instances] Instance masks
+        float_masks: [num_instances, height, width] Instance masks before thresholding
+        roi_features: [N, ...] Features of the ROIs (None if the model does
+            not output them, see export_inference_graph())"""
 
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
@@ -2425,7 +2929,8 @@ class MaskRCNN:
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
         masks = mrcnn_mask[np.arange(N), :, :, class_ids]
-        roi_features = roi_features[:N, :, :, :]
+        if roi_features is not None:
+            roi_features = roi_features[:N, :, :, :]
 
         # Translate normalized coordinates in the resized image to pixel
         # coordinates in the original image before resizing
@@ -2452,26 +2957,26 @@ class MaskRCNN:
             N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        full_masks, full_float_masks = utils.unmold_masks(masks, boxes, original_image_shape,
+                                                          box_local=box_local)
 
-        return boxes, class_ids, scores, full_masks, roi_features
+        return boxes, class_ids, scores, full_masks, full_float_masks, roi_features
 
-    def detect(self, images, verbose=0):
+    def detect(self, images, verbose=0, box_local=False, sparse_masks=False):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
+        box_local: If True, masks and mrcnn_masks are lists of masks cropped
+            to their rois instead of full image masks.
+        sparse_masks: If True, masks are returned as utils.SparseMasks (and
+            mrcnn_masks are cropped to their rois, as with box_local).
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
         masks: [H, W, N] instance binary masks
+        mrcnn_masks: [N, H, W] instance float masks
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2492,38 +2997,29 @@ class MaskRCNN:
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        model_in = self.inference_inputs(molded_images, image_metas)
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
+            if len(model_in) > 2:
+                log("anchors", model_in[2])
         # Run object detection
         detections, _, _, mrcnn_mask, roi_features, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.keras_model.predict(model_in, verbose=0)
+        if roi_features is None:
+            # Stripped from the inference graph
+            roi_features = [None] * len(images)
 
         # Process detections
         results = []
         for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_masks, final_features,\
+            final_rois, final_class_ids, final_scores, final_masks, final_float_masks, final_features,\
                 = self.unmold_detections(detections[i],
                                          mrcnn_mask[i], roi_features[i], image.shape, molded_images[i].shape,
-                                         windows[i])
-
-            full_float_masks = []
-            N = final_rois.shape[0]
-            for j in range(N):
-                y1, x1, y2, x2 = final_rois[j]
-                mask = skimage.transform.resize(mrcnn_mask[i, np.arange(N), :, :, final_class_ids][j], (y2 - y1, x2 - x1), order=1, mode="constant")
-
-                # Put the mask in the right location.
-                full_float_mask = np.zeros(image.shape[:2], dtype=np.float32)
-                full_float_mask[y1:y2, x1:x2] = mask
-                full_float_masks.append(full_float_mask)
+                                         windows[i], box_local=box_local or sparse_masks)
+            if sparse_masks:
+                final_masks = utils.SparseMasks(final_rois, final_masks, image.shape)
 
             results.append({
                 "rois": final_rois,
@@ -2531,7 +3027,7 @@ class MaskRCNN:
                 "scores": final_scores,
                 "masks": final_masks,
                 "roi_features": final_features,
-                "mrcnn_masks": np.array(full_float_masks),
+                "mrcnn_masks": final_float_masks,
             })
         return results
 
@@ -2564,25 +3060,25 @@ class MaskRCNN:
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        model_in = self.inference_inputs(molded_images, image_metas)
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
+            if len(model_in) > 2:
+                log("anchors", model_in[2])
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, _, _, mrcnn_mask, roi_features, _, _, _ =\
+            self.keras_model.predict(model_in, verbose=0)
+        if roi_features is None:
+            # Stripped from the inference graph
+            roi_features = [None] * len(molded_images)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
             window = [0, 0, image.shape[0], image.shape[1]]
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
+            final_rois, final_class_ids, final_scores, final_masks, _, _ =\
+                self.unmold_detections(detections[i], mrcnn_mask[i], roi_features[i],
                                        image.shape, molded_images[i].shape,
                                        window)
             results.append({
@@ -2593,13 +3089,36 @@ class MaskRCNN:
             })
         return results
 
+    def inference_inputs(self, molded_images, image_metas):
+        """Returns the list of inputs of the inference model for a batch of
+        molded images: the images, their metas and (unless the model
+        generates them, see Config.GRAPH_ANCHORS) their anchors.
+        """
+        image_shape = molded_images[0].shape
+        if self.config.GRAPH_ANCHORS:
+            if callable(self.config.BACKBONE):
+                assert tuple(image_shape) == tuple(self.config.IMAGE_SHAPE), \
+                    "Graph anchors of custom backbones need images of shape IMAGE_SHAPE"
+            return [molded_images, image_metas]
+
+        # Anchors
+        anchors = self.get_anchors(image_shape)
+        # Duplicate across the batch dimension because Keras requires it
+        # (Config.GRAPH_ANCHORS avoids feeding them)
+        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        return [molded_images, image_metas, anchors]
+
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
-        backbone_shapes = compute_backbone_shapes(self.config, image_shape)
-        # Cache anchors and reuse if image shape is the same
+        # Cache anchors and reuse if image shape is the same, keeping the
+        # ANCHOR_CACHE_SIZE most recently used shapes
         if not hasattr(self, "_anchor_cache"):
-            self._anchor_cache = {}
-        if not tuple(image_shape) in self._anchor_cache:
+            self._anchor_cache = OrderedDict()
+        key = tuple(image_shape)
+        if key in self._anchor_cache:
+            self._anchor_cache.move_to_end(key)
+        else:
+            backbone_shapes = compute_backbone_shapes(self.config, image_shape)
             # Generate Anchors
             a = utils.generate_pyramid_anchors(
                 self.config.RPN_ANCHOR_SCALES,
@@ -2612,8 +3131,10 @@ class MaskRCNN:
             # TODO: Remove this after the notebook are refactored to not use it
             self.anchors = a
             # Normalize coordinates
-            self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
-        return self._anchor_cache[tuple(image_shape)]
+            self._anchor_cache[key] = utils.norm_boxes(a, image_shape[:2])
+            if len(self._anchor_cache) > self.ANCHOR_CACHE_SIZE:
+                self._anchor_cache.popitem(last=False)
+        return self._anchor_cache[key]
 
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
@@ -2695,13 +3216,7 @@ class MaskRCNN:
             molded_images, image_metas, _ = self.mold_inputs(images)
         else:
             molded_images = images
-        image_shape = molded_images[0].shape
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        model_in = self.inference_inputs(molded_images, image_metas)
 
         # Run inference
         if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
@@ -2822,6 +3337,19 @@ def trim_zeros_graph(boxes, name=None):
     return boxes, non_zeros
 
 
+def batch_gather_graph(params, indices, name=None):
+    """Gathers values of each image of a batch with the indices of that image.
+
+    params: [batch, N, ...]
+    indices: [batch, K] int32 indices into the second dimension of params
+
+    Returns [batch, K, ...]
+    """
+    batch_ids = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                        [1, tf.shape(indices)[1]])
+    return tf.gather_nd(params, tf.stack([batch_ids, indices], axis=2), name=name)
+
+
 def batch_pack_graph(x, counts, num_rows):
     """Picks different number of values from each row
     in x depending on the values in counts.
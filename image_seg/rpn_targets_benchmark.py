@@ -0,0 +1,95 @@
+"""
+rpn_targets_benchmark.py
+
+Micro-benchmark of build_rpn_targets() with the dense IoU matrix (the default) against the anchor grid
+(utils.AnchorGrid) over the anchors of a configuration, for increasing numbers of GT instances. Checks that both
+produce identical rpn_match and rpn_bbox, including on images with only small objects (no anchor with an IoU of
+0.3 or more with any GT box).
+
+Run from the root directory of the project:
+    python -m image_seg.rpn_targets_benchmark
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import numpy as np
+
+from image_seg import utils
+from image_seg import model as modellib
+from image_seg.config import Config
+
+
+class BenchmarkConfig(Config):
+    NAME = "rpn_targets_benchmark"
+    NUM_CLASSES = 1 + 8
+
+
+# Numbers of GT instances per image, GT box sizes (in pixels) and runs per instance count
+instance_counts = [1, 5, 10, 20, 50, 100]
+box_size_range = (8, 256)
+timed_runs = 10
+
+# Images with only small objects, and their GT box sizes
+small_instance_counts = [1, 5]
+small_box_size_range = (4, 16)
+
+
+def random_gt(config, count, rng, size_range=box_size_range):
+    """Random GT boxes inside the image (a tenth of them crowds)."""
+    height, width = config.IMAGE_SHAPE[:2]
+    sizes = rng.randint(*size_range, size=(count, 2))
+    y1 = rng.randint(0, height - sizes[:, 0])
+    x1 = rng.randint(0, width - sizes[:, 1])
+    boxes = np.stack([y1, x1, y1 + sizes[:, 0], x1 + sizes[:, 1]], axis=1).astype(np.int32)
+    class_ids = np.where(rng.rand(count) < 0.1, -1, rng.randint(1, config.NUM_CLASSES, count)).astype(np.int32)
+    class_ids[0] = 1
+    return class_ids, boxes
+
+
+def time_targets(config, anchors, gt, anchor_grid, seed):
+    """Builds RPN targets for each GT set (with the same random state)
+    Returns:
+        average time (s) and the targets
+    """
+    targets = []
+    start = time.perf_counter()
+    for i, (class_ids, boxes) in enumerate(gt):
+        np.random.seed(seed + i)
+        targets.append(modellib.build_rpn_targets(config.IMAGE_SHAPE, anchors, class_ids, boxes, config,
+                                                  anchor_grid=anchor_grid))
+    return (time.perf_counter() - start) / len(gt), targets
+
+
+def main():
+    config = BenchmarkConfig()
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS, backbone_shapes,
+                                             config.BACKBONE_STRIDES, config.RPN_ANCHOR_STRIDE)
+
+    start = time.perf_counter()
+    anchor_grid = utils.AnchorGrid(anchors)
+    grid_time = time.perf_counter() - start
+
+    print(f"{anchors.shape[0]} anchors for {config.IMAGE_SHAPE[0]}x{config.IMAGE_SHAPE[1]} images, "
+          f"anchor grid built in {grid_time * 1000:.1f} ms")
+    print(f"{'instances':>9} {'dense (ms)':>11} {'grid (ms)':>10} {'speedup':>8} {'identical':>10}")
+
+    rng = np.random.RandomState(0)
+    cases = [(count, box_size_range) for count in instance_counts] + \
+            [(count, small_box_size_range) for count in small_instance_counts]
+    for count, size_range in cases:
+        gt = [random_gt(config, count, rng, size_range) for _ in range(timed_runs)]
+
+        dense_time, dense_targets = time_targets(config, anchors, gt, None, seed=count)
+        grid_time, grid_targets = time_targets(config, anchors, gt, anchor_grid, seed=count)
+
+        identical = all(np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1])
+                        for a, b in zip(dense_targets, grid_targets))
+        label = str(count) if size_range == box_size_range else f"{count} small"
+        print(f"{label:>9} {dense_time * 1000:>11.1f} {grid_time * 1000:>10.1f} "
+              f"{dense_time / grid_time:>7.1f}x {str(identical):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+sparse_masks_benchmark.py
+
+Micro-benchmark of resizing instance masks as utils.SparseMasks, and as a single label map (utils.resize_label_map()
+followed by utils.extract_label_map_masks(), as load_image_gt() does for datasets with label maps), against resizing
+the dense [height, width, instance_count] masks (utils.resize_mask()), over random image shapes, scales, paddings and
+crops. Checks that all of them produce identical masks (and boxes, for label maps).
+
+Run from the root directory of the project:
+    python -m image_seg.sparse_masks_benchmark
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import numpy as np
+
+from image_seg import utils
+
+
+# Image sizes (in pixels), scales, instances per image and random draws per setting
+image_size_range = (1, 160)
+scale_range = (0.2, 3.)
+instance_counts = [1, 10, 50]
+draws = 300
+
+
+def random_masks(count, rng):
+    """Random instance masks, each with a random box and random pixels inside it
+    Returns:
+        dense masks [height, width, count]
+    """
+    height, width = rng.randint(*image_size_range, size=2)
+    masks = np.zeros((height, width, count), dtype=bool)
+    for i in range(count):
+        y1, x1 = rng.randint(0, height), rng.randint(0, width)
+        y2, x2 = rng.randint(y1 + 1, height + 1), rng.randint(x1 + 1, width + 1)
+        masks[y1:y2, x1:x2, i] = rng.rand(y2 - y1, x2 - x1) < 0.7
+    return masks
+
+
+def random_label_map(count, rng):
+    """Random instances painted over each other in a label map (as load_label_map() returns)
+    Returns:
+        label map [height, width] and the dense masks of its instances [height, width, count]
+    """
+    masks = random_masks(count, rng)
+    label_map = np.zeros(masks.shape[:2], dtype=np.uint16)
+    for i in range(count):
+        label_map[masks[..., i]] = i + 1
+    return label_map, label_map[..., np.newaxis] == np.arange(1, count + 1)
+
+
+def random_resize(masks, rng):
+    """Random scale, and either a random padding or a random crop of the resized masks
+    Returns:
+        scale, padding and crop (or None), as returned by utils.resize_image()
+    """
+    scale = rng.uniform(*scale_range)
+    height, width = (int(round(n * scale)) for n in masks.shape[:2])
+    if rng.rand() < 0.5 or min(height, width) < 2:
+        padding = [tuple(rng.randint(0, 8, size=2)), tuple(rng.randint(0, 8, size=2)), (0, 0)]
+        return scale, padding, None
+    h, w = rng.randint(1, height), rng.randint(1, width)
+    crop = (rng.randint(0, height - h), rng.randint(0, width - w), h, w)
+    return scale, [(0, 0), (0, 0), (0, 0)], crop
+
+
+def main():
+    print(f"{'instances':>9} {'dense (ms)':>11} {'sparse (ms)':>12} {'speedup':>8} {'identical':>10}")
+
+    rng = np.random.RandomState(0)
+    for count in instance_counts:
+        cases = []
+        for _ in range(draws):
+            masks = random_masks(count, rng)
+            cases.append((masks, utils.SparseMasks.from_dense(masks)) + random_resize(masks, rng))
+
+        start = time.perf_counter()
+        dense = [utils.resize_mask(masks, scale, padding, crop) for masks, _, scale, padding, crop in cases]
+        dense_time = (time.perf_counter() - start) / draws
+
+        start = time.perf_counter()
+        sparse = [utils.resize_mask(sparse, scale, padding, crop) for _, sparse, scale, padding, crop in cases]
+        sparse_time = (time.perf_counter() - start) / draws
+
+        identical = all(a.shape == b.shape and np.array_equal(a, b.to_dense()) for a, b in zip(dense, sparse))
+        print(f"{count:>9} {dense_time * 1000:>11.2f} {sparse_time * 1000:>12.2f} "
+              f"{dense_time / sparse_time:>7.1f}x {str(identical):>10}")
+
+    print()
+    print(f"{'instances':>9} {'dense (ms)':>11} {'label map (ms)':>15} {'speedup':>8} {'identical':>10}")
+
+    for count in instance_counts:
+        cases = []
+        for _ in range(draws):
+            label_map, masks = random_label_map(count, rng)
+            cases.append((masks, label_map) + random_resize(masks, rng))
+
+        start = time.perf_counter()
+        dense = []
+        for masks, _, scale, padding, crop in cases:
+            masks = utils.resize_mask(masks, scale, padding, crop)
+            dense.append((utils.extract_bboxes(masks), masks))
+        dense_time = (time.perf_counter() - start) / draws
+
+        start = time.perf_counter()
+        from_label_map = [utils.extract_label_map_masks(utils.resize_label_map(label_map, scale, padding, crop), count)
+                          for _, label_map, scale, padding, crop in cases]
+        label_map_time = (time.perf_counter() - start) / draws
+
+        identical = all(np.array_equal(a_boxes, b_boxes) and a.shape == b.shape and np.array_equal(a, b.to_dense())
+                        for (a_boxes, a), (b_boxes, b) in zip(dense, from_label_map))
+        print(f"{count:>9} {dense_time * 1000:>11.2f} {label_map_time * 1000:>15.2f} "
+              f"{dense_time / label_map_time:>7.1f}x {str(identical):>10}")
+
+
+if __name__ == '__main__':
+    main()
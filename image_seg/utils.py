@@ -74,6 +74,8 @@ def extract_bboxes(mask):
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
+    if isinstance(mask, SparseMasks):
+        return mask.extract_bboxes()
     boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
     for i in range(mask.shape[-1]):
         m = mask[:, :, i]
@@ -136,12 +138,16 @@ def compute_overlaps(boxes1, boxes2):
 
 def compute_overlaps_masks(masks1, masks2):
     '''Computes IoU overlaps between two sets of masks.
-    masks1, masks2: [Height, Width, instances]
+    masks1, masks2: [Height, Width, instances], either dense or SparseMasks
     '''
     
     # If either set of masks is empty return empty result
     if masks1.shape[0] == 0 or masks2.shape[0] == 0:
         return np.zeros((masks1.shape[0], masks2.shape[-1]))
+    if isinstance(masks1, SparseMasks) or isinstance(masks2, SparseMasks):
+        return _compute_overlaps_sparse_masks(*(
+            m if isinstance(m, SparseMasks) else SparseMasks.from_dense(m > .5)
+            for m in (masks1, masks2)))
     # flatten masks and compute their areas
     masks1 = np.reshape(masks1 > .5, (-1, masks1.shape[-1])).astype(np.float32)
     masks2 = np.reshape(masks2 > .5, (-1, masks2.shape[-1])).astype(np.float32)
@@ -156,6 +162,28 @@ def compute_overlaps_masks(masks1, masks2):
     return overlaps
 
 
+def _compute_overlaps_sparse_masks(masks1, masks2):
+    """Computes IoU overlaps between two sets of SparseMasks. Intersections
+    are only counted inside the intersections of their boxes.
+    """
+    area1, area2 = masks1.areas(), masks2.areas()
+    boxes1, boxes2 = masks1.boxes, masks2.boxes
+
+    intersections = np.zeros((len(masks1), len(masks2)))
+    y1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    x1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    y2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    x2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    for i, j in zip(*np.where((y2 > y1) & (x2 > x1))):
+        box = (y1[i, j], x1[i, j], y2[i, j], x2[i, j])
+        intersections[i, j] = np.count_nonzero(masks1.crop(i, box) & masks2.crop(j, box))
+
+    union = area1[:, None] + area2[None, :] - intersections
+    overlaps = intersections / np.maximum(union, 1)
+
+    return overlaps
+
+
 def non_max_suppression(boxes, scores, threshold):
     """Performs non-maximum supression and returns indicies of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
@@ -289,6 +317,11 @@ class Dataset(object):
     See COCODataset and ShapesDataset as examples.
     """
 
+    # Datasets that support it return SparseMasks from load_mask() when set
+    sparse_masks = False
+    # When set, load_image_gt() works on load_label_map() instead of load_mask()
+    label_maps = False
+
     def __init__(self, class_map=None):
         self._image_ids = []
         self.image_info = []
@@ -317,6 +350,10 @@ class Dataset(object):
             "path": path,
         }
         image_info.update(kwargs)
+        # Columnar or viewed image info (e.g. train.manifest.Manifest) can't
+        # grow, so it goes back to a list of dicts first.
+        if not isinstance(self.image_info, list):
+            self.image_info = [dict(info) for info in self.image_info]
         self.image_info.append(image_info)
 
     def image_reference(self, image_id):
@@ -349,8 +386,13 @@ class Dataset(object):
         # Mapping from source class and image IDs to internal IDs
         self.class_from_source_map = {"{}.{}".format(info['source'], info['id']): id
                                       for info, id in zip(self.class_info, self.class_ids)}
-        self.image_from_source_map = {"{}.{}".format(info['source'], info['id']): id
-                                      for info, id in zip(self.image_info, self.image_ids)}
+        if hasattr(self.image_info, 'source_keys'):
+            # Columnar image info (e.g. a train.manifest.Manifest)
+            self.image_from_source_map = dict(zip(self.image_info.source_keys().tolist(),
+                                                  self.image_ids.tolist()))
+        else:
+            self.image_from_source_map = {"{}.{}".format(info['source'], info['id']): id
+                                          for info, id in zip(self.image_info, self.image_ids)}
 
         # Map sources to class_ids they support
         self.sources = list(set([i['source'] for i in self.class_info]))
@@ -422,7 +464,8 @@ class Dataset(object):
 
         Returns:
             masks: A bool array of shape [height, width, instance count] with
-                a binary mask per instance.
+                a binary mask per instance (or SparseMasks, if the dataset
+                supports them and sparse_masks is set).
             class_ids: a 1D array of class IDs of the instance masks.
         """
         # Override this function to load a mask from your dataset.
@@ -431,6 +474,31 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_label_map(self, image_id):
+        """Load the instances of the given image as a single label map.
+
+        Override this method if the dataset stores instance ID maps, so that
+        ground truth doesn't have to be exploded into one mask per instance.
+        By default, it's built from load_mask().
+
+        Returns:
+            label_map: A uint16 array of shape [height, width]. 0 is
+                background and i + 1 is the i-th instance.
+            class_ids: a 1D array of class IDs of the instances.
+        """
+        mask, class_ids = self.load_mask(image_id)
+        return label_map_from_masks(np.asarray(mask)), class_ids
+
+    def load_bboxes(self, image_id):
+        """Returns the bounding boxes [instance_count, (y1, x1, y2, x2)] of
+        the instances of load_label_map(), if the dataset stores them.
+
+        Override this method if the boxes are precomputed, so that they
+        don't have to be searched for in the label map. By default, it
+        returns None and the boxes are computed.
+        """
+        return None
+
 
 def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
     """Resizes an image keeping the aspect ratio unchanged.
@@ -549,6 +617,8 @@ def resize_mask(mask, scale, padding, crop=None):
     padding: Padding to add to the mask in the form
             [(top, bottom), (left, right), (0, 0)]
     """
+    if isinstance(mask, SparseMasks):
+        return mask.resize(scale, padding, crop)
     # Suppress warning from scipy 0.13.0, the output shape of zoom() is
     # calculated with round() instead of int()
     with warnings.catch_warnings():
@@ -570,10 +640,13 @@ def minimize_mask(bbox, mask, mini_shape):
     """
     mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
     for i in range(mask.shape[-1]):
-        # Pick slice and cast to bool in case load_mask() returned wrong dtype
-        m = mask[:, :, i].astype(bool)
         y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
+        if isinstance(mask, SparseMasks):
+            m = mask.crop(i, (y1, x1, y2, x2))
+        else:
+            # Pick slice and cast to bool in case load_mask() returned wrong dtype
+            m = mask[:, :, i].astype(bool)
+            m = m[y1:y2, x1:x2]
         if m.size == 0:
             raise Exception("Invalid bounding box with area of zero")
         # Resize with bilinear interpolation
@@ -600,6 +673,244 @@ def expand_mask(bbox, mini_mask, image_shape):
     return mask
 
 
+############################################################
+#  Sparse Masks
+############################################################
+
+class SparseMasks(object):
+    """Compact container for the instance masks of one image. Each mask is
+    stored as a bitmap cropped to a box, together with the position of that
+    box in the image, so memory grows with the area of the instances instead
+    of with height x width x instance count.
+
+    It stands in for a dense [height, width, instance_count] bool mask where
+    the rest of the code expects one (shape, dtype, indexing the last axis and
+    np.asarray()). The dense mask is only materialized on demand.
+
+    boxes: [instance_count, (y1, x1, y2, x2)] position of each bitmap.
+    bitmaps: List of instance_count bool arrays of size [y2 - y1, x2 - x1].
+    image_shape: [height, width] of the image.
+    """
+
+    dtype = np.dtype(np.bool_)
+
+    def __init__(self, boxes, bitmaps, image_shape):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.bitmaps = [np.asarray(b, dtype=bool) for b in bitmaps]
+        self.image_shape = tuple(image_shape[:2])
+        assert len(self.bitmaps) == self.boxes.shape[0], "Need one box per bitmap"
+
+    @classmethod
+    def from_dense(cls, mask):
+        """Builds sparse masks from a dense [height, width, instance_count] mask."""
+        boxes = extract_bboxes(mask)
+        bitmaps = [mask[y1:y2, x1:x2, i] for i, (y1, x1, y2, x2) in enumerate(boxes)]
+        return cls(boxes, bitmaps, mask.shape[:2])
+
+    @classmethod
+    def from_label_map(cls, label_map, instance_ids):
+        """Builds sparse masks from a map of instance IDs, without creating a
+        full size plane per instance.
+        label_map: [height, width] integer instance IDs.
+        instance_ids: [instance_count] IDs of the instances to extract.
+        """
+        values, inverse = np.unique(label_map, return_inverse=True)
+        inverse = inverse.reshape(label_map.shape)
+        # A single pass over the map finds the box of every ID
+        slices = scipy.ndimage.find_objects(inverse + 1)
+
+        boxes, bitmaps = [], []
+        for instance_id in instance_ids:
+            k = np.searchsorted(values, instance_id)
+            if k < len(values) and values[k] == instance_id:
+                ys, xs = slices[k]
+                boxes.append([ys.start, xs.start, ys.stop, xs.stop])
+                bitmaps.append(inverse[ys, xs] == k)
+            else:
+                boxes.append([0, 0, 0, 0])
+                bitmaps.append(np.zeros((0, 0), dtype=bool))
+        return cls(boxes, bitmaps, label_map.shape)
+
+    @property
+    def shape(self):
+        return self.image_shape + (len(self.bitmaps),)
+
+    def __len__(self):
+        return len(self.bitmaps)
+
+    def __getitem__(self, index):
+        """Selects instances, the same way as indexing the last axis of a
+        dense mask (e.g. masks[..., ids] or masks[:, :, ids]). A single
+        instance is returned as a dense [height, width] mask.
+        """
+        if isinstance(index, tuple):
+            assert all(i is Ellipsis or i == slice(None) for i in index[:-1]),\
+                "Only the instance axis can be indexed"
+            index = index[-1]
+        ids = np.arange(len(self.bitmaps))[index]
+        if np.ndim(ids) == 0:
+            return self.crop(ids, (0, 0) + self.image_shape)
+        return SparseMasks(self.boxes[ids], [self.bitmaps[i] for i in ids], self.image_shape)
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.to_dense()
+        return mask if dtype is None else mask.astype(dtype)
+
+    def to_dense(self):
+        """Returns the dense [height, width, instance_count] bool mask."""
+        mask = np.zeros(self.shape, dtype=bool)
+        for i, ((y1, x1, y2, x2), bitmap) in enumerate(zip(self.boxes, self.bitmaps)):
+            mask[y1:y2, x1:x2, i] = bitmap
+        return mask
+
+    def crop(self, i, box):
+        """Returns the dense mask of instance i inside the given box
+        [y1, x1, y2, x2] of the image.
+        """
+        y1, x1, y2, x2 = box
+        by1, bx1, by2, bx2 = self.boxes[i]
+        m = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        iy1, ix1, iy2, ix2 = max(y1, by1), max(x1, bx1), min(y2, by2), min(x2, bx2)
+        if iy1 < iy2 and ix1 < ix2:
+            m[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] = \
+                self.bitmaps[i][iy1 - by1:iy2 - by1, ix1 - bx1:ix2 - bx1]
+        return m
+
+    def areas(self):
+        """Returns the number of pixels of each instance [instance_count]."""
+        return np.array([np.count_nonzero(b) for b in self.bitmaps], dtype=np.int64)
+
+    def extract_bboxes(self):
+        """Same as extract_bboxes(), from the bitmaps only."""
+        boxes = np.zeros([len(self.bitmaps), 4], dtype=np.int32)
+        for i, ((y1, x1, _, _), bitmap) in enumerate(zip(self.boxes, self.bitmaps)):
+            horizontal_indices = np.where(np.any(bitmap, axis=0))[0]
+            vertical_indices = np.where(np.any(bitmap, axis=1))[0]
+            if horizontal_indices.shape[0]:
+                boxes[i] = [y1 + vertical_indices[0], x1 + horizontal_indices[0],
+                            y1 + vertical_indices[-1] + 1, x1 + horizontal_indices[-1] + 1]
+        return boxes
+
+    def fliplr(self):
+        """Flips the masks left/right (like np.fliplr() on a dense mask)."""
+        width = self.image_shape[1]
+        boxes = self.boxes.copy()
+        boxes[:, 1], boxes[:, 3] = width - self.boxes[:, 3], width - self.boxes[:, 1]
+        return SparseMasks(boxes, [b[:, ::-1] for b in self.bitmaps], self.image_shape)
+
+    def resize(self, scale, padding, crop=None):
+        """Same as resize_mask(), but only resizes the bitmaps."""
+        # zoom() picks the nearest input pixel for each output pixel,
+        # independently on each axis, so zooming the pixel indices of each
+        # axis gives the mapping a zoom of the dense mask would use.
+        # Rounding can map edge pixels just outside of the input, where the
+        # dense zoom returns 0: these are marked -1 (leading) or n (trailing)
+        # so that they fall outside of every box and the indices stay sorted.
+        def source_indices(n):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                indices = np.round(scipy.ndimage.zoom(np.arange(n, dtype=np.float64), scale,
+                                                      order=0, cval=-1)).astype(np.int64)
+            trailing = np.arange(len(indices)) >= len(indices) / 2
+            return np.where(indices >= 0, indices, np.where(trailing, n, -1))
+
+        rows, cols = (source_indices(n) for n in self.image_shape)
+
+        boxes, bitmaps = [], []
+        for (y1, x1, y2, x2), bitmap in zip(self.boxes, self.bitmaps):
+            oy1, oy2 = np.searchsorted(rows, [y1, y2])
+            ox1, ox2 = np.searchsorted(cols, [x1, x2])
+            boxes.append([oy1, ox1, oy2, ox2])
+            bitmaps.append(bitmap[rows[oy1:oy2] - y1][:, cols[ox1:ox2] - x1])
+        boxes = np.array(boxes, dtype=np.int32).reshape(-1, 4)
+
+        if crop is not None:
+            y, x, h, w = crop
+            boxes -= np.array([y, x, y, x], dtype=np.int32)
+            clipped = np.clip(boxes, 0, [h, w, h, w]).astype(np.int32)
+            # Masks cropped out entirely end up with empty boxes
+            clipped[np.any(clipped[:, 2:] <= clipped[:, :2], axis=1)] = 0
+            bitmaps = [b[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1] if cy2 > cy1
+                       else np.zeros((0, 0), dtype=bool)
+                       for b, (y1, x1, _, _), (cy1, cx1, cy2, cx2) in zip(bitmaps, boxes, clipped)]
+            return SparseMasks(clipped, bitmaps, (h, w))
+
+        (top, bottom), (left, right) = padding[:2]
+        boxes += np.array([top, left, top, left], dtype=np.int32)
+        image_shape = (len(rows) + top + bottom, len(cols) + left + right)
+        return SparseMasks(boxes, bitmaps, image_shape)
+
+
+############################################################
+#  Label Maps
+############################################################
+
+def compact_label_map(raw_map, background_ids=(0,)):
+    """Relabels a map of (arbitrary) instance IDs to consecutive labels, so
+    it can be carried through resizing and augmentation as a single plane.
+    raw_map: [height, width] integer instance IDs, as stored by the dataset.
+    background_ids: IDs in raw_map that aren't instances.
+
+    Returns:
+    label_map: [height, width] uint16. 0 is background and i + 1 is the
+        i-th instance.
+    instance_ids: [instance_count] raw ID of each instance, sorted.
+    """
+    values, inverse = np.unique(raw_map, return_inverse=True)
+    is_instance = ~np.isin(values, background_ids)
+    # Background maps to 0, instances to 1..instance_count
+    labels = np.where(is_instance, np.cumsum(is_instance), 0).astype(np.uint16)
+    label_map = labels[inverse].reshape(raw_map.shape)
+    return label_map, values[is_instance]
+
+
+def label_map_from_masks(mask):
+    """Builds a label map from dense [height, width, instance_count] masks
+    (for datasets that don't provide one). Where masks overlap, the last
+    instance wins.
+    """
+    label_map = np.zeros(mask.shape[:2], dtype=np.uint16)
+    for i in range(mask.shape[-1]):
+        label_map[mask[:, :, i].astype(bool)] = i + 1
+    return label_map
+
+
+def resize_label_map(label_map, scale, padding, crop=None):
+    """Same as resize_mask(), for a [height, width] label map. Nearest
+    neighbor zooming keeps labels intact.
+    """
+    return resize_mask(label_map[:, :, np.newaxis], scale, padding, crop)[:, :, 0]
+
+
+def extract_label_map_masks(label_map, instance_count):
+    """Computes the bounding boxes and masks of instances 1..instance_count
+    of a label map. Each mask is only derived inside its box.
+
+    Returns:
+    bbox: [instance_count, (y1, x1, y2, x2)]. Zeros for instances that
+        aren't in the map (e.g. that were cropped out).
+    masks: SparseMasks of the instances.
+    """
+    boxes = np.zeros([instance_count, 4], dtype=np.int32)
+    slices = scipy.ndimage.find_objects(label_map.astype(np.int32), max_label=instance_count)
+    for i, window in enumerate(slices):
+        if window is not None:
+            ys, xs = window
+            boxes[i] = [ys.start, xs.start, ys.stop, xs.stop]
+    return boxes, label_map_masks(label_map, boxes)
+
+
+def label_map_masks(label_map, boxes):
+    """Same as extract_label_map_masks(), for instances whose bounding boxes
+    [instance_count, (y1, x1, y2, x2)] are already known.
+
+    Returns: SparseMasks of the instances.
+    """
+    boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+    bitmaps = [label_map[y1:y2, x1:x2] == i + 1 for i, (y1, x1, y2, x2) in enumerate(boxes)]
+    return SparseMasks(boxes, bitmaps, label_map.shape)
+
+
 # TODO: Build and use this function to reduce code duplication
 def mold_mask(mask, config):
     pass
@@ -615,7 +926,10 @@ def unmold_mask(mask, bbox, image_shape):
     """
     threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = skimage.transform.resize(mask, (y2 - y1, x2 - x1), order=1, mode="constant")
+    # Without anti-aliasing, boxes smaller than the mask are plain bilinear
+    # samples too (which is what unmold_masks() computes)
+    mask = skimage.transform.resize(mask, (y2 - y1, x2 - x1), order=1, mode="constant",
+                                    anti_aliasing=False)
     mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
 
     # Put the mask in the right location.
@@ -624,6 +938,73 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def _resize_weights(in_size, lengths, out_size):
+    """Builds the (bilinear) interpolation weights that resize a row or
+    column of in_size values to lengths[i] values, for each box i at once.
+    lengths: [N] size of each box along the axis.
+    out_size: size of the output axis (at least max(lengths)).
+
+    Returns [N, out_size, in_size] weights. Rows past the length of a box are 0.
+    """
+    rel = np.arange(out_size)[np.newaxis]
+    inside = rel < lengths[:, np.newaxis]
+    coords = (rel + 0.5) * in_size / np.maximum(lengths[:, np.newaxis], 1) - 0.5
+    i0 = np.floor(coords).astype(np.int32)
+    frac = (coords - i0).astype(np.float32)
+    i0 = np.clip(i0, -1, in_size - 1)
+
+    # Like mode="constant" in skimage.transform.resize, samples past the
+    # edges of the mask are 0 (so their weights are dropped)
+    n, y = np.indices(i0.shape)
+    weights = np.zeros(i0.shape + (in_size + 2,), dtype=np.float32)
+    weights[n, y, i0 + 2] = frac * inside
+    weights[n, y, i0 + 1] += (1 - frac) * inside
+    return weights[..., 1:-1]
+
+
+def unmold_masks(masks, boxes, image_shape, threshold=0.5, box_local=False):
+    """Converts all the masks generated by the neural network for one image
+    to a format similar to their original shape, at once (batched version of
+    unmold_mask(), i.e. bilinear resizing without anti-aliasing).
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    threshold: Value above which a mask pixel is set in the binary masks.
+    box_local: If True, the masks are returned cropped to their boxes instead
+        of pasted into the full image.
+
+    Returns binary masks [H, W, N] (bool) and float masks [N, H, W] (float32)
+    with the size of the original image, or, if box_local, two lists of N
+    [y2 - y1, x2 - x1] crops (bool and float32).
+    """
+    masks = np.asarray(masks, dtype=np.float32)
+    boxes = np.asarray(boxes).astype(np.int32).reshape(-1, 4)
+    N = boxes.shape[0]
+    heights, widths = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+
+    # Resize every mask to the size of its box with one pair of batched
+    # matrix products (bilinear interpolation is separable), on a canvas as
+    # large as the largest box.
+    if N > 0:
+        row_weights = _resize_weights(masks.shape[1], heights, max(heights.max(), 0))
+        col_weights = _resize_weights(masks.shape[2], widths, max(widths.max(), 0))
+        crops = np.matmul(np.matmul(row_weights, masks), col_weights.transpose(0, 2, 1))
+    else:
+        crops = np.empty((0, 0, 0), dtype=np.float32)
+
+    if box_local:
+        float_masks = [crops[i, :heights[i], :widths[i]] for i in range(N)]
+        return [m >= threshold for m in float_masks], float_masks
+
+    # Put the masks in the right location.
+    full_masks = np.zeros(tuple(image_shape[:2]) + (N,), dtype=np.bool_)
+    full_float_masks = np.zeros((N,) + tuple(image_shape[:2]), dtype=np.float32)
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        crop = crops[i, :y2 - y1, :x2 - x1]
+        full_float_masks[i, y1:y2, x1:x2] = crop
+        full_masks[y1:y2, x1:x2, i] = crop >= threshold
+    return full_masks, full_float_masks
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -687,6 +1068,116 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+def _ranges(starts, lengths):
+    """Concatenates the integer ranges [start, start + length) into one array."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = lengths.sum()
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(total, dtype=np.int64)
+
+
+class AnchorGrid(object):
+    """Spatial index over anchors, to find the anchors overlapping a set of
+    boxes without computing the IoU of every anchor with every box.
+
+    Anchors are grouped by size (one group per scale and ratio of each
+    pyramid level). Within a group, the anchor centers are bucketed into a
+    grid whose cells are as large as the anchors, so that a box can only
+    overlap anchors whose center is in the cells around it. Build it once
+    for a set of anchors and reuse it for every image.
+
+    anchors: [anchor_count, (y1, x1, y2, x2)]
+    """
+
+    def __init__(self, anchors):
+        self.anchors = anchors
+        self.area = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
+        # Contiguous coordinates, for fast gathers
+        self.y1, self.x1, self.y2, self.x2 = [np.ascontiguousarray(c) for c in anchors.T]
+
+        sizes = np.round(np.stack([anchors[:, 2] - anchors[:, 0],
+                                   anchors[:, 3] - anchors[:, 1]], axis=1), 3)
+        _, group_of = np.unique(sizes, axis=0, return_inverse=True)
+        group_of = group_of.reshape(-1)
+
+        self.groups = []
+        for g in range(group_of.max() + 1 if len(anchors) else 0):
+            ids = np.where(group_of == g)[0]
+            boxes = anchors[ids]
+            # Half extent of the anchors (with some slack for rounding)
+            half = 0.5 * np.max(boxes[:, 2:] - boxes[:, :2], axis=0) + 1e-3
+            cell = np.maximum(2 * half, 1)
+            centers = 0.5 * (boxes[:, :2] + boxes[:, 2:])
+            origin = np.floor(centers.min(axis=0) / cell)
+            cells = (np.floor(centers / cell) - origin).astype(np.int64)
+            grid_shape = cells.max(axis=0) + 1
+            keys = cells[:, 0] * grid_shape[1] + cells[:, 1]
+            order = np.argsort(keys, kind="stable")
+            # CSR layout: anchors of cell k are ids[order[starts[k]:starts[k + 1]]]
+            starts = np.searchsorted(keys[order], np.arange(grid_shape[0] * grid_shape[1] + 1))
+            self.groups.append({"ids": ids[order], "half": half, "cell": cell, "origin": origin,
+                                "shape": grid_shape, "starts": starts})
+
+    def candidates(self, boxes):
+        """Finds the anchors that may overlap each box.
+        boxes: [N, (y1, x1, y2, x2)]
+
+        Returns: (anchor_ids, box_ids) of the candidate pairs. Every pair of
+        an anchor and a box that intersect is included.
+        """
+        anchor_ids, box_ids = [], []
+        for group in self.groups:
+            half, cell, origin, (rows, cols) = group["half"], group["cell"], group["origin"], group["shape"]
+            # Range of cells the center of an overlapping anchor can be in
+            lo = np.floor((boxes[:, :2] - half) / cell) - origin
+            hi = np.floor((boxes[:, 2:] + half) / cell) - origin
+            lo = np.maximum(lo, 0).astype(np.int64)
+            hi = np.minimum(hi, [rows - 1, cols - 1]).astype(np.int64)
+            valid = np.all(hi >= lo, axis=1)
+            if not np.any(valid):
+                continue
+            b = np.where(valid)[0]
+            lo, hi = lo[valid], hi[valid]
+
+            # One contiguous run of cells (and of anchors) per row of each box
+            row_counts = hi[:, 0] - lo[:, 0] + 1
+            run_box = np.repeat(b, row_counts)
+            run_row = _ranges(lo[:, 0], row_counts)
+            run_lo = np.repeat(lo[:, 1], row_counts)
+            run_hi = np.repeat(hi[:, 1], row_counts)
+            first = group["starts"][run_row * cols + run_lo]
+            last = group["starts"][run_row * cols + run_hi + 1]
+
+            positions = _ranges(first, last - first)
+            anchor_ids.append(group["ids"][positions])
+            box_ids.append(np.repeat(run_box, last - first))
+
+        if not anchor_ids:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        return np.concatenate(anchor_ids), np.concatenate(box_ids)
+
+    def overlaps(self, boxes):
+        """Computes the IoU of the anchors with the boxes that overlap them,
+        with the same arithmetic as compute_overlaps().
+        boxes: [N, (y1, x1, y2, x2)]
+
+        Returns: (anchor_ids, box_ids, iou) of the pairs with a positive IoU.
+        """
+        anchor_ids, box_ids = self.candidates(boxes)
+        box_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+        y1 = np.maximum(boxes[:, 0].take(box_ids), self.y1.take(anchor_ids))
+        y2 = np.minimum(boxes[:, 2].take(box_ids), self.y2.take(anchor_ids))
+        x1 = np.maximum(boxes[:, 1].take(box_ids), self.x1.take(anchor_ids))
+        x2 = np.minimum(boxes[:, 3].take(box_ids), self.x2.take(anchor_ids))
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = box_area.take(box_ids) + self.area.take(anchor_ids) - intersection
+        iou = intersection / union
+
+        keep = iou > 0
+        return anchor_ids[keep], box_ids[keep], iou[keep]
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -3,6 +3,7 @@ from keras.callbacks import TensorBoard, CSVLogger, ModelCheckpoint, ReduceLROnP
 from keras.layers import Input, Conv2D, MaxPooling2D, Conv2DTranspose, Concatenate, BatchNormalization, TimeDistributed
 from keras.models import Model
 from keras.optimizers import Adam
+from keras.utils import Sequence
 from os import path
 import math
 import numpy as np
@@ -12,7 +13,8 @@ import tensorflow.keras.backend as K
 
 from typing import Union, Iterable
 
-from opt_flow.opt_flow import OpticalFlowNetwork
+from image_seg.inference_graph import FrozenModel, export_inference_graph
+from opt_flow.opt_flow import OpticalFlowNetwork, CachedOpticalFlow
 
 __all__ = ['MaskRefineSubnet']
 
@@ -139,6 +141,33 @@ def compute_mask_binary_cross_entropy_loss(y_true, y_pred):
     return np.sum(binary_crossentropy) / np.sum(y_true)
 
 
+def roi_windows(rois, frame_shape, margin=32):
+    """
+    Computes the crop window around each instance for ROI-cropped refinement:
+    its bounding box grown by a margin, with sides snapped up to multiples of 64
+    (as the U-Net requires) and shifted to lie within the frame.
+
+    Args:
+        rois: bounding boxes of the instances [n, (y1, x1, y2, x2)]
+        frame_shape: (h, w) of the frame, both multiples of 64 (e.g. after pad64)
+        margin: context (in pixels) kept around each bounding box
+
+    Returns:
+        crop windows [n, (y1, x1, y2, x2)], as integers
+    """
+    rois = np.asarray(rois, dtype=np.int64).reshape(-1, 4)
+    frame_size = np.array(frame_shape[:2], dtype=np.int64)
+
+    start = rois[:, :2] - margin
+    size = np.minimum(np.ceil((rois[:, 2:] + margin - start) / 64).astype(np.int64) * 64, frame_size)
+
+    # keep the window centered on the box, then move it back inside the frame
+    start -= (size - (rois[:, 2:] + margin - start)) // 2
+    start = np.clip(start, 0, frame_size - size)
+
+    return np.concatenate([start, start + size], axis=1)
+
+
 # TODO check tensor data types (and ranges)
 class MaskRefineSubnet:
     """
@@ -146,8 +175,18 @@ class MaskRefineSubnet:
     this subnet does not handle running the optical flow network.)
     """
 
-    def __init__(self, optical_flow_model: OpticalFlowNetwork):
-        self._build_model()
+    def __init__(self, optical_flow_model: OpticalFlowNetwork, inference_graph_path=None):
+        """
+        Args:
+            optical_flow_model: optical flow network for training inputs
+            inference_graph_path: optional frozen inference graph (written by
+                export_inference_graph()) to load instead of building the
+                U-Net, for inference only
+        """
+        if inference_graph_path:
+            self._model = FrozenModel(inference_graph_path)
+        else:
+            self._build_model()
 
         self.optical_flow_model = optical_flow_model
 
@@ -226,16 +265,32 @@ class MaskRefineSubnet:
         if weights_path:
             self._model.load_weights(weights_path)
 
-    def train(self, train_generator, val_generator, epochs=30, steps_per_epoch=500, val_steps_per_epoch=100):
+    def export_inference_graph(self, path):
+        """
+        Writes a frozen inference graph of the U-Net, with the batch
+        normalizations folded into the convolutions before them (see
+        image_seg.inference_graph). Loading it with inference_graph_path is
+        faster than building the U-Net and loading its weights.
+
+        Args:
+            path: path with filename of the graph
+        """
+        export_inference_graph(self._model, path)
+
+    def train(self, train_generator, val_generator, epochs=30, steps_per_epoch=500, val_steps_per_epoch=100,
+              flow_cache_dir=None):
         """
         Trains the U-Net using inputs and ground truth from the given generators.
         
         Args:
-            train_generator: generate training inputs
-            val_generator: generate input pairs for validation
+            train_generator: generate training inputs (or a Sequence of complete
+                samples, e.g. a train.refine_loader.PairedLoader)
+            val_generator: generate input pairs for validation (or a Sequence)
             epochs: number of epochs to train
             steps_per_epoch: number of image pairs + masks per epoch for training
             val_steps_per_epoch: number of image pairs + mask per epoch for validation
+            flow_cache_dir: if given, flow fields are cached on disk in this
+                directory (and reused across epochs and training sessions)
 
         Returns: Keras history object
         
@@ -244,24 +299,38 @@ class MaskRefineSubnet:
         current image:      [1, h, w, 3]
         masks:              [n, h, w, 1]
         ground-truth masks: [n, h, w, 1]
+        flow field:         [1, h, w, 2] (optional, e.g. from a flow store;
+                            computed with the optical flow model if missing)
         """
 
+        optical_flow_model = self.optical_flow_model
+        if flow_cache_dir is not None and optical_flow_model is not None:
+            optical_flow_model = CachedOpticalFlow(optical_flow_model, cache_dir=flow_cache_dir)
+
         # define a wrapper generator that applies optical flow to some of the
         # inputs and creates a new input stack and ground truth
         def with_optical_flow(gen):
             while True:
-                prev_img, curr_img, mask_tensor, gt_tensor = next(gen)
+                prev_img, curr_img, mask_tensor, gt_tensor, *flow_field = next(gen)
         
-                check_rank(prev_img, curr_img, mask_tensor, gt_tensor, c_rank=4)
+                check_rank(prev_img, curr_img, mask_tensor, gt_tensor, *flow_field, c_rank=4)
         
                 # pad everything to multiples of 64
                 prev_img, curr_img, mask_tensor, gt_tensor = map(pad64, (prev_img, curr_img, mask_tensor, gt_tensor))
         
-                # generate flow field and build new input stack
-                img_stack = np.concatenate((prev_img, curr_img), axis=-1)
-                flow_field = np.expand_dims(self.optical_flow_model.infer_from_image_stack(img_stack[0, ...]), axis=0)
+                if flow_field:
+                    # precomputed flow field
+                    flow_field = pad64(flow_field[0])
+                else:
+                    # generate flow field and build new input stack
+                    img_stack = np.concatenate((prev_img, curr_img), axis=-1)
+                    flow_field = np.expand_dims(optical_flow_model.infer_from_image_stack(img_stack[0, ...]), axis=0)
                 
                 yield [curr_img, mask_tensor, flow_field], gt_tensor
+
+        def with_inputs(gen):
+            # sequences already produce padded inputs with their flow fields
+            return gen if isinstance(gen, Sequence) else with_optical_flow(gen)
         
         # create the log directory for this training session
         date_and_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -291,8 +360,8 @@ class MaskRefineSubnet:
         ]
 
         history = self._model.fit_generator(
-            with_optical_flow(train_generator),
-            validation_data=with_optical_flow(val_generator),
+            with_inputs(train_generator),
+            validation_data=with_inputs(val_generator),
             steps_per_epoch=steps_per_epoch,
             validation_steps=val_steps_per_epoch,
             epochs=epochs,
@@ -321,6 +390,81 @@ class MaskRefineSubnet:
 
         return self._model.predict(inputs, batch_size=1)
 
+    def predict_instances(self, image, masks, flow_field, max_batch_pixels=4 * 512 * 896):
+        """
+        Run inference for every instance mask of a single frame. The image and
+        flow field are shared by all the instances, so they are broadcast (not
+        copied) over the mask stack, and the instances are refined in as few
+        forward passes as fit in the memory budget.
+
+        Args:
+            image: image of the frame [1, h, w, 3]
+            masks: coarse masks of all the instances in the frame [n, h, w, 1]
+            flow_field: flow field into the frame [1, h, w, 2]
+            max_batch_pixels: memory budget of a forward pass, as the total
+                number of pixels over the instances in a batch (at least one
+                instance is refined per pass)
+
+        Returns:
+            refined masks of shape [n, h, w, 1]
+        """
+
+        check_rank(image, masks, flow_field, c_rank=4)
+
+        n, h, w = masks.shape[:3]
+        if n == 0:
+            return np.empty((0, h, w, 1), dtype=np.float32)
+
+        batch_size = int(np.clip(max_batch_pixels // (h * w), 1, n))
+
+        # keras slices each batch out of the inputs, so only a batch is ever copied
+        image = np.broadcast_to(image, (n,) + image.shape[1:])
+        flow_field = np.broadcast_to(flow_field, (n,) + flow_field.shape[1:])
+
+        return self._model.predict([image, masks, flow_field], batch_size=batch_size)
+
+    def predict_instances_in_rois(self, image, masks, flow_field, rois, margin=32, max_batch_pixels=4 * 512 * 896):
+        """
+        Run inference for every instance mask of a single frame, but only over a
+        crop around each instance (see roi_windows()) instead of the whole frame.
+        Instances whose crops have the same size are refined together, and each
+        refined crop is pasted back into an otherwise empty full-frame mask.
+
+        Args:
+            image: image of the frame [1, h, w, 3] (h and w multiples of 64)
+            masks: coarse masks of all the instances in the frame [n, h, w, 1]
+            flow_field: flow field into the frame [1, h, w, 2]
+            rois: bounding boxes of the instances in the frame (e.g. the 'rois'
+                of Mask R-CNN, offset by any padding) [n, (y1, x1, y2, x2)]
+            margin: context (in pixels) kept around each bounding box
+            max_batch_pixels: memory budget of a forward pass (see
+                predict_instances())
+
+        Returns:
+            refined masks of shape [n, h, w, 1]
+        """
+
+        check_rank(image, masks, flow_field, c_rank=4)
+
+        n, h, w = masks.shape[:3]
+        windows = roi_windows(rois, (h, w), margin=margin)
+        sizes = windows[:, 2:] - windows[:, :2]
+
+        refined_masks = np.zeros((n, h, w, 1), dtype=np.float32)
+        for size in np.unique(sizes, axis=0):
+            ids = np.flatnonzero(np.all(sizes == size, axis=1))
+            crops = [tuple(slice(y1, y2) for y1, y2 in zip(windows[i, :2], windows[i, 2:])) for i in ids]
+
+            batch = [np.stack([t[0][crop] for crop in crops]) for t in (image, flow_field)]
+            mask_batch = np.stack([masks[i][crop] for i, crop in zip(ids, crops)])
+            batch_size = int(np.clip(max_batch_pixels // np.prod(size), 1, len(ids)))
+
+            refined_crops = self._model.predict([batch[0], mask_batch, batch[1]], batch_size=batch_size)
+            for i, crop, refined_crop in zip(ids, crops, refined_crops):
+                refined_masks[i][crop] = refined_crop
+
+        return refined_masks
+
     def evaluate(self, *inputs_and_outputs):
         check_rank(*inputs_and_outputs, c_rank=4)
         
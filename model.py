@@ -6,21 +6,65 @@ from keras.backend import tf
 import keras.layers as kl
 import keras.models as km
 import numpy as np
-from typing import List, Iterable, Optional
+import queue
+import threading
+from typing import List, Iterable, Iterator, Optional
 
 import image_seg.model as imgseg
 import mask_refine.mask_refine as mr
 import opt_flow.opt_flow as of
 
 
+# pipeline markers (passed down the stage queues)
+_END = object()
+_STOPPED = object()
+
+
+class _StageFailure(object):
+    """Carries an exception raised inside a pipeline stage down to the consumer."""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Blocking put that gives up once the pipeline has been stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """Blocking get that returns _STOPPED once the pipeline has been stopped."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+    return _STOPPED
+
+
+def _is_terminal(item) -> bool:
+    return item is _END or item is _STOPPED or isinstance(item, _StageFailure)
+
+
 class MultiSeg(object):
     
-    def __init__(self, mode: str, image_size: Iterable[2], mrcnn_config, log_dir='./logs/'):
+    def __init__(self, mode: str, image_size: Iterable[2], mrcnn_config, log_dir='./logs/', refine_in_rois=False):
         if mode not in ['training', 'inference']:
             raise ValueError('MultiSeg mode must either be \'training\' or \'inference\'')
         
         self._mode = mode
         self.image_size = image_size
+
+        # refine each instance over a crop around its box instead of the whole frame
+        self.refine_in_rois = refine_in_rois
         
         if mode == 'training':
             self._model = self._build_model(image_size, mrcnn_config, log_dir)
@@ -29,10 +73,13 @@ class MultiSeg(object):
         
     def _build_model(self, image_size, mrcnn_config, log_dir: str) -> Optional[km.Model]:
         if self.mode == 'inference':
-            self.optical_flow = of.TensorFlowPWCNet(image_size)
+            self.optical_flow = of.TensorFlowPWCNet(image_size, video_mode=True)
             self.image_seg = imgseg.MaskRCNN(mode=self.mode, config=mrcnn_config, model_dir=log_dir)
             self.mask_refine = mr.MaskRefineSubnet(self.optical_flow)
             
+            # worker threads of the streaming pipeline must run in this graph
+            self._graph = tf.get_default_graph()
+
         if self.mode == 'training':
             prev_image = kl.Input((None, None, 3), )
             curr_image = kl.Input((None, None, 3), )
@@ -49,6 +96,39 @@ class MultiSeg(object):
             
             return model
 
+    def _refine_masks(self, image: np.ndarray, flow_field: np.ndarray, coarse_masks: np.ndarray,
+                      rois: np.ndarray = None) -> np.ndarray:
+        """
+        Refines every coarse instance mask of a frame with the mask refine U-Net.
+
+        Args:
+            image: current image [h, w, 3]
+            flow_field: flow field from the previous to the current image [h, w, 2]
+            coarse_masks: instance masks from the image segmentation module [h, w, n]
+            rois: bounding boxes of the instances [n, (y1, x1, y2, x2)] (only used
+                when refining in ROIs)
+
+        Returns:
+            refined (soft) masks [h, w, n]
+        """
+        h, w = image.shape[:2]
+
+        # the u-net needs multiples of 64, so pad (centered) and crop back after
+        image, flow_field = (mr.pad64(np.expand_dims(t, axis=0)) for t in (image, flow_field))
+        top, left = (image.shape[1] - h) // 2, (image.shape[2] - w) // 2
+
+        # input masks are on the same 0-255 scale the u-net was trained on
+        masks = np.moveaxis(255 * coarse_masks.astype(np.float32), -1, 0)[..., np.newaxis]
+        if self.refine_in_rois and rois is not None:
+            rois = rois + np.array([top, left, top, left])
+            refined_masks = self.mask_refine.predict_instances_in_rois(image, mr.pad64(masks), flow_field, rois)
+        else:
+            refined_masks = self.mask_refine.predict_instances(image, mr.pad64(masks), flow_field)
+
+        refined_masks = np.moveaxis(refined_masks[:, top:top + h, left:left + w, 0], 0, -1)
+
+        return refined_masks
+
     def predict_on_single_input(self, prev_image: np.ndarray, curr_image: np.ndarray) -> np.ndarray:
         if self.mode != 'inference':
             raise ValueError('create the model in inference mode')
@@ -59,11 +139,133 @@ class MultiSeg(object):
         mrcnn_output = self.image_seg.detect([curr_image])[0]
         coarse_masks = mrcnn_output['masks']
         
+        refined_masks = self._refine_masks(curr_image, flow_field, coarse_masks, mrcnn_output['rois'])
         
         return refined_masks
     
-    def predict(self, prev_imgs: List[np.ndarray], curr_imgs: List[np.ndarray]) -> List[np.ndarray]:
-        pass
+    def predict(self, frames: Iterable[np.ndarray], buffer_size: int = 2) -> Iterator[np.ndarray]:
+        """
+        Runs the whole module over a stream of video frames, yielding the refined
+        masks of each frame as soon as they are ready.
+
+        Decoding (pulling from the frame iterable), optical flow, detection and
+        mask refinement each run in their own thread, connected by queues that
+        hold at most buffer_size frames. The stages overlap, so the frame rate on
+        long videos is set by the slowest stage instead of the sum of all of them.
+        Each frame is handed to the flow stage once, where its feature pyramid is
+        kept (on the device) as the previous image of the next pair, so frames are
+        neither copied again nor encoded twice.
+
+        Args:
+            frames: iterable of images [h, w, 3], e.g. a lazy video decoder
+            buffer_size: maximum number of frames queued between two stages
+
+        Returns:
+            generator of refined masks [h, w, n], one per frame (the first frame
+            has no previous image, so it is refined with a zero flow field)
+        """
+        if self.mode != 'inference':
+            raise ValueError('create the model in inference mode')
+
+        stop = threading.Event()
+        flow_in, detect_in, flow_out, detect_out, refine_out = (queue.Queue(maxsize=buffer_size) for _ in range(5))
+
+        def decode():
+            try:
+                for frame in frames:
+                    if not (_put(flow_in, frame, stop) and _put(detect_in, frame, stop)):
+                        return
+                item = _END
+            except Exception as e:
+                item = _StageFailure(e)
+
+            _put(flow_in, item, stop)
+            _put(detect_in, item, stop)
+
+        def flow():
+            self.optical_flow.reset_video()
+            while True:
+                curr_image = _get(flow_in, stop)
+                if _is_terminal(curr_image):
+                    _put(flow_out, curr_image, stop)
+                    return
+
+                try:
+                    # the previous frame's feature pyramid is cached by the flow network
+                    flow_field = self.optical_flow.infer_from_next_frame(curr_image)
+                    if flow_field is None:
+                        flow_field = np.zeros(curr_image.shape[:2] + (2,), dtype=np.float32)
+                except Exception as e:
+                    _put(flow_out, _StageFailure(e), stop)
+                    return
+
+                if not _put(flow_out, (curr_image, flow_field), stop):
+                    return
+
+        def detect():
+            while True:
+                image = _get(detect_in, stop)
+                if _is_terminal(image):
+                    _put(detect_out, image, stop)
+                    return
+
+                try:
+                    mrcnn_output = self.image_seg.detect([image])[0]
+                except Exception as e:
+                    _put(detect_out, _StageFailure(e), stop)
+                    return
+
+                if not _put(detect_out, (mrcnn_output['masks'], mrcnn_output['rois']), stop):
+                    return
+
+        def refine():
+            while True:
+                flow_item = _get(flow_out, stop)
+                detect_item = _get(detect_out, stop)
+
+                # report failures first, whichever stage they come from
+                for item in (flow_item, detect_item):
+                    if _is_terminal(item) and item is not _END:
+                        _put(refine_out, item, stop)
+                        return
+                if _is_terminal(flow_item) or _is_terminal(detect_item):
+                    _put(refine_out, _END, stop)
+                    return
+
+                try:
+                    refined_masks = self._refine_masks(*flow_item, *detect_item)
+                except Exception as e:
+                    _put(refine_out, _StageFailure(e), stop)
+                    return
+
+                if not _put(refine_out, refined_masks, stop):
+                    return
+
+        def in_graph(target):
+            def run():
+                with self._graph.as_default():
+                    target()
+            return run
+
+        workers = [threading.Thread(target=in_graph(target), daemon=True)
+                   for target in (decode, flow, detect, refine)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            while True:
+                item = _get(refine_out, stop)
+                if isinstance(item, _StageFailure):
+                    raise item.error
+                if _is_terminal(item):
+                    return
+
+                yield item
+        finally:
+            # also reached when the caller abandons the generator early
+            stop.set()
+            for worker in workers:
+                worker.join()
 
     @property
     def mode(self):
@@ -38,3 +38,27 @@ def cost_volume(c1, warp, search_range, name):
     cost_vol = tf.nn.leaky_relu(cost_vol, alpha=0.1, name=name)
 
     return cost_vol
+
+
+def cost_volume_patches(c1, warp, search_range, name):
+    """Build the same cost volume as cost_volume(), but with a single batched patch extraction op instead of a loop of
+    (2*search_range+1)**2 slices, products and means (and their concat), which keeps the graph small and fast to build.
+    Note that the extracted patches take (2*search_range+1)**2 times the memory of the warped level.
+    Args:
+        c1: Level of the feature pyramid of Image1
+        warp: Warped level of the feature pyramid of image22
+        search_range: Search range (maximum displacement)
+    """
+    padded_lvl = tf.pad(warp, [[0, 0], [search_range, search_range], [search_range, search_range], [0, 0]])
+    b, h, w, c = tf.unstack(tf.shape(c1))
+    max_offset = search_range * 2 + 1
+
+    # Patches are flattened in (y, x, channel) order, which matches the order of the displacements in cost_volume()
+    patches = tf.extract_image_patches(padded_lvl, ksizes=[1, max_offset, max_offset, 1], strides=[1, 1, 1, 1],
+                                       rates=[1, 1, 1, 1], padding='VALID')
+    patches = tf.reshape(patches, [b, h, w, max_offset ** 2, c])
+    cost_vol = tf.reduce_mean(patches * tf.expand_dims(c1, axis=3), axis=4)
+    cost_vol.set_shape([None, None, None, max_offset ** 2])
+    cost_vol = tf.nn.leaky_relu(cost_vol, alpha=0.1, name=name)
+
+    return cost_vol
@@ -0,0 +1,92 @@
+"""
+costvol_benchmark.py
+
+Micro-benchmark of the cost volume implementations (see 'cost_volume' in the model options). For each level of the
+feature pyramid, compares graph construction time, number of ops in the graph and inference latency of the loop-based
+cost_volume() against the patch-based cost_volume_patches(), and checks that both agree.
+
+Run from the root directory of the project:
+    python -m opt_flow.costvol_benchmark [--device /device:GPU:0]
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from opt_flow.core_costvol import cost_volume, cost_volume_patches
+from opt_flow.model_pwcnet import _PYR_NUM_CHANN
+
+# Size of the (padded) input images, pyramid levels to benchmark and search range of the cost volume
+img_size = (512, 896)
+pyr_lvls = [2, 3, 4, 5, 6]
+search_range = 4
+warmup_runs, timed_runs = 3, 20
+
+_IMPLS = {'loop': cost_volume, 'patches': cost_volume_patches}
+
+
+def benchmark_level(impl, lvl, c1, warp, device):
+    """Build the cost volume of one pyramid level in a fresh graph and time it
+    Args:
+        impl: name of the cost volume implementation
+        lvl: index of the pyramid level
+        c1, warp: features of the level in [1, H, W, C] format
+        device: device to run the cost volume on
+    Returns:
+        graph construction time (s), number of ops, average latency (s) and the cost volume itself
+    """
+    graph = tf.Graph()
+    with graph.as_default(), tf.device(device):
+        c1_tnsr = tf.placeholder(tf.float32, [1, None, None, c1.shape[3]], 'c1')
+        warp_tnsr = tf.placeholder(tf.float32, [1, None, None, c1.shape[3]], 'warp')
+
+        start = time.perf_counter()
+        cost_vol_tnsr = _IMPLS[impl](c1_tnsr, warp_tnsr, search_range, f'corr{lvl}')
+        build_time = time.perf_counter() - start
+        num_ops = len(graph.get_operations())
+
+    config = tf.ConfigProto(allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    with tf.Session(graph=graph, config=config) as sess:
+        feed_dict = {c1_tnsr: c1, warp_tnsr: warp}
+        for _ in range(warmup_runs):
+            cost_vol = sess.run(cost_vol_tnsr, feed_dict=feed_dict)
+
+        start = time.perf_counter()
+        for _ in range(timed_runs):
+            sess.run(cost_vol_tnsr, feed_dict=feed_dict)
+        latency = (time.perf_counter() - start) / timed_runs
+
+    return build_time, num_ops, latency, cost_vol
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost volume micro-benchmark")
+    parser.add_argument('--device', default='/device:CPU:0',
+                        help="device to run the benchmark on (e.g. '/device:GPU:0')")
+    device = parser.parse_args().device
+
+    print(f"Cost volumes for {img_size[0]}x{img_size[1]} images, search range {search_range}, on {device}")
+    print(f"{'lvl':>3} {'size':>12} {'impl':>8} {'build (ms)':>11} {'ops':>6} {'latency (ms)':>13} {'max diff':>9}")
+
+    for lvl in pyr_lvls:
+        shape = (1, img_size[0] // 2**lvl, img_size[1] // 2**lvl, _PYR_NUM_CHANN[lvl])
+        c1 = np.random.randn(*shape).astype(np.float32)
+        warp = np.random.randn(*shape).astype(np.float32)
+
+        ref = None
+        for impl in _IMPLS:
+            build_time, num_ops, latency, cost_vol = benchmark_level(impl, lvl, c1, warp, device)
+            if ref is None:
+                ref = cost_vol
+            max_diff = np.max(np.abs(cost_vol - ref))
+            print(f"{lvl:>3} {f'{shape[1]}x{shape[2]}x{shape[3]}':>12} {impl:>8} {build_time * 1000:>11.1f} "
+                  f"{num_ops:>6} {latency * 1000:>13.2f} {max_diff:>9.2e}")
+
+
+if __name__ == '__main__':
+    main()
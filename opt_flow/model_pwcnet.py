@@ -13,6 +13,7 @@ import time
 import datetime
 import warnings
 import numpy as np
+from collections import OrderedDict
 import pandas as pd
 import tensorflow as tf
 from tqdm import trange
@@ -24,11 +25,14 @@ from opt_flow.losses import pwcnet_loss
 from opt_flow.logger import OptFlowTBLogger
 from opt_flow.multi_gpus import assign_to_device, average_gradients
 from opt_flow.core_warp import dense_image_warp
-from opt_flow.core_costvol import cost_volume
+from opt_flow.core_costvol import cost_volume, cost_volume_patches
 from opt_flow.utils import tf_where
 
 _DEBUG_USE_REF_IMPL = False
 
+# Number of feature channels at each level of the feature pyramid (1-based)
+_PYR_NUM_CHANN = [None, 16, 32, 64, 96, 128, 196]
+
 # Default options
 _DEFAULT_PWCNET_TRAIN_OPTIONS = {
     'verbose': False,
@@ -81,6 +85,7 @@ _DEFAULT_PWCNET_TRAIN_OPTIONS = {
     'pyr_lvls': 6,  # number of feature levels in the flow pyramid
     'flow_pred_lvl': 2,  # which level to upsample to generate the final optical flow prediction
     'search_range': 4,  # cost volume search range
+    'cost_volume': 'loop',  # cost volume implementation, in ['loop', 'patches'] (see core_costvol.py)
     # if True, use model with dense connections (4705064 params w/o, 9374274 params with (no residual conn.))
     'use_dense_cx': False,
     # if True, use model with residual connections (4705064 params w/o, 6774064 params with (+2069000) (no dense conn.))
@@ -137,6 +142,7 @@ _DEFAULT_PWCNET_FINETUNE_OPTIONS = {
     'pyr_lvls': 6,  # number of feature levels in the flow pyramid
     'flow_pred_lvl': 2,  # which level to upsample to generate the final optical flow prediction
     'search_range': 4,  # cost volume search range
+    'cost_volume': 'loop',  # cost volume implementation, in ['loop', 'patches'] (see core_costvol.py)
     # if True, use model with dense connections (4705064 params w/o, 9374274 params with (no residual conn.))
     'use_dense_cx': False,
     # if True, use model with residual connections (4705064 params w/o, 6774064 params with (+2069000) (no dense conn.))
@@ -165,6 +171,7 @@ _DEFAULT_PWCNET_VAL_OPTIONS = {
     'pyr_lvls': 6,  # number of feature levels in the flow pyramid
     'flow_pred_lvl': 2,  # which level to upsample to generate the final optical flow prediction
     'search_range': 4,  # cost volume search range
+    'cost_volume': 'loop',  # cost volume implementation, in ['loop', 'patches'] (see core_costvol.py)
     # if True, use model with dense connections (4705064 params w/o, 9374274 params with (no residual conn.))
     'use_dense_cx': False,
     # if True, use model with residual connections (4705064 params w/o, 6774064 params with (+2069000) (no dense conn.))
@@ -187,10 +194,12 @@ _DEFAULT_PWCNET_TEST_OPTIONS = {
     'batch_size': 1,
     'use_tf_data': True,  # Set to True to get data from tf.data.Dataset; otherwise, use feed_dict with numpy
     'use_mixed_precision': False,  # Set to True to use fp16 inputs
+    'use_video_mode': False,  # Set to True to also build the graph that reuses the previous frame's feature pyramid
     # Model hyper-params
     'pyr_lvls': 6,  # number of feature levels in the flow pyramid
     'flow_pred_lvl': 2,  # which level to upsample to generate the final optical flow prediction
     'search_range': 4,  # cost volume search range
+    'cost_volume': 'loop',  # cost volume implementation, in ['loop', 'patches'] (see core_costvol.py)
     # if True, use model with dense connections (4705064 params w/o, 9374274 params with (no residual conn.))
     'use_dense_cx': False,
     # if True, use model with residual connections (4705064 params w/o, 6774064 params with (+2069000) (no dense conn.))
@@ -248,9 +257,58 @@ class ModelPWCNet(ModelBase):
         with tf.device(self.opts['controller']):
             self.flow_pred_tnsr, self.flow_pyr_tnsr = self.nn(self.x_tnsr)
 
+            if self.mode == 'test' and self.opts['use_video_mode']:
+                self.build_video_model()
+
         if self.opts['verbose']:
             print("... model built.")
 
+    def build_video_model(self, name='pwcnet'):
+        """Build the video mode graph, which shares its weights with the main model
+        When flows are computed for frames (t-1,t) and then (t,t+1), both pairs need the feature pyramid of frame t.
+        Instead of a pair of images, this graph takes a single new frame, runs it through the feature pyramid extractor
+        and estimates the flow from the feature pyramid of the previous frame, which is cached on the device (in local
+        variables) between runs. The pyramid of the new frame then replaces the cached one, so each frame only goes
+        through the feature pyramid extractor once.
+        """
+        if self.opts['verbose']:
+            print("Building video mode graph...")
+
+        self.frame_tnsr = tf.placeholder(self.opts['x_dtype'], [1] + self.opts['x_shape'][1:], 'frame_tnsr')
+
+        # The cached pyramid's size follows the size of the frames, hence validate_shape=False. Local variables are
+        # neither saved to nor restored from checkpoints.
+        prev_feat_vars, prev_feats = [None], [None]
+        for lvl in range(1, self.opts['pyr_lvls'] + 1):
+            var = tf.Variable(tf.zeros([1, 1, 1, _PYR_NUM_CHANN[lvl]], self.opts['x_dtype']), trainable=False,
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES], validate_shape=False, name=f'prev_feat{lvl}')
+            feat = tf.identity(var)
+            feat.set_shape([1, None, None, _PYR_NUM_CHANN[lvl]])
+            prev_feat_vars.append(var)
+            prev_feats.append(feat)
+
+        with tf.variable_scope(name, reuse=True):
+            with tf.variable_scope('featpyr'):
+                frame_feats = self.extract_pyramid(self.frame_tnsr, 'c2', reuse=True)
+            self.video_flow_pred_tnsr, _ = self.estimate_flow(prev_feats, frame_feats)
+
+        def cache_frame_feats():
+            return tf.group(*[tf.assign(var, feat, validate_shape=False)
+                              for var, feat in zip(prev_feat_vars[1:], frame_feats[1:])])
+
+        # Without a previous frame (first frame of a video), only cache the new pyramid
+        self.cache_frame_feats_op = cache_frame_feats()
+
+        # Otherwise, only replace the cached pyramid once the flow has been computed from it
+        with tf.control_dependencies([self.video_flow_pred_tnsr]):
+            self.update_frame_feats_op = cache_frame_feats()
+
+        self.sess.run(tf.variables_initializer(prev_feat_vars[1:]))
+        self.video_frame_shape = None
+
+        if self.opts['verbose']:
+            print("... video mode graph built.")
+
     def build_model_towers(self):
         """Build model towers. A tower is the name used to describe a copy of the model on a device.
         Called by the base class when building the TF graph to setup the list of output tensors
@@ -955,55 +1013,104 @@ class ModelPWCNet(ModelBase):
 
     def predict_from_img_pairs(self, img_pairs, batch_size=1, verbose=False):
         """Inference loop. Run inference on a list of image pairs.
+        The image pairs don't need to have the same size: they are grouped by padded size (multiples of
+        2**pyr_lvls), batched within each group, and their predicted flows are cropped back to their own size. The
+        graph's spatial dimensions are dynamic, so no graph is rebuilt and no checkpoint is reloaded for new sizes.
         Args:
             img_pairs: list of image pairs/tuples in list((img_1, img_2),...,(img_n, img_nplusone)) format.
-            batch_size: size of the batch to process (all images must have the same dimension, if batch_size>1)
+            batch_size: size of the batch to process (ignored, the model's batch size is used)
             verbose: if True, show progress bar
         Returns:
             Predicted flows in list format
         """
-    
-        # Chunk image pair list
+
+        # Group the image pairs by padded size
         batch_size = self.opts['batch_size']
-        test_size = len(img_pairs)
-        rounds, rounds_left = divmod(test_size, batch_size)
-        if rounds_left:
-            rounds += 1
+        buckets = OrderedDict()
+        for idx, img_pair in enumerate(img_pairs):
+            buckets.setdefault(self.padded_size(np.shape(img_pair[0])), []).append(idx)
+
+        # Chunk each group of image pairs
+        batches = []
+        for padded_size, bucket in buckets.items():
+            for ptr in range(0, len(bucket), batch_size):
+                batches.append((padded_size, bucket[ptr:ptr + batch_size]))
 
         # Loop through input samples and run inference on them
-        preds, test_ptr = [], 0
-        rng = trange(rounds, ascii=True, ncols=100, desc='Predicting flows') if verbose else range(rounds)
+        preds = [None] * len(img_pairs)
+        rng = trange(len(batches), ascii=True, ncols=100, desc='Predicting flows') if verbose else range(len(batches))
         for _round in rng:
-            # In batch mode, make sure to wrap around if there aren't enough input samples to process
-            if test_ptr + batch_size < test_size:
-                new_ptr = test_ptr + batch_size
-                indices = list(range(test_ptr, test_ptr + batch_size))
-            else:
-                new_ptr = (test_ptr + batch_size) % test_size
-                indices = list(range(test_ptr, test_size)) + list(range(0, new_ptr))
-            test_ptr = new_ptr
+            (pad_h, pad_w), indices = batches[_round]
 
-            # Repackage input image pairs as np.ndarray
-            x = np.array([img_pairs[idx] for idx in indices])
+            # Repackage input image pairs as np.ndarray, padded to the size of their group. If there aren't enough input
+            # samples left to fill the batch, pad it with blank pairs (instead of running other samples through again)
+            x = np.zeros((batch_size, 2, pad_h, pad_w, 3), dtype=np.asarray(img_pairs[indices[0]][0]).dtype)
+            for n, idx in enumerate(indices):
+                img_1, img_2 = img_pairs[idx]
+                x[n, 0, 0:img_1.shape[0], 0:img_1.shape[1]] = img_1
+                x[n, 1, 0:img_2.shape[0], 0:img_2.shape[1]] = img_2
 
-            # Make input samples conform to the network's requirements
+            # Make input samples conform to the network's requirements (they are already padded)
             # x: [batch_size,2,H,W,3] uint8; x_adapt: [batch_size,2,H,W,3] float32
-            x_adapt, x_adapt_info = self.adapt_x(x)
-            if x_adapt_info is not None:
-                y_adapt_info = (x_adapt_info[0], x_adapt_info[2], x_adapt_info[3], 2)
-            else:
-                y_adapt_info = None
+            x_adapt, _ = self.adapt_x(x)
 
             # Run the adapted samples through the network
             feed_dict = {self.x_tnsr: x_adapt}
             y_hat = self.sess.run(self.y_hat_test_tnsr, feed_dict=feed_dict)
-            y_hats, _ = self.postproc_y_hat_test(y_hat, y_adapt_info)
+            y_hats, _ = self.postproc_y_hat_test(y_hat)
+
+            # Crop the predicted flows back to the size of their image pair (dropping the predictions for the padding)
+            for y_hat, idx in zip(y_hats, indices):
+                height, width = np.shape(img_pairs[idx][0])[0:2]
+                preds[idx] = y_hat[0:height, 0:width, :]
+
+        return preds
+
+    def padded_size(self, img_shape):
+        """Size an image has to be padded to in order to conform to the network's requirements
+        Args:
+            img_shape: shape of the image in (H,W,...) format
+        Returns:
+            Padded size in (H,W) format (multiples of 2**pyr_lvls)
+        """
+        multiple = 2 ** self.opts['pyr_lvls']
+        return tuple(-(-dim // multiple) * multiple for dim in img_shape[0:2])
+
+    def predict_from_next_frame(self, frame):
+        """Video mode inference. Run inference on the next frame of a video, reusing the feature pyramid of the frame
+        given in the previous call (only the new frame goes through the feature pyramid extractor).
+        Call reset_video() before starting on a new video.
+        Args:
+            frame: next frame of the video in [H, W, 3] format
+        Returns:
+            Predicted flow from the previous frame to this frame in [H, W, 2] format, or None if there is no previous
+            frame (first frame of a video, or the frame size changed)
+        """
+        assert (self.mode == 'test' and self.opts['use_video_mode'])
 
-            # Return flat list of predicted labels
-            for y_hat in y_hats:
-                preds.append(y_hat)
+        # Make the frame conform to the network's requirements
+        # x: [1,1,H,W,3] uint8; x_adapt: [1,1,H,W,3] float32
+        x_adapt, x_adapt_info = self.adapt_x([np.expand_dims(frame, 0)])
+        feed_dict = {self.frame_tnsr: x_adapt[:, 0]}
 
-        return preds[0:test_size]
+        # Nothing to compute a flow from yet, just cache the frame's feature pyramid
+        if self.video_frame_shape != x_adapt.shape:
+            self.sess.run(self.cache_frame_feats_op, feed_dict=feed_dict)
+            self.video_frame_shape = x_adapt.shape
+            return None
+
+        pred_flow, _ = self.sess.run([self.video_flow_pred_tnsr, self.update_frame_feats_op], feed_dict=feed_dict)
+
+        # Has the frame been padded to fit the network's requirements? If so, crop the flow back to original size.
+        if x_adapt_info is not None:
+            pred_flow = pred_flow[:, 0:x_adapt_info[2], 0:x_adapt_info[3], :]
+
+        return pred_flow[0]
+
+    def reset_video(self):
+        """Forget the previous frame of the video mode, so that the next frame starts a new video.
+        """
+        self.video_frame_shape = None
 
     ###
     # PWC-Net pyramid helpers
@@ -1079,26 +1186,38 @@ class ModelPWCNet(ModelBase):
         assert(1 <= self.opts['pyr_lvls'] <= 6)
         if self.dbg:
             print(f"Building feature pyramids (c11,c21) ... (c1{self.opts['pyr_lvls']},c2{self.opts['pyr_lvls']})")
-        # Make the feature pyramids 1-based for better readability down the line
-        num_chann = [None, 16, 32, 64, 96, 128, 196]
-        c1, c2 = [None], [None]
-        init = tf.keras.initializers.he_normal()
         with tf.variable_scope(name):
-            for pyr, x, reuse, name in zip([c1, c2], [x_tnsr[:, 0], x_tnsr[:, 1]], [None, True], ['c1', 'c2']):
-                for lvl in range(1, self.opts['pyr_lvls'] + 1):
-                    # tf.layers.conv2d(inputs, filters, kernel_size, strides=(1, 1), padding='valid', ... , name, reuse)
-                    # reuse is set to True because we want to learn a single set of weights for the pyramid
-                    # kernel_initializer = 'he_normal' or tf.keras.initializers.he_normal(seed=None)
-                    f = num_chann[lvl]
-                    x = tf.layers.conv2d(x, f, 3, 2, 'same', kernel_initializer=init, name=f'conv{lvl}a', reuse=reuse)
-                    x = tf.nn.leaky_relu(x, alpha=0.1)  # , name=f'relu{lvl+1}a') # default alpha is 0.2 for TF
-                    x = tf.layers.conv2d(x, f, 3, 1, 'same', kernel_initializer=init, name=f'conv{lvl}aa', reuse=reuse)
-                    x = tf.nn.leaky_relu(x, alpha=0.1)  # , name=f'relu{lvl+1}aa')
-                    x = tf.layers.conv2d(x, f, 3, 1, 'same', kernel_initializer=init, name=f'conv{lvl}b', reuse=reuse)
-                    x = tf.nn.leaky_relu(x, alpha=0.1, name=f'{name}{lvl}')
-                    pyr.append(x)
+            # reuse is set to True for the second image because we want to learn a single set of weights for the pyramid
+            c1 = self.extract_pyramid(x_tnsr[:, 0], 'c1', reuse=None)
+            c2 = self.extract_pyramid(x_tnsr[:, 1], 'c2', reuse=True)
         return c1, c2
 
+    def extract_pyramid(self, x, name, reuse=True):
+        """Extract the pyramid of features of a single image (one branch of the Siamese feature pyramid extractor)
+        Must be called from within the feature pyramid's variable scope.
+        Args:
+            x: Input tensor (batch of single images in [batch_size, H, W, 3] format)
+            name: Prefix of the names of the pyramid level ops
+            reuse: Whether to reuse the pyramid's weights
+        Returns:
+            Feature pyramid, as a 1-based list of levels
+        """
+        # Make the feature pyramids 1-based for better readability down the line
+        pyr = [None]
+        init = tf.keras.initializers.he_normal()
+        for lvl in range(1, self.opts['pyr_lvls'] + 1):
+            # tf.layers.conv2d(inputs, filters, kernel_size, strides=(1, 1), padding='valid', ... , name, reuse)
+            # kernel_initializer = 'he_normal' or tf.keras.initializers.he_normal(seed=None)
+            f = _PYR_NUM_CHANN[lvl]
+            x = tf.layers.conv2d(x, f, 3, 2, 'same', kernel_initializer=init, name=f'conv{lvl}a', reuse=reuse)
+            x = tf.nn.leaky_relu(x, alpha=0.1)  # , name=f'relu{lvl+1}a') # default alpha is 0.2 for TF
+            x = tf.layers.conv2d(x, f, 3, 1, 'same', kernel_initializer=init, name=f'conv{lvl}aa', reuse=reuse)
+            x = tf.nn.leaky_relu(x, alpha=0.1)  # , name=f'relu{lvl+1}aa')
+            x = tf.layers.conv2d(x, f, 3, 1, 'same', kernel_initializer=init, name=f'conv{lvl}b', reuse=reuse)
+            x = tf.nn.leaky_relu(x, alpha=0.1, name=f'{name}{lvl}')
+            pyr.append(x)
+        return pyr
+
     ###
     # PWC-Net warping helpers
     ###
@@ -1273,6 +1392,8 @@ class ModelPWCNet(ModelBase):
         if self.dbg:
             print(f'Adding {op_name} with inputs {c1.op.name} and {warp.op.name}')
         with tf.name_scope(name):
+            if self.opts['cost_volume'] == 'patches':
+                return cost_volume_patches(c1, warp, self.opts['search_range'], op_name)
             return cost_volume(c1, warp, self.opts['search_range'], op_name)
 
     ###
@@ -1544,49 +1665,59 @@ class ModelPWCNet(ModelBase):
             # Extract pyramids of CNN features from both input images (1-based lists))
             c1, c2 = self.extract_features(x_tnsr)
 
-            flow_pyr = []
+            return self.estimate_flow(c1, c2)
 
-            for lvl in range(self.opts['pyr_lvls'], self.opts['flow_pred_lvl'] - 1, -1):
-
-                if lvl == self.opts['pyr_lvls']:
-                    # Compute the cost volume
-                    corr = self.corr(c1[lvl], c2[lvl], lvl)
+    def estimate_flow(self, c1, c2):
+        """Connects the flow estimation stages (warping, cost volume, flow estimation and context nets) to a pair of
+        feature pyramids. Must be called from within the nn's variable scope.
+        Args:
+            c1, c2: Feature pyramids of Image1 and Image2 (1-based lists)
+        Returns:
+            flow_pred, flow_pyr: Predicted flow (upsampled to the size of the images) and pyramid of estimated flows
+        """
+        flow_pyr = []
 
-                    # Estimate the optical flow
-                    upfeat, flow = self.predict_flow(corr, None, None, None, lvl)
-                else:
-                    # Warp level of Image1's using the upsampled flow
-                    scaler = 20. / 2**lvl  # scaler values are 0.625, 1.25, 2.5, 5.0
-                    warp = self.warp(c2[lvl], up_flow * scaler, lvl)
+        for lvl in range(self.opts['pyr_lvls'], self.opts['flow_pred_lvl'] - 1, -1):
 
-                    # Compute the cost volume
-                    corr = self.corr(c1[lvl], warp, lvl)
+            if lvl == self.opts['pyr_lvls']:
+                # Compute the cost volume
+                corr = self.corr(c1[lvl], c2[lvl], lvl)
 
-                    # Estimate the optical flow
-                    upfeat, flow = self.predict_flow(corr, c1[lvl], up_flow, up_feat, lvl)
+                # Estimate the optical flow
+                upfeat, flow = self.predict_flow(corr, None, None, None, lvl)
+            else:
+                # Warp level of Image1's using the upsampled flow
+                scaler = 20. / 2**lvl  # scaler values are 0.625, 1.25, 2.5, 5.0
+                warp = self.warp(c2[lvl], up_flow * scaler, lvl)
 
-                _, lvl_height, lvl_width, _ = tf.unstack(tf.shape(c1[lvl]))
+                # Compute the cost volume
+                corr = self.corr(c1[lvl], warp, lvl)
 
-                if lvl != self.opts['flow_pred_lvl']:
-                    if self.opts['use_res_cx']:
-                        flow = self.refine_flow(upfeat, flow, lvl)
+                # Estimate the optical flow
+                upfeat, flow = self.predict_flow(corr, c1[lvl], up_flow, up_feat, lvl)
 
-                    # Upsample predicted flow and the features used to compute predicted flow
-                    flow_pyr.append(flow)
+            _, lvl_height, lvl_width, _ = tf.unstack(tf.shape(c1[lvl]))
 
-                    up_flow = self.deconv(flow, lvl, 'up_flow')
-                    up_feat = self.deconv(upfeat, lvl, 'up_feat')
-                else:
-                    # Refine the final predicted flow
+            if lvl != self.opts['flow_pred_lvl']:
+                if self.opts['use_res_cx']:
                     flow = self.refine_flow(upfeat, flow, lvl)
-                    flow_pyr.append(flow)
 
-                    # Upsample the predicted flow (final output) to match the size of the images
-                    scaler = 2**self.opts['flow_pred_lvl']
-                    if self.dbg:
-                        print(f'Upsampling {flow.op.name} by {scaler} in each dimension.')
-                    size = (lvl_height * scaler, lvl_width * scaler)
-                    flow_pred = tf.image.resize_bilinear(flow, size, name="flow_pred") * scaler
-                    break
+                # Upsample predicted flow and the features used to compute predicted flow
+                flow_pyr.append(flow)
+
+                up_flow = self.deconv(flow, lvl, 'up_flow')
+                up_feat = self.deconv(upfeat, lvl, 'up_feat')
+            else:
+                # Refine the final predicted flow
+                flow = self.refine_flow(upfeat, flow, lvl)
+                flow_pyr.append(flow)
+
+                # Upsample the predicted flow (final output) to match the size of the images
+                scaler = 2**self.opts['flow_pred_lvl']
+                if self.dbg:
+                    print(f'Upsampling {flow.op.name} by {scaler} in each dimension.')
+                size = (lvl_height * scaler, lvl_width * scaler)
+                flow_pred = tf.image.resize_bilinear(flow, size, name="flow_pred") * scaler
+                break
 
-            return flow_pred, flow_pyr
+        return flow_pred, flow_pyr
@@ -2,10 +2,15 @@ from __future__ import absolute_import, division, print_function
 
 from abc import ABC, abstractmethod
 from copy import deepcopy
+import hashlib
+import numpy as np
+import os
+from os import path
 from opt_flow.model_pwcnet import ModelPWCNet, _DEFAULT_PWCNET_TEST_OPTIONS
+from opt_flow.optflow import flow_read_mmap, flow_write
 
 # declare for import *
-__all__ = ['OpticalFlowNetwork', 'TensorFlowPWCNet']
+__all__ = ['OpticalFlowNetwork', 'TensorFlowPWCNet', 'CachedOpticalFlow']
 
 
 class OpticalFlowNetwork(ABC):
@@ -23,6 +28,16 @@ class OpticalFlowNetwork(ABC):
         """
         pass
 
+    def infer_from_image_pairs(self, img_pairs, batch_size=None):
+        """
+        Infers flow fields for a list of image pairs. Override this if the
+        network can process several pairs at once.
+        :param img_pairs: list of (previous image, current image) pairs, each [h, w, 3]
+        :param batch_size: number of pairs to process at once (ignored here)
+        :return: list of flow fields between images, each [h, w, 2]
+        """
+        return [self.infer_from_image_pair(img1, img2) for img1, img2 in img_pairs]
+
     @abstractmethod
     def infer_from_image_stack(self, imgs):
         """
@@ -43,20 +58,28 @@ class OpticalFlowNetwork(ABC):
 
 
 class TensorFlowPWCNet(OpticalFlowNetwork):
+    """
+    PWC-Net (TensorFlow) optical flow network. The network accepts images of
+    any size: each call pads its inputs to multiples of 64 and crops the flow
+    fields back, so image_size is only informative.
+    """
 
-    def __init__(self, image_size: tuple,
+    def __init__(self, image_size: tuple = None,
                  model_pathname='./opt_flow/models/pwcnet-lg-6-2-multisteps-chairsthingsmix/pwcnet.ckpt-595000',
                  verbose=False,
-                 gpu=0):
+                 gpu=0,
+                 batch_size=1,
+                 video_mode=False):
         gpu_devices = [f'/device:GPU:{gpu}']
         controller = f'/device:GPU:{gpu}'
 
         nn_opts = deepcopy(_DEFAULT_PWCNET_TEST_OPTIONS)
         nn_opts['verbose'] = verbose
         nn_opts['ckpt_path'] = model_pathname
-        nn_opts['batch_size'] = 1
+        nn_opts['batch_size'] = batch_size
         nn_opts['gpu_devices'] = gpu_devices
         nn_opts['controller'] = controller
+        nn_opts['use_video_mode'] = video_mode
 
         # PWC-Net-large model in quarter-resolution mode:
         # - 6 level pyramid
@@ -66,20 +89,128 @@ class TensorFlowPWCNet(OpticalFlowNetwork):
         nn_opts['pyr_lvls'] = 6
         nn_opts['flow_pred_lvl'] = 2
 
-        # cropping of output images back to original size
-        nn_opts['adapt_info'] = (1, image_size[0], image_size[1], 2)
+        # cropping of output images back to original size (only used when evaluating, predictions are cropped per call)
+        if image_size is not None:
+            nn_opts['adapt_info'] = (batch_size, image_size[0], image_size[1], 2)
 
+        self.batch_size = batch_size
+        self.model_pathname = model_pathname
         self.nn = ModelPWCNet(mode='test', options=nn_opts)
 
         if verbose:
             self.nn.print_config()
 
     def infer_from_image_pair(self, img1, img2):
-        return self.nn.predict_from_img_pairs([(img1, img2)], batch_size=1, verbose=False)[0]
+        return self.infer_from_image_pairs([(img1, img2)])[0]
+
+    def infer_from_image_pairs(self, img_pairs, batch_size=None):
+        """
+        Infers flow fields for a list of image pairs, running batch_size pairs
+        through the network per session call. The last batch is padded with
+        blank pairs if there aren't enough pairs left to fill it.
+        :param img_pairs: list of (previous image, current image) pairs, each [h, w, 3]
+        (pairs can have different sizes)
+        :param batch_size: must be the batch size the network was built with
+        (None to use it)
+        :return: list of flow fields between images, each [h, w, 2]
+        """
+        if batch_size is not None and batch_size != self.batch_size:
+            raise ValueError(f'network was built for batches of {self.batch_size} image pairs '
+                             f'(requested: {batch_size})')
+
+        return self.nn.predict_from_img_pairs(img_pairs, batch_size=self.batch_size, verbose=False)
 
     def infer_from_image_stack(self, imgs):
         return self.infer_from_image_pair(imgs[..., :3], imgs[..., 3:])
 
+    def infer_from_next_frame(self, img):
+        """
+        Infers a flow field from the previous frame given to this method to this
+        frame. The feature pyramid of the previous frame is reused, so each frame
+        is only encoded once (requires video_mode).
+        :param img: current image [h, w, 3]
+        :return: flow field between images [h, w, 2], or None for the first frame
+        """
+        return self.nn.predict_from_next_frame(img)
+
+    def reset_video(self):
+        """
+        Forgets the previous frame, so that the next one starts a new video.
+        """
+        self.nn.reset_video()
+
     def __call__(self, *args, **kwargs):
         raise NotImplemented("not yet implemented for tf pwcnet")
 
+
+
+class CachedOpticalFlow(OpticalFlowNetwork):
+    """
+    Wraps an optical flow network with a persistent, on-disk cache of its flow
+    fields. Flow fields are stored as .flo files (memory-mapped when read back),
+    keyed by a hash of the contents of both images and of the network's
+    checkpoint, and sharded into subdirectories by the first 2 hex digits of
+    the key. Image pairs that were already seen (e.g. in a previous training
+    epoch) are read from disk instead of going through the network again.
+    """
+
+    def __init__(self, network: OpticalFlowNetwork, cache_dir='./opt_flow/cache/', model_id: str = None):
+        """
+        :param network: optical flow network to compute the flow fields that aren't cached yet
+        :param cache_dir: root directory of the cache
+        :param model_id: identifies the network's weights in the cache keys (defaults
+        to the network's checkpoint path and modification time, if it has one)
+        """
+        self.network = network
+        self.cache_dir = cache_dir
+
+        if model_id is None:
+            model_id = getattr(network, 'model_pathname', type(network).__name__)
+            if path.exists(f'{model_id}.index'):
+                model_id = f'{model_id}@{path.getmtime(model_id + ".index")}'
+        self._model_key = hashlib.sha1(model_id.encode()).digest()
+
+    def cache_path(self, img1, img2):
+        """
+        Path of the cached flow field for an image pair (whether it exists or not).
+        :param img1: previous image [h, w, 3]
+        :param img2: current image [h, w, 3]
+        :return: path of the .flo file
+        """
+        key = hashlib.sha1(self._model_key)
+        for img in (img1, img2):
+            img = np.ascontiguousarray(img)
+            key.update(f'{img.shape}{img.dtype}'.encode())
+            key.update(img.data)
+        key = key.hexdigest()
+
+        return path.join(self.cache_dir, key[:2], f'{key}.flo')
+
+    def _store(self, flow_path, flow):
+        # write to a temporary file first so that concurrent readers never see partial files
+        tmp_path = f'{flow_path[:-4]}.{os.getpid()}.tmp.flo'
+        flow_write(flow, tmp_path)
+        os.replace(tmp_path, flow_path)
+
+    def infer_from_image_pair(self, img1, img2):
+        return self.infer_from_image_pairs([(img1, img2)])[0]
+
+    def infer_from_image_pairs(self, img_pairs, batch_size=None):
+        flow_paths = [self.cache_path(img1, img2) for img1, img2 in img_pairs]
+        flows = [flow_read_mmap(flow_path) if path.exists(flow_path) else None for flow_path in flow_paths]
+
+        # only run the pairs that missed the cache through the network
+        missed = [i for i, flow in enumerate(flows) if flow is None]
+        if missed:
+            new_flows = self.network.infer_from_image_pairs([img_pairs[i] for i in missed], batch_size=batch_size)
+            for i, flow in zip(missed, new_flows):
+                self._store(flow_paths[i], flow)
+                flows[i] = flow
+
+        return flows
+
+    def infer_from_image_stack(self, imgs):
+        return self.infer_from_image_pair(imgs[..., :3], imgs[..., 3:])
+
+    def __call__(self, *args, **kwargs):
+        return self.network(*args, **kwargs)
@@ -142,6 +142,23 @@ def flow_read(src_file):
     return flow
 
 
+def flow_read_mmap(src_file):
+    """Memory-map optical flow stored in a .flo file (nothing is read until the flow values are accessed)
+    Args:
+        src_file: Path to .flo file
+    Returns:
+        flow: read-only optical flow in [h, w, 2] format
+    """
+    assert(src_file.lower().endswith('.flo'))
+
+    # Parse .flo file header (see flow_write() for the layout)
+    header = np.memmap(src_file, dtype=np.float32, mode='r', shape=(3,))
+    assert(float(header[0]) == TAG_FLOAT)
+    w, h = header[1:3].view(np.int32)
+
+    return np.memmap(src_file, dtype=np.float32, mode='r', offset=12, shape=(h, w, 2))
+
+
 def flow_write(flow, dst_file):
     """Write optical flow to a .flo file
     Args:
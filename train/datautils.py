@@ -1,17 +1,117 @@
-from copy import deepcopy
+from copy import copy
 import numpy as np
-from typing import List
+from typing import Iterator, List, Tuple
 
 from image_seg.utils import Dataset
 
 
-def splitd(dataset: Dataset, *splits: float, shuffle=True) -> List[Dataset]:
+class ImageInfoView:
+    """
+    Read-only view of the image info of a parent dataset, through an array of
+    indices into it. It is indexed like the image info it views (an integer
+    returns the parent's info dict, anything else returns a narrower view), so
+    a dataset whose image_info is a view loads the parent's images.
+    """
+
+    def __init__(self, parent_info, indices: np.ndarray):
+        # views of views index the root image info directly
+        if isinstance(parent_info, ImageInfoView):
+            parent_info, indices = parent_info.parent_info, parent_info.indices[indices]
+
+        self.parent_info = parent_info
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.parent_info[int(self.indices[index])]
+
+        return ImageInfoView(self.parent_info, self.indices[index])
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.parent_info[int(i)]
+
+    def source_keys(self) -> np.ndarray:
+        """'source.id' of every image (see utils.Dataset.prepare())."""
+        if hasattr(self.parent_info, 'source_keys'):
+            return self.parent_info.source_keys()[self.indices]
+
+        return np.array(["{}.{}".format(info['source'], info['id']) for info in self])
+
+
+def subset(dataset: Dataset, indices) -> Dataset:
+    """
+    Utility function that creates a *prepared* dataset of some of the images of
+    a dataset, without copying their image info. The subset shares everything
+    else (classes, directories, caches) with the original dataset.
+    :param dataset: dataset to take images from
+    :param indices: image ids (in dataset) of the images to keep, in order
+    :return: dataset viewing the selected images
+    """
+    view = copy(dataset)
+    view.image_info = ImageInfoView(dataset.image_info, indices)
+    view.prepare()
+
+    return view
+
+
+def _group_ids(dataset: Dataset) -> np.ndarray:
+    """
+    Group (video) of every image of a dataset, as integer ids. Images without a
+    video each get a group of their own.
+    """
+    image_info = dataset.image_info
+    if isinstance(image_info, ImageInfoView) and hasattr(image_info.parent_info, 'columns'):
+        videos = image_info.parent_info.columns['video'][image_info.indices]
+    elif hasattr(image_info, 'columns'):
+        videos = image_info.columns['video']
+    else:
+        videos = np.array([str(info.get('video') or '') for info in image_info])
+
+    videos = np.where(videos == '', np.char.add('#', np.arange(len(videos)).astype(str)), videos)
+
+    return np.unique(videos, return_inverse=True)[1].reshape(-1)
+
+
+def _ordering(dataset: Dataset, shuffle: bool, by_video: bool, rng: np.random.RandomState):
+    """
+    Order in which the images are split, and the positions in that order where
+    a split may start (any position, or only the first frame of a video).
+    """
+    num_images = len(dataset.image_info)
+
+    if not by_video:
+        order = rng.permutation(num_images) if shuffle else np.arange(num_images)
+        return order, np.arange(num_images + 1)
+
+    groups = _group_ids(dataset)
+    num_groups = groups.max() + 1 if num_images else 0
+    group_order = rng.permutation(num_groups) if shuffle else np.arange(num_groups)
+    rank = np.empty_like(group_order)
+    rank[group_order] = np.arange(len(group_order))
+
+    # frames of a video stay together (and in order)
+    order = np.argsort(rank[groups], kind='stable')
+    sorted_groups = groups[order]
+    boundaries = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1], True])
+
+    return order, boundaries
+
+
+def splitd(dataset: Dataset, *splits: float, shuffle=True, by_video=False, random_state=None) -> List[Dataset]:
     """
     Utility function that splits a *prepared* dataset object (that is, you've
     called dataset.prepare() ) into multiple datasets based on splits.
     :param dataset: dataset to split
     :param splits: split ratios for each split
     :param shuffle: whether to first shuffle the images before splitting
+    :param by_video: whether to keep all the frames of a video in the same
+    split (so that splits don't share scenes); split sizes are then rounded to
+    whole videos
+    :param random_state: seed (or numpy RandomState) of the shuffle
     :return: list of datasets for each split
     In general, if you pass in 'k' splits, you'll get back 'k+1' dataset
     objects. If the splits sum to 1.0, then passing in 'k' splits will return
@@ -23,6 +123,9 @@ def splitd(dataset: Dataset, *splits: float, shuffle=True) -> List[Dataset]:
     whole dataset). In contrast, passing in a set of splits that don't sum to
     1.0 follows the logic of taking a dataset and 'stripping off' certain
     amounts for other purposes.
+
+    The splits are views of the given dataset (see subset()), which is left
+    unchanged.
     """
 
     if sum(splits) > 1.:
@@ -37,48 +140,101 @@ def splitd(dataset: Dataset, *splits: float, shuffle=True) -> List[Dataset]:
 
     partitions = list(map(convert_to_partition, splits))
 
-    # shuffles the images before splitting
-    if shuffle:
-        np.random.shuffle(dataset.image_info)
+    rng = random_state if isinstance(random_state, np.random.RandomState) else np.random.RandomState(random_state)
+    order, boundaries = _ordering(dataset, shuffle, by_video, rng)
+
+    def snap(index):
+        # nearest position a split may start at
+        return boundaries[np.argmin(np.abs(boundaries - min(index, len(order))))]
 
     # 'strip off' the last x number of images (starting from the back)
     split_datasets = []
     curr_index = 0
     for partition in reversed(partitions):
-        # extract the desired image info elements
-        left = min(curr_index, len(dataset.image_info))
-        right = min(left + partition, len(dataset.image_info))
-        split_info = dataset.image_info[left:right]
+        left = snap(curr_index)
+        right = snap(curr_index + partition)
         curr_index += partition
 
-        # load the chosen images into a new dataset
-        new_dataset = deepcopy(dataset)
-        new_dataset.image_info = split_info
-        new_dataset.prepare()
-
-        split_datasets.append(new_dataset)
+        split_datasets.append(subset(dataset, order[left:right]))
 
     # include the original dataset with whatever's left
-    dataset.image_info = dataset.image_info[min(curr_index, len(dataset.image_info)):]
-    dataset.prepare()
-    split_datasets.append(dataset)
+    split_datasets.append(subset(dataset, order[snap(curr_index):]))
 
     # reverse (since we starting splitting from the end) and return the datasets
     return list(reversed(split_datasets))
 
 
+def kfold(dataset: Dataset, k: int, shuffle=True, by_video=False, random_state=None) \
+        -> Iterator[Tuple[Dataset, Dataset]]:
+    """
+    Utility function that generates the k folds of cross-validation over a
+    *prepared* dataset, as views of it (see subset()).
+    :param dataset: dataset to split into folds
+    :param k: number of folds
+    :param shuffle: whether to first shuffle the images before splitting
+    :param by_video: whether to keep all the frames of a video in the same fold
+    :param random_state: seed (or numpy RandomState) of the shuffle
+    :return: generator of (training dataset, validation dataset) for each fold
+    """
+    if k < 2:
+        raise ValueError('k must be at least 2')
+
+    rng = random_state if isinstance(random_state, np.random.RandomState) else np.random.RandomState(random_state)
+    order, boundaries = _ordering(dataset, shuffle, by_video, rng)
+
+    cuts = [boundaries[np.argmin(np.abs(boundaries - round(i * len(order) / k)))] for i in range(k + 1)]
+
+    for left, right in zip(cuts, cuts[1:]):
+        yield (subset(dataset, np.concatenate([order[:left], order[right:]])),
+               subset(dataset, order[left:right]))
+
+
 def merged(*datasets: Dataset) -> Dataset:
     """
     Utility function that merges a set of datasets containing
     :param datasets: datasets to merge together
-    :return:
+    :return: a *prepared* dataset of the images of all datasets (with the
+    classes and loading methods of the first one). Views of the same dataset
+    are merged into a view of it; otherwise, the image info is concatenated
+    (without copying the info of each image).
     """
     assert len(datasets) > 0
 
-    new_dataset = deepcopy(datasets[0])
+    infos = [dataset.image_info for dataset in datasets]
+    new_dataset = copy(datasets[0])
+
+    if all(isinstance(info, ImageInfoView) for info in infos) \
+            and all(info.parent_info is infos[0].parent_info for info in infos):
+        new_dataset.image_info = ImageInfoView(infos[0].parent_info, np.concatenate([info.indices for info in infos]))
+    elif all(hasattr(info, 'columns') for info in infos):
+        # columnar manifests (see train.manifest)
+        new_dataset.image_info = type(infos[0]).concatenate(*infos)
+    else:
+        new_dataset.image_info = [info for image_info in infos for info in image_info]
 
-    for dataset in datasets:
-        new_dataset.image_info.extend(dataset.image_info)
+    new_dataset.prepare()
 
     return new_dataset
 
+
+def frame_pairs(dataset: Dataset, max_pair_dist: int = 2) -> List[Tuple[int, int]]:
+    """
+    Utility function that lists the pairs of frames of the same video in a
+    *prepared* dataset that are less than max_pair_dist frames apart (as with
+    Davis2017Dataset.id_pairs(), so 2 lists consecutive frames). Frames are
+    grouped by the 'video' entry of their image info (images without one are
+    skipped) and ordered by their source image id.
+    :param dataset: dataset of video frames
+    :param max_pair_dist: bound on the distance between the frames of a pair
+    :return: list of (previous image id, current image id) pairs, by distance
+    between the frames and then in video and frame order (so that consecutive
+    frames form chains)
+    """
+    frames = sorted((info['video'], str(info['id']), image_id)
+                    for image_id, info in zip(dataset.image_ids, dataset.image_info)
+                    if info.get('video') is not None)
+
+    return [(prev_id, curr_id)
+            for dist in range(1, max_pair_dist)
+            for (prev_video, _, prev_id), (curr_video, _, curr_id) in zip(frames, frames[dist:])
+            if prev_video == curr_video]
@@ -10,6 +10,8 @@ import skimage
 from warnings import warn
 
 from image_seg import utils
+from train.frame_cache import FrameCache
+from train.manifest import Manifest, add_manifest, scan_davis
 
 
 __all__ = ['Davis2017Dataset',
@@ -51,7 +53,7 @@ class Davis2017Dataset(utils.Dataset):
     name = 'DAVIS2017'
     size = (480, 854)
 
-    def __init__(self, subset: str, quality: str, data_dir='./'):
+    def __init__(self, subset: str, quality: str, data_dir='./', cache_bytes=2 ** 30):
         super(self.__class__, self).__init__(self)
 
         if not path.exists(data_dir):
@@ -62,6 +64,10 @@ class Davis2017Dataset(utils.Dataset):
         self.quality = quality
         self.data_dir = data_dir
 
+        # decoded frames and label maps, shared by all loading methods (and by
+        # the splits of this dataset, see train.datautils.subset)
+        self.frame_cache = FrameCache(cache_bytes)
+
     def __len__(self):
         return len(self.image_ids)
 
@@ -73,13 +79,16 @@ class Davis2017Dataset(utils.Dataset):
         It is not safe to use the current dataset as a training dataset if this
         property is not true.
         """
+        if isinstance(self.image_info, Manifest):
+            return bool(np.all(self.image_info.columns['has_mask']))
+
         for img_dict in self.image_info:
             if 'mask_path' not in img_dict:
                 return False
 
         return True
 
-    def load_subset(self, *videos):
+    def load_subset(self, *videos, workers=16):
         """
         Loads all the videos within this subset and video quality for the videos
         given. If a list of videos is given, only those videos will be loaded;
@@ -87,13 +96,13 @@ class Davis2017Dataset(utils.Dataset):
         
         Args:
             *videos: specific videos to load
+            workers: number of video directories scanned in parallel
         """
 
-        if not len(videos):
-            _, videos, _ = next(os.walk(self.build_absolute_path_to('images', '')))
-
-        for vid in videos:
-            self.load_video(vid)
+        self.image_info = add_manifest(self.image_info,
+                                       scan_davis(self.build_absolute_path_to('images', ''),
+                                                  self.build_absolute_path_to('labels', ''),
+                                                  videos, source=self.name, workers=workers))
 
     def load_video(self, video: str):
         """
@@ -103,10 +112,7 @@ class Davis2017Dataset(utils.Dataset):
             video: name of the video to load into dataset
         """
 
-        _, _, frame_filenames = next(os.walk(self.build_absolute_path_to('images', video)))
-
-        for fname in frame_filenames:
-            self.load_frame(video, fname)
+        self.load_subset(video)
 
     def load_frame(self, video, img_filename):
         """
@@ -142,10 +148,10 @@ class Davis2017Dataset(utils.Dataset):
         if info['source'] != self.name:
             return super(self.__class__, self).load_image(image_id)
 
-        img_path = self.build_absolute_path_to('images', info['path'])
+        return self.frame_cache.get(('images', info['path']), lambda: self._decode_image(image_id))
 
-        # Load image
-        image = skimage.io.imread(img_path)
+    def _decode_image(self, image_id: int):
+        image = skimage.io.imread(self.source_image_link(image_id))
 
         # If has an alpha channel, remove it for consistency
         if image.shape[-1] == 4:
@@ -153,6 +159,34 @@ class Davis2017Dataset(utils.Dataset):
 
         return image
 
+    def _load_raw_label_map(self, image_id: int):
+        """
+        Loads the (cached) palette indices [h, w] of the mask of a frame, which
+        are the object ids of its pixels (0 is background).
+        """
+        info = self.image_info[image_id]
+
+        if not self.has_mask(image_id):
+            raise ValueError('this image does not have a mask')
+
+        mask_path = self.build_absolute_path_to('labels', info['mask_path'])
+
+        return self.frame_cache.get(('labels', info['mask_path']),
+                                    lambda: np.atleast_3d(Image.open(mask_path))[..., 0])
+
+    def source_image_link(self, image_id: int) -> str:
+        """
+        Returns the full path to the image file of a frame.
+        
+        Args:
+            image_id: id of the frame
+
+        Returns:
+            absolute path to the image
+        """
+        
+        return self.build_absolute_path_to('images', self.image_info[image_id]['path'])
+
     def has_mask(self, image_id: int):
         """
         Check whether the specified frame has a mask associated with it.
@@ -180,7 +214,7 @@ class Davis2017Dataset(utils.Dataset):
             (mask, labels) pair, where mask and labels are tensors
             
         The returned mask has shape [h, w, n], where n is the number of instances
-        in this frame.
+        in this frame (as utils.SparseMasks if sparse_masks is set).
         
         The returned labels tensor has shape [n], where n is the same as above.
         """
@@ -190,17 +224,35 @@ class Davis2017Dataset(utils.Dataset):
         if info['source'] != self.name:
             return super(self.__class__, self).load_mask(image_id)
 
-        if not self.has_mask(image_id):
-            raise ValueError('this image does not have a mask')
-
-        mask_path = self.build_absolute_path_to('labels', info['mask_path'])
-
-        mask = np.expand_dims(np.atleast_3d(Image.open(mask_path))[..., 0], axis=2)
+        mask = np.expand_dims(self._load_raw_label_map(image_id), axis=2)
         uniqs = np.delete(np.expand_dims(np.expand_dims(np.unique(mask), axis=0), axis=0), 0)
 
+        if self.sparse_masks:
+            return utils.SparseMasks.from_label_map(mask[..., 0], uniqs), uniqs
+
         # Return mask and class of mask
         return mask == uniqs, uniqs
 
+    def load_label_map(self, image_id: int):
+        """
+        Loads the instances of a frame as a single label map (see
+        utils.Dataset.load_label_map()).
+        
+        Args:
+            image_id: id of the frame
+
+        Returns:
+            (label_map, labels) pair, where label_map has shape [h, w] (uint16,
+            0 is background and i + 1 the i-th instance) and labels has shape [n]
+        """
+        
+        info = self.image_info[image_id]
+
+        if info['source'] != self.name:
+            return super(self.__class__, self).load_label_map(image_id)
+
+        return utils.compact_label_map(self._load_raw_label_map(image_id))
+
     def load_int_mask(self, image_id: int):
         """
         Loads the mask for a frame as an integer-based image.
@@ -213,12 +265,12 @@ class Davis2017Dataset(utils.Dataset):
         """
         mask, ids = self.load_mask(image_id)
 
-        return 255 * mask.astype(int), ids
+        return 255 * np.asarray(mask).astype(int), ids
 
     def load_float_mask(self, image_id: int):
         mask, ids = self.load_mask(image_id)
 
-        return mask.astype(np.float32), ids
+        return np.asarray(mask).astype(np.float32), ids
 
     def __str__(self):
         try:
@@ -226,7 +278,85 @@ class Davis2017Dataset(utils.Dataset):
         except AttributeError:
             return '<Davis 2017 Dataset (unprepared)>'
 
-    def paired_generator(self, augmentation=iaa.Noop(), mask_as_input=True, max_pair_dist=10):
+    def id_pairs(self, max_pair_dist=10):
+        """
+        Lists the pairs of frames of the same video that are at most
+        max_pair_dist frames apart, as used by paired_generator().
+        
+        Args:
+            max_pair_dist: maximum distance between 2 images (in a pair)
+
+        Returns:
+            list of (previous image id, current image id) pairs
+        """
+        ordered_ids = deepcopy(self.image_ids[1:])
+
+        id_pairs = []
+
+        i = 0
+        while i < len(ordered_ids) - 1:
+            # at the change point between videos
+            if self.image_info[i]['video'] != self.image_info[i + 1]['video']:
+                i += 1
+                continue
+
+            # add image pairs until we reach the max distance (in frame) away
+            j = i + 1
+            while j < len(ordered_ids) - 1 \
+                    and self.image_info[i]['video'] == self.image_info[j]['video'] \
+                    and j - i < max_pair_dist:
+                id_pairs.append((i, j))
+
+                j += 1
+
+            i += 1
+
+        return id_pairs
+
+    @staticmethod
+    def shuffled_pairs(id_pairs, locality=32):
+        """
+        Shuffles pairs of frames in blocks: pairs whose first frame falls in the
+        same block of 'locality' frames stay together (in random order), and the
+        order of the blocks is random. This keeps the frames of consecutive
+        pairs in the frame cache.
+        
+        Args:
+            id_pairs: pairs of image ids (see id_pairs())
+            locality: number of frames in a block (a fully random order if 0)
+
+        Returns:
+            shuffled list of pairs
+        """
+        return [pair for block in Davis2017Dataset.shuffled_blocks(id_pairs, locality) for pair in block]
+
+    @staticmethod
+    def shuffled_blocks(id_pairs, locality=32):
+        """
+        Same as shuffled_pairs(), but returns the blocks of pairs separately
+        (one pair per block if locality is 0).
+
+        Returns:
+            shuffled list of shuffled lists of pairs
+        """
+        if not locality:
+            id_pairs = list(id_pairs)
+            shuffle(id_pairs)
+            return [[pair] for pair in id_pairs]
+
+        blocks = {}
+        for pair in id_pairs:
+            blocks.setdefault(pair[0] // locality, []).append(pair)
+
+        blocks = list(blocks.values())
+        shuffle(blocks)
+        for block in blocks:
+            shuffle(block)
+
+        return blocks
+
+    def paired_generator(self, augmentation=iaa.Noop(), mask_as_input=True, max_pair_dist=10, flow_store=None,
+                         locality=32):
         """
         Creates a generator that returns pairs of consecutive images (as input)
         and the mask for the second image (as ground truth).
@@ -235,6 +365,13 @@ class Davis2017Dataset(utils.Dataset):
             mask to transform it into an input mask
             mask_as_input:
             max_pair_dist:
+            flow_store: if given (a train.flow_store.FlowStore), the flow field
+            of pairs in the store is yielded after the other tensors (the
+            flow field of other pairs is left to the optical flow model, see
+            MaskRefineSubnet.train())
+            locality: pairs are shuffled within blocks of this many frames, and
+            the blocks are shuffled, so that the frames of consecutive pairs
+            stay in the frame cache (a fully random order if 0)
 
         Returns:
 
@@ -254,33 +391,12 @@ class Davis2017Dataset(utils.Dataset):
         def make_batch_dim(tensor):
             return np.expand_dims(tensor, axis=0)
 
-        ordered_ids = deepcopy(self.image_ids[1:])
-
-        id_pairs = []
-
-        i = 0
-        while i < len(ordered_ids) - 1:
-            # at the change point between videos
-            if self.image_info[i]['video'] != self.image_info[i + 1]['video']:
-                i += 1
-                continue
-
-            # add image pairs until we reach the max distance (in frame) away
-            j = i + 1
-            while j < len(ordered_ids) - 1 \
-                    and self.image_info[i]['video'] == self.image_info[j]['video'] \
-                    and j - i < max_pair_dist:
-                id_pairs.append((i, j))
-
-                j += 1
-
-            i += 1
+        id_pairs = self.id_pairs(max_pair_dist)
 
         print(f'Created paired generator with {len(id_pairs)} image pairs.')
         sentinel = (-1, -1)
 
-        shuffle(id_pairs)
-        id_pair_queue = deque(id_pairs)
+        id_pair_queue = deque(self.shuffled_pairs(id_pairs, locality))
         id_pair_queue.appendleft(sentinel)
 
         while True:
@@ -289,8 +405,7 @@ class Davis2017Dataset(utils.Dataset):
 
             # reshuffle if reached the sentinel
             if prev_id == curr_id:
-                shuffle(id_pairs)
-                id_pair_queue = deque(id_pairs)
+                id_pair_queue = deque(self.shuffled_pairs(id_pairs, locality))
                 id_pair_queue.appendleft(sentinel)
                 continue
 
@@ -298,7 +413,12 @@ class Davis2017Dataset(utils.Dataset):
             prev_image = self.load_image(prev_id)
             curr_image = self.load_image(curr_id)
             gt_masks, _ = self.load_float_mask(curr_id)
-            pre_aug_masks, _ = self.load_int_mask(curr_id)
+            pre_aug_masks = 255 * gt_masks.astype(int)
+
+            flow_field = []
+            paths = (self.image_info[prev_id]['path'], self.image_info[curr_id]['path'])
+            if flow_store is not None and paths in flow_store:
+                flow_field = [flow_store.load(*paths)]
 
             # generate a pair for each mask instance
             for i in range(gt_masks.shape[-1]):
@@ -310,9 +430,9 @@ class Davis2017Dataset(utils.Dataset):
                     aug_mask = np.expand_dims(pre_aug_masks[..., i], axis=2)
                     aug_mask = aug_for_this.augment_image(aug_mask)
 
-                    yield map(make_batch_dim, (prev_image, curr_image, aug_mask, gt_mask))
+                    yield map(make_batch_dim, (prev_image, curr_image, aug_mask, gt_mask, *flow_field))
                 else:
-                    yield map(make_batch_dim, (prev_image, curr_image, gt_mask))
+                    yield map(make_batch_dim, (prev_image, curr_image, gt_mask, *flow_field))
 
             # add the image to the back of the queue
             id_pair_queue.appendleft(curr_id)
@@ -0,0 +1,183 @@
+"""
+Precomputed optical flow fields for the frames of a dataset, so that training
+and evaluation jobs can load flow fields instead of keeping an optical flow
+network resident next to the model they train.
+
+Flow fields are computed on the frames padded to multiples of 64 (see
+mask_refine.pad64), as training pads them before inferring the flow fields
+that are not in the store, so stored and inferred flow fields match.
+
+A flow store is a directory containing:
+ * index.json - maps each pair of frames less than max_pair_dist frames
+   apart in a video (consecutive frames by default; by image path, relative
+   to the dataset) to the shard, offset and shape of its flow field
+ * flows_<k>.bin - shards of raw float16 flow fields, one per worker
+
+Each flow field takes 4 bytes per (padded) pixel, and the store holds
+max_pair_dist - 1 of them per frame: widen the window with care.
+
+Usage:
+FlowStore.build(dataset, store_dir, model_pathname, gpus=[0, 1])
+flows = FlowStore(store_dir)
+flow = flows.load(prev_path, curr_path)
+"""
+
+import json
+import numpy as np
+import os
+from os import path
+import skimage.io
+import threading
+from typing import List
+
+from image_seg.utils import Dataset
+from mask_refine.mask_refine import pad64
+from train.datautils import frame_pairs
+
+__all__ = ['FlowStore']
+
+_INDEX_FILENAME = 'index.json'
+_DTYPE = np.float16
+
+
+def _load_frame(image_path: str) -> np.ndarray:
+    image = skimage.io.imread(image_path)
+
+    # If has an alpha channel, remove it for consistency
+    if image.shape[-1] == 4:
+        image = image[..., :3]
+
+    # padded as in training
+    return pad64(image[np.newaxis])[0]
+
+
+def _compute_shard(shard_path: str, pairs: List[tuple], model_pathname: str, gpu: int, entries: list):
+    """
+    Computes the flow fields of a list of frame pairs on one device and writes
+    them into one shard (runs in its own thread, with its own graph).
+
+    Args:
+        shard_path: path of the shard file to write
+        pairs: (prev rel. path, prev abs. path, curr rel. path, curr abs. path)
+            tuples (see frame_pairs() for their order)
+        model_pathname: checkpoint of the optical flow network
+        gpu: index of the gpu to run the network on
+        entries: list to append the index entries of this shard to
+    """
+    import tensorflow as tf
+    from opt_flow.opt_flow import TensorFlowPWCNet
+
+    with tf.Graph().as_default():
+        # chains of consecutive pairs share frames, so only encode each of
+        # them once (other pairs start over from their previous frame)
+        pwc_net = TensorFlowPWCNet(model_pathname=model_pathname, gpu=gpu, video_mode=True)
+
+    offset, last_path = 0, None
+    with open(shard_path, 'wb') as f:
+        for prev_rel, prev_abs, curr_rel, curr_abs in pairs:
+            if prev_abs != last_path:
+                pwc_net.reset_video()
+                pwc_net.infer_from_next_frame(_load_frame(prev_abs))
+
+            flow = pwc_net.infer_from_next_frame(_load_frame(curr_abs))
+            last_path = curr_abs
+
+            flow.astype(_DTYPE).tofile(f)
+            entries.append({'prev': prev_rel, 'curr': curr_rel, 'shard': path.basename(shard_path),
+                            'offset': offset, 'shape': list(flow.shape)})
+            offset += flow.size * np.dtype(_DTYPE).itemsize
+
+
+class FlowStore:
+    """
+    Read-only access to a directory of precomputed flow fields (see
+    FlowStore.build() to create one). Shards are memory-mapped, so only the
+    flow fields that are actually loaded are read from disk.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+
+        with open(path.join(store_dir, _INDEX_FILENAME), 'r') as f:
+            index = json.load(f)
+
+        self._entries = {(e['prev'], e['curr']): e for e in index['pairs']}
+        self._shards = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, pair):
+        return tuple(pair) in self._entries
+
+    def _shard(self, shard: str) -> np.ndarray:
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(path.join(self.store_dir, shard), dtype=_DTYPE, mode='r')
+
+        return self._shards[shard]
+
+    def load(self, prev_path: str, curr_path: str) -> np.ndarray:
+        """
+        Loads the flow field between two frames.
+
+        Args:
+            prev_path: path of the previous image (relative to the dataset, as
+                in the 'path' entry of its image info)
+            curr_path: path of the current image (same)
+
+        Returns:
+            flow field from the previous to the current image [h, w, 2], with
+            h and w those of the image padded to multiples of 64
+        """
+        entry = self._entries[(prev_path, curr_path)]
+        start = entry['offset'] // np.dtype(_DTYPE).itemsize
+        size = int(np.prod(entry['shape']))
+
+        return self._shard(entry['shard'])[start:start + size].reshape(entry['shape']).astype(np.float32)
+
+    @staticmethod
+    def build(dataset: Dataset, store_dir: str, model_pathname: str, gpus=(0,), max_pair_dist=2) -> 'FlowStore':
+        """
+        Computes the flow fields of every pair of frames that training draws
+        from a *prepared* dataset (once each) and writes them into a flow store.
+        The pairs are split into contiguous chunks, one per device, and each
+        device runs its own optical flow network in its own thread.
+
+        Args:
+            dataset: dataset of video frames (whose source_image_link() returns
+                the path to each image file)
+            store_dir: directory to write the flow store to
+            model_pathname: checkpoint of the optical flow network
+            gpus: indices of the devices to spread the pairs over
+            max_pair_dist: pairs of frames less than this many frames apart
+                are computed (consecutive frames by default; pairs of training
+                beyond it are inferred by the optical flow model)
+
+        Returns:
+            the flow store that was built
+        """
+        os.makedirs(store_dir, exist_ok=True)
+
+        pairs = [(dataset.image_info[prev_id]['path'], dataset.source_image_link(prev_id),
+                  dataset.image_info[curr_id]['path'], dataset.source_image_link(curr_id))
+                 for prev_id, curr_id in frame_pairs(dataset, max_pair_dist)]
+        chunks = np.array_split(np.arange(len(pairs)), len(gpus))
+
+        shard_entries = [[] for _ in gpus]
+        workers = [threading.Thread(target=_compute_shard,
+                                    args=(path.join(store_dir, f'flows_{k:03d}.bin'),
+                                          [pairs[i] for i in chunk], model_pathname, gpu, shard_entries[k]))
+                   for k, (gpu, chunk) in enumerate(zip(gpus, chunks))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        entries = [entry for e in shard_entries for entry in e]
+        if len(entries) != len(pairs):
+            raise RuntimeError(f'only computed {len(entries)} out of {len(pairs)} flow fields')
+
+        with open(path.join(store_dir, _INDEX_FILENAME), 'w') as f:
+            json.dump({'dtype': np.dtype(_DTYPE).name, 'max_pair_dist': max_pair_dist, 'pairs': entries}, f)
+
+        return FlowStore(store_dir)
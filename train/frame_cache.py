@@ -0,0 +1,114 @@
+"""
+Byte-budgeted LRU cache of decoded frames.
+
+Generators that sample pairs of nearby frames (see
+Davis2017Dataset.paired_generator) load each frame many times per epoch;
+decoding it once and keeping it while it is still in use removes most of that
+work. Entries are numpy arrays (or tuples of them), evicted least recently
+used first once their total size exceeds the budget. Cached arrays are made
+read-only, since every caller shares them.
+
+Usage:
+cache = FrameCache(2 ** 30)
+image = cache.get(('image', filename), lambda: skimage.io.imread(filename))
+"""
+
+from collections import OrderedDict
+import numpy as np
+from threading import Lock
+
+__all__ = ['FrameCache']
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+
+    return getattr(value, 'nbytes', 0)
+
+
+def _read_only(value):
+    if isinstance(value, tuple):
+        return tuple(_read_only(v) for v in value)
+
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+
+    return value
+
+
+class FrameCache:
+    """
+    Thread-safe LRU cache holding at most max_bytes of arrays. A budget of 0
+    disables caching.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __getstate__(self):
+        # worker processes start with an empty cache of the same budget
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, load):
+        """
+        Returns the cached value of key, loading (and caching) it with load()
+        if it isn't cached.
+
+        Args:
+            key: hashable key of the value (e.g. a kind and a path)
+            load: function returning the value
+
+        Returns:
+            the value (arrays are read-only if it was cached)
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # decoding happens outside of the lock, so that threads decode in parallel
+        value = load()
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return value
+
+        value = _read_only(value)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self.nbytes += size
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= _nbytes(evicted)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+
+        return self.hits / total if total else 0.
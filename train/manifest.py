@@ -0,0 +1,271 @@
+"""
+Columnar image manifests for the DAVIS and WAD datasets.
+
+A Manifest holds the image info of a dataset as a few numpy columns (ids,
+paths, videos, frame indices, whether a mask exists and image sizes) instead
+of a list of dicts, so that it saves and loads (as .npz) in milliseconds,
+slices by video, and can be split, shuffled and merged without copying a dict
+per image. It can be used directly as the image_info of a utils.Dataset:
+indexing it with an integer builds that image's info on the fly, as a
+read-only mapping (writes to it would be lost). Adding an image to the dataset
+with add_image() turns its image info back into a list of dicts.
+
+Manifests are built by scanners that list each directory once (in parallel,
+one directory per worker) instead of checking the existence of every file.
+
+Usage:
+dataset.image_info = scan_wad('/data/wad/train')
+dataset.image_info.save('/data/wad/train.manifest.npz')
+dataset.image_info = Manifest.load('/data/wad/train.manifest.npz')
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+from os import path
+from PIL import Image
+from types import MappingProxyType
+from typing import Iterable, List
+
+__all__ = ['Manifest', 'add_manifest', 'scan_davis', 'scan_wad']
+
+_STR_COLUMNS = ('source', 'id', 'path', 'mask_path', 'video')
+_INT_COLUMNS = ('frame', 'height', 'width')
+_COLUMNS = _STR_COLUMNS + _INT_COLUMNS + ('has_mask',)
+
+
+class Manifest:
+    """
+    Image info of a dataset, stored as columns. Rows are kept sorted by video
+    and frame by the scanners, so that each video is a contiguous range.
+    """
+
+    def __init__(self, columns: dict):
+        n = len(columns['id'])
+        self.columns = {'source': np.asarray(columns['source'], dtype=str),
+                        'id': np.asarray(columns['id'], dtype=str),
+                        'path': np.asarray(columns['path'], dtype=str),
+                        'mask_path': np.asarray(columns.get('mask_path', [''] * n), dtype=str),
+                        'video': np.asarray(columns.get('video', [''] * n), dtype=str),
+                        'frame': np.asarray(columns.get('frame', np.zeros(n)), dtype=np.int32),
+                        'has_mask': np.asarray(columns.get('has_mask', np.zeros(n)), dtype=bool),
+                        'height': np.asarray(columns.get('height', np.zeros(n)), dtype=np.int32),
+                        'width': np.asarray(columns.get('width', np.zeros(n)), dtype=np.int32)}
+
+    @classmethod
+    def from_image_info(cls, image_info: Iterable[dict]) -> 'Manifest':
+        """Builds a manifest from a list of image info dicts."""
+        image_info = list(image_info)
+        columns = {name: [info.get(name) or '' for info in image_info] for name in _STR_COLUMNS}
+        columns.update({name: [info.get(name) or 0 for info in image_info] for name in _INT_COLUMNS})
+        columns['id'] = [str(info['id']) for info in image_info]
+        columns['has_mask'] = [info.get('mask_path') is not None for info in image_info]
+
+        return cls(columns)
+
+    @classmethod
+    def concatenate(cls, *manifests: 'Manifest') -> 'Manifest':
+        return cls({name: np.concatenate([m.columns[name] for m in manifests]) for name in _COLUMNS})
+
+    @classmethod
+    def load(cls, filename: str) -> 'Manifest':
+        with np.load(filename, allow_pickle=False) as columns:
+            return cls(dict(columns))
+
+    def save(self, filename: str):
+        np.savez(filename, **self.columns)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, index):
+        """
+        An integer index returns the info of that image (as built by
+        utils.Dataset.add_image(), but read-only); a slice, index array or boolean mask
+        returns the manifest of those images.
+        """
+        if isinstance(index, (int, np.integer)):
+            return self._info(index)
+
+        return Manifest({name: column[index] for name, column in self.columns.items()})
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._info(i)
+
+    def _info(self, i: int) -> MappingProxyType:
+        c = self.columns
+        info = {'id': c['id'][i], 'source': c['source'][i], 'path': c['path'][i],
+                'video': c['video'][i] or None, 'frame': int(c['frame'][i]),
+                'height': int(c['height'][i]), 'width': int(c['width'][i])}
+        # images without a mask have no 'mask_path' (see Davis2017Dataset.has_mask)
+        if c['has_mask'][i]:
+            info['mask_path'] = c['mask_path'][i]
+
+        return MappingProxyType(info)
+
+    def extend(self, image_info: Iterable[dict]):
+        """Appends images (like list.extend()), from a manifest or info dicts."""
+        other = image_info if isinstance(image_info, Manifest) else Manifest.from_image_info(image_info)
+        self.columns = Manifest.concatenate(self, other).columns
+
+    def source_keys(self) -> np.ndarray:
+        """'source.id' of every image (see utils.Dataset.prepare())."""
+        return np.char.add(np.char.add(self.columns['source'], '.'), self.columns['id'])
+
+    def videos(self) -> List[str]:
+        """Names of the videos in this manifest, in order."""
+        videos, first = np.unique(self.columns['video'], return_index=True)
+
+        return list(videos[np.argsort(first)])
+
+    def video_slice(self, video: str) -> slice:
+        """Range of rows of a video (rows must be grouped by video)."""
+        rows = np.flatnonzero(self.columns['video'] == video)
+        if not len(rows):
+            return slice(0, 0)
+
+        return slice(rows[0], rows[-1] + 1)
+
+    def video(self, video: str) -> 'Manifest':
+        """Manifest of the frames of one video."""
+        return self[self.video_slice(video)]
+
+
+def add_manifest(image_info, manifest: Manifest):
+    """
+    Appends the images of a manifest to the image info of a dataset, which
+    becomes (or stays) a manifest unless images were already added one by one.
+
+    Returns:
+        the new image info of the dataset
+    """
+    if isinstance(image_info, Manifest) or len(image_info):
+        image_info.extend(manifest)
+        return image_info
+
+    return manifest
+
+
+def _sorted_by_video(columns: dict) -> Manifest:
+    manifest = Manifest(columns)
+    order = np.lexsort((manifest.columns['id'], manifest.columns['video']))
+    manifest = manifest[order]
+
+    # frame index within each video
+    videos = manifest.columns['video']
+    starts = np.flatnonzero(np.r_[True, videos[1:] != videos[:-1]])
+    manifest.columns['frame'] = np.arange(len(videos)) - np.repeat(starts, np.diff(np.r_[starts, len(videos)]))
+
+    return manifest
+
+
+def _read_sizes(filenames: List[str], workers: int):
+    """Reads (height, width) of images from their headers, in parallel."""
+    def size_of(filename):
+        with Image.open(filename) as image:
+            return image.size[::-1]
+
+    with ThreadPoolExecutor(workers) as pool:
+        return np.array(list(pool.map(size_of, filenames)), dtype=np.int32).reshape(-1, 2)
+
+
+def _list_files(directory: str) -> List[str]:
+    try:
+        return [entry.name for entry in os.scandir(directory) if entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def scan_davis(images_dir: str, labels_dir: str, videos: Iterable[str] = (), source='DAVIS2017',
+               read_sizes=False, workers=16) -> Manifest:
+    """
+    Builds the manifest of DAVIS-style videos (a directory of frames per video,
+    with a directory of masks per video next to it).
+
+    Args:
+        images_dir: directory containing a directory of frames per video
+        labels_dir: directory containing a directory of masks per video
+        videos: videos to scan (all the videos in images_dir if empty)
+        source: source name of the images
+        read_sizes: whether to read the size of every image (from its header)
+        workers: number of directories listed (or images read) in parallel
+
+    Returns:
+        manifest of all frames, sorted by video and frame
+    """
+    videos = list(videos) or sorted(entry.name for entry in os.scandir(images_dir) if entry.is_dir())
+
+    def scan_video(video):
+        frames = sorted(_list_files(path.join(images_dir, video)))
+        masks = set(_list_files(path.join(labels_dir, video)))
+
+        return video, frames, masks
+
+    columns = {name: [] for name in ('id', 'path', 'mask_path', 'video', 'has_mask')}
+    with ThreadPoolExecutor(workers) as pool:
+        for video, frames, masks in pool.map(scan_video, videos):
+            for filename in frames:
+                img_id = filename[:-4]
+                columns['id'].append(img_id)
+                columns['path'].append(path.join(video, filename))
+                columns['mask_path'].append(path.join(video, f'{img_id}.png'))
+                columns['video'].append(video)
+                columns['has_mask'].append(f'{img_id}.png' in masks)
+    columns['source'] = [source] * len(columns['id'])
+
+    manifest = _sorted_by_video(columns)
+    if read_sizes:
+        sizes = _read_sizes([path.join(images_dir, p) for p in manifest.columns['path']], workers)
+        manifest.columns['height'], manifest.columns['width'] = sizes[:, 0], sizes[:, 1]
+
+    return manifest
+
+
+def scan_wad(root_dir: str, labeled=True, assume_match=False, source='WAD', read_sizes=False,
+             workers=16) -> Manifest:
+    """
+    Builds the manifest of a WAD subset (images in root_dir + '_color', masks in
+    root_dir + '_label').
+
+    Args:
+        root_dir: root directory of the subset (e.g. '<data>/train')
+        labeled: whether the images have ground-truth masks (unmasked images
+            are left out if so)
+        assume_match: whether to assume the mask files for all images exist
+        source: source name of the images
+        read_sizes: whether to read the size of every image (from its header)
+        workers: number of directories listed (or images read) in parallel
+
+    Returns:
+        manifest of all images, sorted by video (camera and day) and time
+    """
+    from train.wad_dataset import WadDataset
+
+    with ThreadPoolExecutor(workers) as pool:
+        images = pool.submit(_list_files, root_dir + '_color')
+        masks = pool.submit(_list_files, root_dir + '_label') if labeled and not assume_match else None
+        images, masks = images.result(), set(masks.result()) if masks is not None else None
+
+    columns = {name: [] for name in ('id', 'path', 'mask_path', 'video', 'has_mask')}
+    for img_filename in images:
+        img_id = img_filename[:-4]
+        mask_filename = img_id + '_instanceIds.png'
+
+        # ignores the image if no mask exists
+        if masks is not None and mask_filename not in masks:
+            continue
+
+        columns['id'].append(img_id)
+        columns['path'].append(img_filename)
+        columns['mask_path'].append(mask_filename if labeled else '')
+        columns['video'].append(WadDataset.video_of(img_id) or '')
+        columns['has_mask'].append(labeled)
+    columns['source'] = [source] * len(columns['id'])
+
+    manifest = _sorted_by_video(columns)
+    if read_sizes:
+        sizes = _read_sizes([path.join(root_dir + '_color', p) for p in manifest.columns['path']], workers)
+        manifest.columns['height'], manifest.columns['width'] = sizes[:, 0], sizes[:, 1]
+
+    return manifest
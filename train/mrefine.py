@@ -8,6 +8,10 @@ Commands Available:
              (requires a matplotlib backend that supports display)
     * sizes - run each component of the module separate on fixed size inputs to
               verify input and output tensor sizes/shapes
+    * flows - precompute the optical flow field of every pair of consecutive
+              frames (or up to --store-pair-dist frames apart) in a dataset
+              (DAVIS or WAD) into a flow store, which the train command then
+              loads instead of running PWC-Net
     * infer - (WIP) predict an overall refined mask for an image pair from a
               dataset (with augmentation, not with image segmentation integration)
               
@@ -17,6 +21,7 @@ command `python -m train.mrefine -h` from the root directory of this project.
 
 import argparse
 import imgaug.augmenters as iaa
+from os import path
 import sys
 from warnings import warn
 import tensorflow as tf
@@ -32,7 +37,8 @@ forward-compatibility in case they can in future.
 COMMANDS = {'train': 'train',
             'infer': 'infer',
             'augs': 'augs',
-            'sizes': 'sizes'
+            'sizes': 'sizes',
+            'flows': 'flows'
             }
 COMMANDS_LIST = list(COMMANDS.values())
 
@@ -64,6 +70,12 @@ parser.add_argument('-d', '--dataset', dest='dataset_path', type=str,
 parser.add_argument('-o', '--optical-flow', dest='optical_flow_path', type=str,
                     nargs=1,
                     default=['./opt_flow/models/pwcnet-lg-6-2-multisteps-chairsthingsmix/pwcnet.ckpt-595000'])
+parser.add_argument('-c', '--flow-cache', dest='flow_cache_path', type=str,
+                    nargs=1,
+                    default=[None])
+parser.add_argument('-f', '--flow-store', dest='flow_store_path', type=str,
+                    nargs=1,
+                    default=[None])
 parser.add_argument('-m', '--mask-refine', dest='mask_refine_path', type=str,
                     nargs=1,
                     default=[None])
@@ -73,6 +85,21 @@ parser.add_argument('-e', '-epochssteps', dest='epochssteps', type=int,
                     nargs=2, default=[100, 500])
 parser.add_argument('-p', '--print-debugs', dest='print_debugs', action='store_true')
 parser.add_argument('--gpu', dest='device', type=int, nargs=1, default=[0])
+parser.add_argument('-w', '--workers', dest='workers', type=int, nargs=1, default=[1],
+                    help='Number of GPUs (starting at --gpu) to precompute flows on')
+parser.add_argument('-l', '--loader-workers', dest='loader_workers', type=int, nargs=1, default=[None],
+                    help='Number of processes loading training and validation samples (all CPUs by default, a '
+                         'quarter of them for validation; 0 loads them on the training thread)')
+parser.add_argument('--max-pair-dist', dest='max_pair_dist', type=int, nargs=1, default=[10],
+                    help='Frames of a training pair are less than this many frames apart')
+parser.add_argument('--store-pair-dist', dest='store_pair_dist', type=int, nargs=1, default=[2],
+                    help='Frames of a pair precomputed by the flows command are less than this many frames apart '
+                         '(consecutive frames by default). Each flow field takes 4 bytes per pixel of the padded '
+                         'frame (about 1.8 MB at 480p, 37 MB for WAD frames), and a store holds '
+                         '--store-pair-dist - 1 of them per frame: about 11 GB per frame distance for DAVIS '
+                         '2017 trainval at 480p')
+parser.add_argument('--wad', dest='wad', action='store_true',
+                    help='Precompute flows for the WAD dataset (train subset) instead of DAVIS')
 
 ############################################################################
 
@@ -81,23 +108,36 @@ args = parser.parse_args()
 cmd = args.cmd
 dataset_path = args.dataset_path[0]
 optical_flow_path = args.optical_flow_path[0]
+flow_cache_path = args.flow_cache_path[0]
+flow_store_path = args.flow_store_path[0]
 mask_refine_path = args.mask_refine_path[0]
 val_split = args.val_split[0]
 epochs = args.epochssteps[0]
 steps = args.epochssteps[1]
 print_debugs = args.print_debugs
 device = args.device[0]
+workers = args.workers[0]
+loader_workers = args.loader_workers[0]
+max_pair_dist = args.max_pair_dist[0]
+store_pair_dist = args.store_pair_dist[0]
+wad = args.wad
 
 print('Arguments given to trainmaskrefine command: ')
 print(f'\tcommand\t{cmd}')
 print(f'\tdataset\t{dataset_path}')
 print(f'\toptical\t{optical_flow_path}')
+print(f'\tfcache\t{flow_cache_path}')
+print(f'\tfstore\t{flow_store_path}')
 print(f'\tmrefine\t{mask_refine_path}')
 print(f'\tv split\t{val_split}')
 print(f'\tepochs\t{epochs}')
 print(f'\tsteps\t{steps}')
 print(f'\tdebugs\t{print_debugs}')
 print(f'\tdevice\tGPU:{device}')
+print(f'\tworkers\t{workers}')
+print(f'\tloader workers\t{loader_workers}')
+print(f'\tpair dist\t{max_pair_dist}')
+print(f'\tstore pair dist\t{store_pair_dist}')
 print()
 
 
@@ -152,21 +192,96 @@ elif cmd == COMMANDS['train']:
 
     dataset = get_trainval(dataset_path)
 
-    train, val = splitd(dataset, 1 - val_split, val_split, shuffle=False)
-    train_gen, val_gen = train.paired_generator(AUG_SEQ), val.paired_generator(AUG_SEQ)
+    train, val = splitd(dataset, 1 - val_split, val_split, shuffle=False, by_video=True)
 
-    pwc_net = TensorFlowPWCNet(dataset.size, model_pathname=optical_flow_path,
-                               verbose=print_debugs, gpu=device)
+    from train.refine_loader import missing_flows
 
-    with tf.device(f'/device:GPU:{device + 1}'):
-        mr_subnet = MaskRefineSubnet(pwc_net)
+    flow_store = None
+    if flow_store_path is not None:
+        from train.flow_store import FlowStore
+
+        flow_store = FlowStore(flow_store_path)
+
+    # flow fields are loaded from the store, so PWC-Net is only needed for the
+    # pairs that are missing from it
+    missing = sum(missing_flows(d, d.id_pairs(max_pair_dist), flow_store) for d in (train, val))
+    if flow_store is not None and missing:
+        warn(f'{missing} pairs of frames are not in the flow store, their flow fields are inferred by PWC-Net '
+             f'(build the store with --store-pair-dist {max_pair_dist} to precompute them)')
+
+    loaders = []
+    if loader_workers != 0:
+        import multiprocessing
+        from train.refine_loader import PairedLoader
+
+        # the workers are split between the loaders, a quarter for validation
+        total_workers = loader_workers or multiprocessing.cpu_count()
+        val_workers = max(1, total_workers // 4)
+        train_workers = max(1, total_workers - val_workers)
+
+        train_gen = PairedLoader(train, AUG_SEQ, steps, flow_store=flow_store, max_pair_dist=max_pair_dist,
+                                 workers=train_workers)
+        val_gen = PairedLoader(val, AUG_SEQ, 100, flow_store=flow_store, max_pair_dist=max_pair_dist,
+                               workers=val_workers)
+        loaders = [train_gen, val_gen]
+
+        # fork the workers before TensorFlow starts sessions and threads
+        for loader in loaders:
+            loader.start()
+
+    try:
+        pwc_net = None
+        if missing:
+            pwc_net = TensorFlowPWCNet(dataset.size, model_pathname=optical_flow_path,
+                                       verbose=print_debugs, gpu=device)
+
+        if loader_workers == 0:
+            train_gen = train.paired_generator(AUG_SEQ, max_pair_dist=max_pair_dist, flow_store=flow_store)
+            val_gen = val.paired_generator(AUG_SEQ, max_pair_dist=max_pair_dist, flow_store=flow_store)
+        else:
+            from opt_flow.opt_flow import CachedOpticalFlow
+
+            flow_model = pwc_net
+            if flow_cache_path is not None and pwc_net is not None:
+                flow_model = CachedOpticalFlow(pwc_net, cache_dir=flow_cache_path)
+
+            for loader in loaders:
+                loader.optical_flow_model = flow_model
+
+        with tf.device(f'/device:GPU:{device + 1}'):
+            mr_subnet = MaskRefineSubnet(pwc_net)
+
+            if mask_refine_path is not None:
+                mr_subnet.load_weights(mask_refine_path)
+
+        printd('Starting MaskRefine training...')
+
+        mr_subnet.train(train_gen, val_gen, epochs=epochs, steps_per_epoch=steps, flow_cache_dir=flow_cache_path)
+    finally:
+        for loader in loaders:
+            loader.close()
+elif cmd == COMMANDS['flows']:
+    from train.flow_store import FlowStore
+
+    if wad:
+        from train.wad_dataset import WadDataset
+
+        dataset = WadDataset()
+        dataset.load_data(dataset_path, 'train', labeled=False)
+        dataset.prepare()
+    else:
+        dataset = get_trainval(dataset_path)
+
+    if flow_store_path is None:
+        flow_store_path = path.join(dataset_path, 'flows')
 
-        if mask_refine_path is not None:
-            mr_subnet.load_weights(mask_refine_path)
+    gpus = list(range(device, device + workers))
+    printd(f'Precomputing flows for {dataset.num_images} images on GPUs {gpus}...')
 
-    printd('Starting MaskRefine training...')
+    flow_store = FlowStore.build(dataset, flow_store_path, optical_flow_path, gpus=gpus,
+                                 max_pair_dist=store_pair_dist)
 
-    mr_subnet.train(train_gen, val_gen, epochs=epochs, steps_per_epoch=steps)
+    print(f'Wrote {len(flow_store)} flow fields to {flow_store_path}')
 elif cmd == COMMANDS['sizes']:
     warn_if_debugging_without_prints("sizes")
 
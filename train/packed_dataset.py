@@ -0,0 +1,273 @@
+#!usr/bin/env python
+"""
+Packed, pre-resized Mask R-CNN training data.
+
+Decoding multi-megapixel JPEGs and PNGs and resizing them (in float64) every
+time an image is sampled makes training decode-bound. compile_dataset() does
+that work once: each image is resized the way load_image_gt() would resize it
+(without the padding/cropping, which stays cheap) and stored as raw uint8,
+next to its instances as a uint16 label map (see utils.Dataset.load_label_map)
+and its precomputed boxes and class IDs. Images and label maps go into large
+shard files that PackedDataset memory-maps, so loading an image is a view
+into the page cache rather than a decode.
+
+A packed dataset is a directory containing:
+ * index.json - class info, image info and shard names
+ * index.npz - columns of offsets and shapes of every image and label map,
+   and the (concatenated) boxes and class IDs of the instances of every image
+ * shard_<k>.bin - raw images and label maps
+
+Usage:
+compile_dataset(dataset, '/data/wad-packed', WadConfig())
+dataset = PackedDataset('/data/wad-packed', config=WadConfig())
+dataset.prepare()
+
+From the command line (run from the root directory of the project):
+python -m train.packed_dataset -d <dataset root> -o <output dir> [--davis]
+"""
+
+import argparse
+import json
+import numpy as np
+import os
+from os import path
+
+from image_seg import utils
+from image_seg.config import Config
+
+__all__ = ['PackedDataset', 'compile_dataset']
+
+_INDEX_FILENAME = 'index'
+_DEFAULT_SHARD_BYTES = 2 ** 30
+_RESIZE_SETTINGS = ('IMAGE_RESIZE_MODE', 'IMAGE_MIN_DIM', 'IMAGE_MAX_DIM', 'IMAGE_MIN_SCALE')
+
+
+def _resize_settings(config: Config) -> dict:
+    return {name: getattr(config, name) for name in _RESIZE_SETTINGS}
+
+
+def _packed_image(dataset: utils.Dataset, image_id: int, config: Config):
+    """
+    Loads an image with its label map, and scales both the way load_image_gt()
+    will, but without padding or cropping them.
+
+    Returns:
+        (image, label_map, class_ids, bbox) of the image, resized, the
+        original shape of the image and the scale it was resized by
+    """
+    image = dataset.load_image(image_id)
+    label_map, class_ids = dataset.load_label_map(image_id)
+    original_shape = image.shape
+
+    # random crops happen at training time, and only square mode caps the size
+    mode = config.IMAGE_RESIZE_MODE if config.IMAGE_RESIZE_MODE != 'crop' else 'pad64'
+    image, window, scale, _, _ = utils.resize_image(image,
+                                                    min_dim=config.IMAGE_MIN_DIM,
+                                                    min_scale=config.IMAGE_MIN_SCALE,
+                                                    max_dim=config.IMAGE_MAX_DIM,
+                                                    mode=mode)
+    y1, x1, y2, x2 = window
+    image = np.ascontiguousarray(image[y1:y2, x1:x2], dtype=np.uint8)
+    label_map = utils.resize_label_map(label_map, scale, [(0, 0), (0, 0), (0, 0)])
+
+    bbox, _ = utils.extract_label_map_masks(label_map, len(class_ids))
+
+    return (image, np.ascontiguousarray(label_map, dtype=np.uint16), np.asarray(class_ids, dtype=np.int32), bbox,
+            original_shape, scale)
+
+
+def compile_dataset(dataset: utils.Dataset, out_dir: str, config: Config, shard_bytes=_DEFAULT_SHARD_BYTES,
+                    verbose=True):
+    """
+    Writes a *prepared* dataset into a packed dataset (see PackedDataset).
+
+    Args:
+        dataset: dataset to pack (its load_label_map() is used for the masks)
+        out_dir: directory to write the packed dataset to
+        config: Mask R-CNN configuration whose resizing settings (IMAGE_MIN_DIM,
+            IMAGE_MAX_DIM, IMAGE_MIN_SCALE, IMAGE_RESIZE_MODE) are applied
+        shard_bytes: a new shard is started once a shard exceeds this size
+        verbose: print progress
+
+    Returns:
+        path to the packed dataset
+    """
+    # load_image_gt() resizes the packed images again, which is a no-op unless
+    # IMAGE_MIN_SCALE forces an upscale, which would then be applied twice
+    assert not config.IMAGE_MIN_SCALE or config.IMAGE_MIN_SCALE <= 1, \
+        'Packed datasets do not support IMAGE_MIN_SCALE > 1'
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards = []
+    columns = {name: [] for name in ('shard', 'image_offset', 'image_shape', 'mask_offset',
+                                     'instance_start', 'instance_count')}
+    bboxes, class_ids = [], []
+    image_info = []
+
+    f, offset = None, 0
+    try:
+        for image_id in dataset.image_ids:
+            if f is None or offset >= shard_bytes:
+                if f is not None:
+                    f.close()
+                shards.append(f'shard_{len(shards):04d}.bin')
+                f, offset = open(path.join(out_dir, shards[-1]), 'wb'), 0
+
+            image, label_map, image_class_ids, bbox, original_shape, scale = _packed_image(dataset, image_id,
+                                                                                            config)
+
+            columns['shard'].append(len(shards) - 1)
+            columns['image_offset'].append(offset)
+            columns['image_shape'].append(image.shape)
+            f.write(image.tobytes())
+            offset += image.nbytes
+
+            columns['mask_offset'].append(offset)
+            f.write(label_map.tobytes())
+            offset += label_map.nbytes
+
+            columns['instance_start'].append(len(class_ids))
+            columns['instance_count'].append(len(image_class_ids))
+            bboxes.extend(bbox)
+            class_ids.extend(image_class_ids)
+
+            info = dataset.image_info[image_id]
+            image_info.append({'source': info['source'], 'id': info['id'], 'path': info['path'],
+                               'video': info.get('video'), 'original_shape': original_shape,
+                               'resize_scale': scale})
+
+            if verbose and (image_id + 1) % 100 == 0:
+                print(f'Packed {image_id + 1}/{dataset.num_images} images')
+    finally:
+        if f is not None:
+            f.close()
+
+    np.savez(path.join(out_dir, _INDEX_FILENAME + '.npz'),
+             bbox=np.array(bboxes, dtype=np.int32).reshape(-1, 4),
+             class_ids=np.array(class_ids, dtype=np.int32),
+             **{name: np.array(column, dtype=np.int64) for name, column in columns.items()})
+
+    with open(path.join(out_dir, _INDEX_FILENAME + '.json'), 'w') as f:
+        # ids may be numpy scalars
+        json.dump({'shards': shards, 'class_info': dataset.class_info, 'image_info': image_info,
+                   'resize': _resize_settings(config)}, f, default=lambda o: o.item())
+
+    return out_dir
+
+
+class PackedDataset(utils.Dataset):
+    """
+    Dataset of images and label maps written by compile_dataset(). Images and
+    label maps are returned as read-only views into memory-mapped shards.
+
+    Images are already scaled as configured when the dataset was compiled, so
+    load_image_gt() only pads (or crops) them, and uses the stored boxes when
+    it doesn't crop or augment; image_info[image_id]['original_shape'] and
+    ['resize_scale'] keep the shape of the source image and the scale it was
+    resized by, which go into the image metas. Use the same resizing settings in training
+    as when compiling (see resize_settings).
+    """
+
+    label_maps = True
+
+    def __init__(self, packed_dir: str, class_map=None, config: Config = None):
+        """
+        Args:
+            packed_dir: directory written by compile_dataset()
+            class_map: see utils.Dataset
+            config: if given, its resizing settings must match the ones the
+                dataset was compiled with (ValueError otherwise)
+        """
+        super(PackedDataset, self).__init__(class_map)
+
+        self.packed_dir = packed_dir
+
+        with open(path.join(packed_dir, _INDEX_FILENAME + '.json'), 'r') as f:
+            index = json.load(f)
+        self.resize_settings = index['resize']
+        if config is not None and _resize_settings(config) != self.resize_settings:
+            raise ValueError(f'{packed_dir} was compiled with {self.resize_settings}, '
+                             f'not {_resize_settings(config)}')
+        self._columns = dict(np.load(path.join(packed_dir, _INDEX_FILENAME + '.npz')))
+        self._shard_names = index['shards']
+        self._shards = {}
+
+        for info in index['class_info'][1:]:
+            self.add_class(info['source'], info['id'], info['name'])
+        for i, info in enumerate(index['image_info']):
+            self.add_image(info['source'], info['id'], info['path'], packed_index=i,
+                           video=info['video'], original_shape=tuple(info['original_shape']),
+                           resize_scale=info['resize_scale'])
+
+    def _shard(self, shard: int) -> np.ndarray:
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(path.join(self.packed_dir, self._shard_names[shard]),
+                                            dtype=np.uint8, mode='r')
+
+        return self._shards[shard]
+
+    def _view(self, i: int, offset_column: str, shape, dtype) -> np.ndarray:
+        shard = self._shard(self._columns['shard'][i])
+        offset = self._columns[offset_column][i]
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        return shard[offset:offset + size].view(dtype).reshape(shape)
+
+    def load_image(self, image_id: int) -> np.ndarray:
+        """Returns the (resized) image [height, width, 3] as a read-only view."""
+        i = self.image_info[image_id]['packed_index']
+
+        return self._view(i, 'image_offset', self._columns['image_shape'][i], np.uint8)
+
+    def load_label_map(self, image_id: int):
+        """Returns the (resized) label map [height, width] as a read-only view,
+        and the class IDs of the instances."""
+        i = self.image_info[image_id]['packed_index']
+        label_map = self._view(i, 'mask_offset', self._columns['image_shape'][i][:2], np.uint16)
+
+        return label_map, self._instances(i, 'class_ids')
+
+    def load_mask(self, image_id: int):
+        """Generates dense instance masks [height, width, instance count] from
+        the label map."""
+        label_map, class_ids = self.load_label_map(image_id)
+        _, masks = utils.extract_label_map_masks(label_map, len(class_ids))
+
+        return masks if self.sparse_masks else masks.to_dense(), class_ids
+
+    def load_bboxes(self, image_id: int) -> np.ndarray:
+        """Returns the precomputed boxes [instance count, (y1, x1, y2, x2)] of
+        the instances in the (resized) image."""
+        return self._instances(self.image_info[image_id]['packed_index'], 'bbox')
+
+    def _instances(self, i: int, column: str) -> np.ndarray:
+        start = self._columns['instance_start'][i]
+
+        return self._columns[column][start:start + self._columns['instance_count'][i]]
+
+    def image_reference(self, image_id: int) -> str:
+        return self.image_info[image_id]['path']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a dataset into a packed, pre-resized dataset')
+    parser.add_argument('-d', '--dataset', dest='dataset_path', type=str, required=True)
+    parser.add_argument('-o', '--output', dest='output_path', type=str, required=True)
+    parser.add_argument('--davis', dest='davis', action='store_true',
+                        help='Compile the DAVIS 2017 trainval set instead of the WAD train set')
+    parser.add_argument('--shard-gb', dest='shard_gb', type=float, default=_DEFAULT_SHARD_BYTES / 2 ** 30)
+    args = parser.parse_args()
+
+    if args.davis:
+        from train.davis2017_dataset import get_trainval
+
+        dataset, config = get_trainval(args.dataset_path), Config()
+    else:
+        from train.wad_dataset import WadConfig, WadDataset
+
+        dataset, config = WadDataset(), WadConfig()
+        dataset.load_data(args.dataset_path, 'train')
+        dataset.prepare()
+
+    compile_dataset(dataset, args.output_path, config, shard_bytes=int(args.shard_gb * 2 ** 30))
@@ -0,0 +1,252 @@
+"""
+Prefetching, multi-worker loader of mask refine training samples.
+
+Davis2017Dataset.paired_generator() decodes frames, augments masks and (in
+MaskRefineSubnet.train) infers flow fields on the training thread, one sample
+at a time. PairedLoader splits that into stages that run concurrently with
+training:
+ 1. worker processes decode the frames of a pair and augment the masks of
+    all its instances (and read its flow field from a flow store, if given
+    and the pair is in it). Each worker loads a whole block of pairs (see
+    Davis2017Dataset.shuffled_blocks) at a time, so the frames they share
+    stay in the frame cache of that worker
+ 2. a thread infers the flow fields that aren't precomputed (the optical flow
+    model stays in the training process) and splits pairs into samples
+ 3. samples wait in a bounded queue, from which training takes them
+
+The loader never stops between epochs: pairs are reshuffled (see
+Davis2017Dataset.shuffled_blocks) whenever they run out. If loading fails, the
+error is raised by every later request for a sample.
+
+Workers are forked, which can deadlock them if the process already runs
+TensorFlow sessions or other threads: call start() before building models.
+
+Usage:
+loader = PairedLoader(train_dataset, AUG_SEQ, steps_per_epoch=500, flow_store=flow_store)
+loader.start()
+pwc_net = TensorFlowPWCNet(...)
+loader.optical_flow_model = pwc_net
+try:
+    mr_subnet.train(loader, val_loader, steps_per_epoch=500)
+finally:
+    loader.close()
+"""
+
+from collections import deque
+from keras.utils import Sequence
+import multiprocessing
+import numpy as np
+import os
+from queue import Full, Queue
+from threading import Event, Thread
+
+from mask_refine.mask_refine import pad64
+
+__all__ = ['PairedLoader', 'missing_flows']
+
+# state of a worker process (see _init_worker)
+_worker = {}
+
+
+def _init_worker(dataset, augmentation, flow_store, seed):
+    _worker.update(dataset=dataset, augmentation=augmentation, flow_store=flow_store)
+
+    # forked workers would otherwise all draw the same augmentations
+    augmentation.reseed((seed + os.getpid()) % 2 ** 31)
+
+
+def _load_block(block):
+    """Loads the pairs of a block, in order (in a worker)."""
+    return [_load_pair(pair) for pair in block]
+
+
+def _load_pair(pair):
+    """
+    Loads a pair of frames and the masks of the current frame (in a worker).
+
+    Returns:
+        (previous image [1, h, w, 3], current image [1, h, w, 3], augmented
+        masks [n, h, w, 1], ground-truth masks [n, h, w, 1], flow field
+        [1, h, w, 2] or None), padded to multiples of 64
+    """
+    dataset, augmentation, flow_store = _worker['dataset'], _worker['augmentation'], _worker['flow_store']
+    prev_id, curr_id = pair
+
+    prev_image = np.expand_dims(dataset.load_image(prev_id), axis=0)
+    curr_image = np.expand_dims(dataset.load_image(curr_id), axis=0)
+    gt_masks, _ = dataset.load_float_mask(curr_id)
+    gt_masks = np.expand_dims(np.moveaxis(gt_masks, -1, 0), axis=-1)
+
+    # each instance gets its own augmentation
+    aug_masks = np.array([augmentation.to_deterministic().augment_image(255 * mask.astype(int))
+                          for mask in gt_masks]).reshape(gt_masks.shape)
+
+    flow_field = None
+    paths = (dataset.image_info[prev_id]['path'], dataset.image_info[curr_id]['path'])
+    if flow_store is not None and paths in flow_store:
+        flow_field = pad64(np.expand_dims(flow_store.load(*paths), axis=0))
+
+    return (*map(pad64, (prev_image, curr_image, aug_masks, gt_masks)), flow_field)
+
+
+def missing_flows(dataset, id_pairs, flow_store=None):
+    """
+    Counts the pairs of frames whose flow field isn't in a flow store (and so
+    must be inferred by an optical flow model).
+
+    Args:
+        dataset: dataset the pairs are from
+        id_pairs: pairs of image ids (see Davis2017Dataset.id_pairs())
+        flow_store: train.flow_store.FlowStore (all pairs are missing if None)
+
+    Returns:
+        number of pairs without a precomputed flow field
+    """
+    if flow_store is None:
+        return len(id_pairs)
+
+    return sum((dataset.image_info[i]['path'], dataset.image_info[j]['path']) not in flow_store
+               for i, j in id_pairs)
+
+
+class PairedLoader(Sequence):
+    """
+    Keras Sequence of mask refine training samples ([current image, mask,
+    flow field], ground-truth mask), each for one instance of a pair of frames
+    (as paired_generator() with mask_as_input). Samples are produced ahead of
+    time by the stages described above; indexing returns the next sample, so
+    the order is random whatever the index.
+
+    Call start() early (see above) and close() to stop the workers.
+    """
+
+    def __init__(self, dataset, augmentation, steps_per_epoch, optical_flow_model=None, flow_store=None,
+                 max_pair_dist=10, locality=32, workers=None, prefetch=64, seed=None):
+        """
+        Args:
+            dataset: *prepared* Davis2017Dataset to take pairs of frames from
+            augmentation: imgaug augmentations turning ground-truth masks into
+                input masks
+            steps_per_epoch: number of samples in an epoch (the length of the
+                sequence)
+            optical_flow_model: model inferring the flow fields that are not
+                in flow_store (only needed if some pairs are missing from it;
+                can be set after start())
+            flow_store: train.flow_store.FlowStore of precomputed flow fields
+            max_pair_dist: maximum distance between 2 frames (in a pair)
+            locality: see Davis2017Dataset.shuffled_blocks() (up to
+                workers + 1 blocks of loaded pairs are held in memory)
+            workers: number of worker processes (the number of CPUs if None)
+            prefetch: number of samples ready ahead of training
+            seed: seed of the augmentations of the workers
+        """
+        self.dataset = dataset
+        self.augmentation = augmentation
+        self.steps_per_epoch = steps_per_epoch
+        self.optical_flow_model = optical_flow_model
+        self.flow_store = flow_store
+        self.locality = locality
+        self.workers = workers or multiprocessing.cpu_count()
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+
+        self.id_pairs = dataset.id_pairs(max_pair_dist)
+        if not self.id_pairs:
+            raise ValueError('the dataset has no pairs of frames')
+
+        self._samples = Queue(maxsize=prefetch)
+        self._stopped = Event()
+        self._pool = None
+        self._thread = None
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __getitem__(self, index):
+        if self._thread is None:
+            self._start_producing()
+
+        sample = self._samples.get()
+        if isinstance(sample, Exception):
+            # the producer has stopped: leave the error for the next calls
+            self._samples.put(sample)
+            raise sample
+
+        return sample
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self[0]
+
+    def start(self):
+        """Forks the worker processes (if not done yet)."""
+        if self._pool is not None:
+            return
+
+        # workers are forked, so they don't need to pickle the dataset
+        context = multiprocessing.get_context('fork')
+        self._pool = context.Pool(self.workers, initializer=_init_worker,
+                                  initargs=(self.dataset, self.augmentation, self.flow_store, self.seed))
+
+    def _start_producing(self):
+        """Starts the workers (unless started already) and the flow thread."""
+        if self.optical_flow_model is None:
+            missing = missing_flows(self.dataset, self.id_pairs, self.flow_store)
+            if missing:
+                raise ValueError(f'{missing} pairs of frames have no precomputed flow field, so an optical flow '
+                                 f'model is needed')
+
+        self.start()
+        self._thread = Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops producing samples."""
+        self._stopped.set()
+        if self._thread is not None:
+            # the pool can't be terminated while workers send results
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _block_stream(self):
+        while True:
+            yield from self.dataset.shuffled_blocks(self.id_pairs, self.locality)
+
+    def _produce(self):
+        blocks = self._block_stream()
+
+        # a bounded number of blocks is loading at any time, in order, each
+        # in a single worker
+        pending = deque(self._pool.apply_async(_load_block, (next(blocks),)) for _ in range(self.workers + 1))
+
+        try:
+            while not self._stopped.is_set():
+                loaded = pending.popleft().get()
+                pending.append(self._pool.apply_async(_load_block, (next(blocks),)))
+
+                for prev_image, curr_image, aug_masks, gt_masks, flow_field in loaded:
+                    if flow_field is None:
+                        img_stack = np.concatenate((prev_image, curr_image), axis=-1)
+                        flow_field = np.expand_dims(
+                            self.optical_flow_model.infer_from_image_stack(img_stack[0, ...]), axis=0)
+
+                    for i in range(len(gt_masks)):
+                        self._put(([curr_image, aug_masks[i:i + 1], flow_field], gt_masks[i:i + 1]))
+        except Exception as e:
+            # errors of the workers are raised by training
+            self._put(e)
+        finally:
+            for result in pending:
+                result.wait()
+
+    def _put(self, sample):
+        """Queues a sample, unless the loader is closed first."""
+        while not self._stopped.is_set():
+            try:
+                self._samples.put(sample, timeout=0.1)
+                return
+            except Full:
+                pass
@@ -13,8 +13,10 @@ import os
 import pickle
 import re
 import skimage.io
+from warnings import warn
 
 from image_seg import config, utils
+from train.manifest import Manifest, add_manifest, scan_wad
 from os.path import join, isfile, exists
 
 __all__ = ['WadConfig', 'WadDataset', 'class_names', 'classes_to_index', 'index_to_classes', 'index_to_class_names']
@@ -137,7 +139,8 @@ class WadDataset(utils.Dataset):
                 mask_file = None
 
             # Add the image to the dataset
-            self.add_image(self.name, image_id=img_id, path=img_file, mask_path=mask_file)
+            self.add_image(self.name, image_id=img_id, path=img_file, mask_path=mask_file,
+                           video=os.path.basename(video_list_filename))
 
     def _load_all_images(self, labeled: bool = True, assume_match: bool = False):
         """Load all images from the img_dir directory, with corresponding masks
@@ -164,25 +167,43 @@ class WadDataset(utils.Dataset):
                 mask_filename = None
 
             # Adds the image to the dataset
-            self.add_image('WAD', img_id, img_filename, mask_path=mask_filename)
+            self.add_image('WAD', img_id, img_filename, mask_path=mask_filename, video=self.video_of(img_id))
+
+    @staticmethod
+    def video_of(img_id: str):
+        """Name of the video (a camera on a given day) that an image belongs to.
+        :param img_id: id of the image (e.g. '170908_061502408_Camera_5')
+        :return: name of the video (e.g. '170908_Camera_5'), or None if the id
+        doesn't follow that format
+        """
+        matches = re.search('^([0-9]+)_[0-9]+_(Camera_[0-9]+)$', img_id)
+
+        return None if matches is None else '_'.join(matches.group(1, 2))
 
     def load_data(self, root_dir: str, subset: str,
-                  labeled: bool = True, assume_match: bool = False, use_pickle: bool = True):
+                  labeled: bool = True, assume_match: bool = False, use_manifest: bool = True, workers: int = 16,
+                  use_pickle: bool = None):
         """Load a subset of the WAD image segmentation dataset.
         :param root_dir: Root directory of the train
         :param subset: Which subset to load: images will be looked for in 'subset_color' and masks will
-        be looked for in 'subset_label' (will look for pickle file subset.pkl first)
+        be looked for in 'subset_label' (will look for the manifest file subset.manifest.npz first)
         :param labeled: Whether the images have ground-truth masks
         :param assume_match: whether to assume the mask files for all images exist (ignored if labeled
         is False)
-        :param use_pickle: If False, forces a fresh load of the files
+        :param use_manifest: If False, forces a fresh scan of the files
+        :param workers: number of threads scanning the files
+        :param use_pickle: Deprecated alias of use_manifest
         """
+        if use_pickle is not None:
+            warn('use_pickle is deprecated, use use_manifest instead', DeprecationWarning, stacklevel=2)
+            use_manifest = use_pickle
+
         self.root_dir = join(root_dir, subset)
 
-        pickle_path = self.root_dir + '.pkl'
+        manifest_path = self.root_dir + '.manifest.npz'
 
-        if use_pickle and isfile(pickle_path):
-            self.load_data_from_file(pickle_path)
+        if use_manifest and isfile(manifest_path):
+            manifest = Manifest.load(manifest_path)
         else:
             # Check directories for existence
             assert exists(self.root_dir + '_color')
@@ -190,10 +211,14 @@ class WadDataset(utils.Dataset):
                 assert exists(self.root_dir + '_label')
 
             # blindly load all images
-            self._load_all_images(labeled=labeled, assume_match=assume_match)
+            manifest = scan_wad(self.root_dir, labeled=labeled, assume_match=assume_match, source=self.name,
+                                workers=workers)
 
             # save list of images for future speed improvements
-            self.save_data_to_file(pickle_path)
+            manifest.save(manifest_path)
+
+        # keep the images that were already added
+        self.image_info = add_manifest(self.image_info, manifest)
 
     def load_image(self, image_id: int) -> np.ndarray:
         """Load the specified image and return a [H,W,3] Numpy array.
@@ -207,8 +232,7 @@ class WadDataset(utils.Dataset):
             return super(self.__class__, self).load_image(image_id)
 
         # Load image
-        path = join(self.root_dir + '_color', info['path'])
-        image = skimage.io.imread(path)
+        image = skimage.io.imread(self.source_image_link(image_id))
 
         # If has an alpha channel, remove it for consistency
         if image.shape[-1] == 4:
@@ -216,12 +240,17 @@ class WadDataset(utils.Dataset):
 
         return image
 
+    def source_image_link(self, image_id: int) -> str:
+        """Return the full path to the image file."""
+
+        return join(self.root_dir + '_color', self.image_info[image_id]['path'])
+
     def load_mask(self, image_id: int) -> (np.ndarray, np.ndarray):
         """Generate instance masks for an image.
         image_id: integer id of the image
         Returns:
         masks: A bool array of shape [height, width, instance count] with
-            one mask per instance.
+            one mask per instance (utils.SparseMasks if sparse_masks is set).
         class_ids: a 1D array of class IDs of the instance masks.
         """
 
@@ -242,12 +271,16 @@ class WadDataset(utils.Dataset):
         index = np.searchsorted(unique, 255)
         unique = np.delete(unique, index, axis=0)
 
-        # tensors!
-        raw_mask = raw_mask.reshape(self.image_height, self.image_width, 1)
+        if self.sparse_masks:
+            # only the pixels inside each instance's box are kept
+            masks = utils.SparseMasks.from_label_map(raw_mask.reshape(self.image_height, self.image_width), unique)
+        else:
+            # tensors!
+            raw_mask = raw_mask.reshape(self.image_height, self.image_width, 1)
 
-        # k = instance_count
-        # broadcast (h, w, 1) x (k,) => (h, w, k) : bool array
-        masks = raw_mask == unique
+            # k = instance_count
+            # broadcast (h, w, 1) x (k,) => (h, w, k) : bool array
+            masks = raw_mask == unique
 
         # get the actual class id
         # int(PixelValue / 1000) is the label (class of object)
@@ -257,6 +290,33 @@ class WadDataset(utils.Dataset):
         # Return mask, and array of class IDs of each instance.
         return masks, class_ids
 
+    def load_label_map(self, image_id: int) -> (np.ndarray, np.ndarray):
+        """Load the instances of an image as a single label map.
+        image_id: integer id of the image
+        Returns:
+        label_map: A uint16 array of shape [height, width], where 0 is
+            background and i + 1 is the i-th instance.
+        class_ids: a 1D array of class IDs of the instances.
+        """
+
+        info = self.image_info[image_id]
+
+        # If not a WAD dataset image, delegate to parent class
+        if info["source"] != "WAD":
+            return super(self.__class__, self).load_label_map(image_id)
+
+        # Read the original mask image
+        mask_path = join(self.root_dir + '_label', info['mask_path'])
+        raw_mask = skimage.io.imread(mask_path).reshape(self.image_height, self.image_width)
+
+        # 255 is background
+        label_map, instance_ids = utils.compact_label_map(raw_mask, background_ids=(255,))
+
+        # int(PixelValue / 1000) is the label (class of object)
+        class_ids = np.array([classes_to_index[e] for e in np.floor_divide(instance_ids, 1000)])
+
+        return label_map, class_ids
+
     def load_data_from_file(self, filename: str):
         """Load images from pickled file.
         filename: name of the pickle file